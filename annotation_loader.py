@@ -0,0 +1,501 @@
+import os
+import functools
+import hashlib
+import operator
+import tempfile
+import zipfile
+import xml.parsers.expat
+from collections.abc import Mapping
+import numpy as np
+import xml.etree.ElementTree as ET
+from profiler import profiled
+
+
+# アノテーションのタグと型コードの対応(frame, textが連続するように並べる)
+ANNOTATION_TYPES = ("frame", "text", "body", "face")
+TYPE_CODES = {tag: code for code, tag in enumerate(ANNOTATION_TYPES)}
+COORD_COLUMNS = ("xmin", "ymin", "xmax", "ymax")
+BBOX_KEYS = ("type", "id") + COORD_COLUMNS
+_get_row = operator.itemgetter("id", *COORD_COLUMNS)
+
+
+class BBox(Mapping):
+    """
+    1つのバウンディングボックス情報
+    従来の辞書と同じように bbox["xmin"] で参照できる(座標は文字列ではなく整数)
+    """
+
+    __slots__ = BBOX_KEYS
+
+    def __init__(self, type, id, xmin, ymin, xmax, ymax):
+        self.type = type
+        self.id = id
+        self.xmin = xmin
+        self.ymin = ymin
+        self.xmax = xmax
+        self.ymax = ymax
+
+    def __getitem__(self, key):
+        if key not in BBOX_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(BBOX_KEYS)
+
+    def __len__(self):
+        return len(BBOX_KEYS)
+
+    def __reduce__(self):
+        return BBox, tuple(getattr(self, key) for key in BBOX_KEYS)
+
+    def __repr__(self):
+        return f"BBox({', '.join(f'{key}={getattr(self, key)!r}' for key in BBOX_KEYS)})"
+
+
+def _smallest_int_dtype(values):
+    """
+    座標の範囲に収まる最小の整数型を選ぶ
+    :param values: 整数の配列
+    :return: np.int16またはnp.int32
+    """
+    if len(values) == 0 or (values.min() >= np.iinfo(np.int16).min and values.max() <= np.iinfo(np.int16).max):
+        return np.int16
+    return np.int32
+
+
+def _iter_page_elements(xml_file, pages=None):
+    """
+    アノテーションファイルをiterparseで走査し，<page>要素を1つずつ返す
+    返したページの要素は次の要素に進む時点で破棄する
+    :param xml_file: アノテーションファイルのパス
+    :param pages: 返すページのインデックス(Noneの場合は全ページ)，全て返した時点で走査を打ち切る
+    :return: <page>要素のジェネレータ
+    """
+    remaining = None if pages is None else set(pages)
+    for _, elem in ET.iterparse(xml_file, events=("end",)):
+        if elem.tag != "page":
+            continue
+        index = int(elem.get("index"))
+        if remaining is not None and index not in remaining:
+            elem.clear()
+            continue
+
+        yield elem
+
+        # 処理済みのページの子要素を破棄してメモリを解放
+        elem.clear()
+        if remaining is not None:
+            remaining.discard(index)
+            if not remaining:
+                break
+
+
+def _table_from_page_elements(page_elements):
+    """
+    <page>要素の列を列ごとの配列にまとめる
+    :param page_elements: <page>要素のイテラブル
+    :return: アノテーションテーブル(load_annotation_tableを参照)
+    """
+    page_index, page_width, page_height = [], [], []
+    type_offsets = []
+    types, doc_order, rows_all = [], [], []
+
+    for elem in page_elements:
+        page_index.append(int(elem.get("index")))
+        page_width.append(int(elem.get("width", 0)))
+        page_height.append(int(elem.get("height", 0)))
+
+        # 型コードごとに分けて，同じ型の中では文書順を保つ
+        rows_by_type = [[] for _ in ANNOTATION_TYPES]
+        positions_by_type = [[] for _ in ANNOTATION_TYPES]
+        position = 0
+        for obj in elem:
+            code = TYPE_CODES.get(obj.tag)
+            if code is None:
+                continue
+            rows_by_type[code].append(_get_row(obj.attrib))
+            positions_by_type[code].append(position)
+            position += 1
+
+        offsets = [len(types)]
+        for code, rows in enumerate(rows_by_type):
+            types.extend([code] * len(rows))
+            rows_all.extend(rows)
+            doc_order.extend(positions_by_type[code])
+            offsets.append(len(types))
+        type_offsets.append(offsets)
+
+    table = {
+        "page_index": np.array(page_index, dtype=np.int32),
+        "page_width": np.array(page_width, dtype=np.int32),
+        "page_height": np.array(page_height, dtype=np.int32),
+        "type_offsets": np.array(type_offsets, dtype=np.int64).reshape(-1, len(ANNOTATION_TYPES) + 1),
+        "type": np.array(types, dtype=np.uint8),
+        "doc_order": np.array(doc_order, dtype=np.int32),
+    }
+    # 属性は行ごとに集めて最後に列へ変換
+    columns = list(zip(*rows_all)) or [()] * (len(COORD_COLUMNS) + 1)
+    try:
+        # idは16進数の文字列なのでバイト列で持つ
+        table["id"] = np.array(columns[0], dtype=bytes)
+    except UnicodeEncodeError:
+        table["id"] = np.array(columns[0], dtype=str)
+    for column, values in zip(COORD_COLUMNS, columns[1:]):
+        table[column] = np.fromiter(map(int, values), dtype=np.int64, count=len(values))
+    # 座標はページ内に収まる最小の整数型で持つ
+    coord_dtype = max((_smallest_int_dtype(table[column]) for column in COORD_COLUMNS), key=lambda t: np.dtype(t).itemsize)
+    for column in COORD_COLUMNS:
+        table[column] = table[column].astype(coord_dtype)
+    _index_pages(table)
+    return table
+
+
+@profiled("parse_xml")
+def _parse_annotation_xml(xml_file, pages=None):
+    """
+    アノテーションファイルをiterparseで1回だけ走査し，列ごとの配列にまとめる
+    ページの要素は処理した時点で破棄する
+    :param xml_file: アノテーションファイルのパス
+    :param pages: 読み込むページのインデックス(Noneの場合は全ページ)，全て読み込んだ時点で走査を打ち切る
+    :return: アノテーションテーブル(load_annotation_tableを参照)
+    """
+    return _table_from_page_elements(_iter_page_elements(xml_file, pages))
+
+
+def _index_pages(table):
+    """
+    ページインデックスからページ番号(行番号)への辞書をテーブルに追加
+    :param table: アノテーションテーブル
+    """
+    table["page_position"] = {index: p for p, index in enumerate(table["page_index"].tolist())}
+
+
+# キャッシュ形式のバージョン(テーブルの列を変更したら上げる)
+ANNOTATION_CACHE_VERSION = 2
+# キャッシュの保存先(Noneの場合はアノテーションディレクトリと同じ階層の<ディレクトリ名>.cache)
+ANNOTATION_CACHE_DIR = os.environ.get("MANGA109_ANNOTATION_CACHE_DIR")
+
+
+def annotation_cache_path(xml_file, cache_dir=None):
+    """
+    アノテーションファイルに対応するキャッシュファイルのパスを取得
+    :param xml_file: アノテーションファイルのパス
+    :param cache_dir: キャッシュの保存先(Noneの場合はANNOTATION_CACHE_DIR)
+    :return: キャッシュファイル(.npz)のパス
+    """
+    ano_dir, file_name = os.path.split(os.path.abspath(xml_file))
+    if cache_dir is None:
+        cache_dir = ANNOTATION_CACHE_DIR or ano_dir + ".cache"
+    return os.path.join(cache_dir, os.path.splitext(file_name)[0] + ".npz")
+
+
+def _file_digest(path):
+    """
+    ファイル内容のSHA-1を計算
+    :param path: ファイルのパス
+    :return: 16進数のハッシュ値
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_annotation_cache(cache_file, path, mtime_ns, size):
+    """
+    キャッシュが元のアノテーションファイルと一致していれば読み込む
+    サイズが異なる場合は無効，更新時刻だけが異なる場合は内容のハッシュで判定する
+    :param cache_file: キャッシュファイルのパス
+    :param path: アノテーションファイルのパス
+    :param mtime_ns: アノテーションファイルの更新時刻
+    :param size: アノテーションファイルのサイズ
+    :return: (アノテーションテーブル, メタ情報の更新が必要か)，無効な場合は(None, False)
+    """
+    try:
+        with np.load(cache_file, allow_pickle=False) as npz:
+            table = {name: npz[name] for name in npz.files}
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None, False
+
+    meta = {name: table.pop(name) for name in list(table) if name.startswith("_meta_")}
+    if "_meta_version" not in meta or int(meta["_meta_version"]) != ANNOTATION_CACHE_VERSION:
+        return None, False
+    if int(meta["_meta_size"]) != size:
+        return None, False
+    if int(meta["_meta_mtime_ns"]) == mtime_ns:
+        return table, False
+    if str(meta["_meta_sha1"]) == _file_digest(path):
+        return table, True
+    return None, False
+
+
+def _write_annotation_cache(cache_file, table, path, mtime_ns, size):
+    """
+    アノテーションテーブルをキャッシュに書き込む(書き込めない場合は何もしない)
+    :param cache_file: キャッシュファイルのパス
+    :param table: アノテーションテーブル
+    :param path: アノテーションファイルのパス
+    :param mtime_ns: アノテーションファイルの更新時刻
+    :param size: アノテーションファイルのサイズ
+    """
+    arrays = {name: value for name, value in table.items() if isinstance(value, np.ndarray)}
+    arrays["_meta_version"] = np.array(ANNOTATION_CACHE_VERSION)
+    arrays["_meta_size"] = np.array(size)
+    arrays["_meta_mtime_ns"] = np.array(mtime_ns)
+    arrays["_meta_sha1"] = np.array(_file_digest(path))
+    _save_arrays_atomic(cache_file, arrays)
+
+
+def _save_arrays_atomic(npz_file, arrays):
+    """
+    配列を.npzに書き込む
+    一時ファイルに書いてからos.replaceで置き換えるため，複数プロセスから同時に読み書きしても壊れない
+    書き込めない場合は何もしない
+    :param npz_file: 書き込むファイルのパス
+    :param arrays: 配列の辞書
+    """
+    try:
+        npz_dir = os.path.dirname(npz_file)
+        os.makedirs(npz_dir, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=npz_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_file, npz_file)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+    except OSError:
+        pass
+
+
+# ページ位置の索引の形式のバージョン
+PAGE_OFFSETS_VERSION = 1
+
+
+def page_offsets_path(xml_file):
+    """
+    アノテーションファイルに対応するページ位置の索引ファイルのパスを取得(アノテーションファイルと同じディレクトリ)
+    :param xml_file: アノテーションファイルのパス
+    :return: 索引ファイル(.pages.npz)のパス
+    """
+    return os.path.splitext(os.path.abspath(xml_file))[0] + ".pages.npz"
+
+
+def _scan_page_offsets(path):
+    """
+    expatでアノテーションファイルを走査し，各<page>要素のバイト範囲を記録
+    :param path: アノテーションファイルのパス
+    :return: page_index, start, end(<page>要素の開始位置と終了位置の次), encodingの辞書
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    parser = xml.parsers.expat.ParserCreate()
+    page_index, starts, ends = [], [], []
+    # has_children: 現在の<page>要素が子要素をもつか(空要素タグの判定に使う)
+    state = {"encoding": "utf-8", "has_children": False}
+
+    def on_xml_decl(version, encoding, standalone):
+        if encoding:
+            state["encoding"] = encoding
+
+    def on_start(name, attrs):
+        if name == "page":
+            page_index.append(int(attrs["index"]))
+            starts.append(parser.CurrentByteIndex)
+            state["has_children"] = False
+        else:
+            state["has_children"] = True
+
+    def on_end(name):
+        if name != "page":
+            return
+        position = parser.CurrentByteIndex
+        if not state["has_children"] and data[position - 2 : position] == b"/>":
+            # 空要素タグ(<page .../>)は終了イベントの位置がタグの直後になる
+            ends.append(position)
+        else:
+            ends.append(data.index(b">", position) + 1)
+
+    parser.XmlDeclHandler = on_xml_decl
+    parser.StartElementHandler = on_start
+    parser.EndElementHandler = on_end
+    parser.Parse(data, True)
+    return {
+        "page_index": np.array(page_index, dtype=np.int32),
+        "start": np.array(starts, dtype=np.int64),
+        "end": np.array(ends, dtype=np.int64),
+        "encoding": np.array(state["encoding"]),
+    }
+
+
+@functools.lru_cache(maxsize=16)
+def _load_page_offsets(path, mtime_ns, size):
+    """
+    ページ位置の索引を読み込み，ないかアノテーションファイルが更新されていれば作り直す
+    :param path: アノテーションファイルの絶対パス
+    :param mtime_ns: ファイルの更新時刻(キャッシュキー)
+    :param size: ファイルサイズ(キャッシュキー)
+    :return: ページ位置の索引(_scan_page_offsetsを参照)
+    """
+    index_file = page_offsets_path(path)
+    try:
+        with np.load(index_file, allow_pickle=False) as npz:
+            offsets = {name: npz[name] for name in npz.files}
+        meta = (int(offsets.pop("_meta_version")), int(offsets.pop("_meta_size")), int(offsets.pop("_meta_mtime_ns")))
+        if meta == (PAGE_OFFSETS_VERSION, size, mtime_ns):
+            return offsets
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        pass
+
+    offsets = _scan_page_offsets(path)
+    arrays = dict(offsets)
+    arrays["_meta_version"] = np.array(PAGE_OFFSETS_VERSION)
+    arrays["_meta_size"] = np.array(size)
+    arrays["_meta_mtime_ns"] = np.array(mtime_ns)
+    _save_arrays_atomic(index_file, arrays)
+    return offsets
+
+
+def load_page_offsets(xml_file):
+    """
+    アノテーションファイルの各<page>要素のバイト範囲の索引を取得
+    索引はアノテーションファイルと同じディレクトリに保存し，ファイルが更新されていれば作り直す
+    :param xml_file: アノテーションファイルのパス
+    :return: page_index, start, end, encodingの辞書
+    """
+    path = os.path.abspath(xml_file)
+    stat = os.stat(path)
+    return _load_page_offsets(path, stat.st_mtime_ns, stat.st_size)
+
+
+@profiled("parse_xml")
+def load_annotation_pages(xml_file, pages):
+    """
+    ページ位置の索引を用いて，指定したページの<page>要素だけを読み込んでパースする
+    :param xml_file: アノテーションファイルのパス
+    :param pages: 読み込むページのインデックスのイテラブル
+    :return: 指定したページだけをもつアノテーションテーブル(文書順，存在しないページは含まない)
+    """
+    offsets = load_page_offsets(xml_file)
+    wanted = set(pages)
+    positions = [p for p, index in enumerate(offsets["page_index"].tolist()) if index in wanted]
+    encoding = str(offsets["encoding"])
+
+    def page_elements():
+        with open(xml_file, "rb") as f:
+            for p in positions:
+                start = int(offsets["start"][p])
+                f.seek(start)
+                fragment = f.read(int(offsets["end"][p]) - start)
+                yield ET.fromstring(fragment.decode(encoding))
+
+    return _table_from_page_elements(page_elements())
+
+
+@functools.lru_cache(maxsize=4)
+def _load_annotation_table(path, mtime_ns, size, use_cache):
+    """
+    同じファイルを続けて読み込む場合に再パースしないためのキャッシュ
+    use_cacheがTrueの場合はディスク上のキャッシュを読み，なければ作成する
+    :param path: アノテーションファイルの絶対パス
+    :param mtime_ns: ファイルの更新時刻(キャッシュキー)
+    :param size: ファイルサイズ(キャッシュキー)
+    :param use_cache: ディスク上のキャッシュを使うか
+    :return: アノテーションテーブル
+    """
+    if not use_cache:
+        return _parse_annotation_xml(path)
+
+    cache_file = annotation_cache_path(path)
+    table, stale_meta = _read_annotation_cache(cache_file, path, mtime_ns, size)
+    if table is None:
+        table = _parse_annotation_xml(path)
+        _write_annotation_cache(cache_file, table, path, mtime_ns, size)
+    else:
+        _index_pages(table)
+        if stale_meta:
+            # 内容は同じなので更新時刻だけを書き直す
+            _write_annotation_cache(cache_file, table, path, mtime_ns, size)
+    return table
+
+
+def load_annotation_table(xml_file, use_cache=True, pages=None):
+    """
+    アノテーションファイルを列指向のテーブルとして読み込む
+    各ページの行は型コード順(frame, text, body, face)に並んでおり，
+    ページpの型tの行は type_offsets[p, t] から type_offsets[p, t + 1] の範囲にある
+    2回目以降はannotation_cache_pathのキャッシュから読み込む
+    pagesを指定した場合はページ位置の索引からそのページだけを読み込む(load_annotation_pagesを参照)
+    :param xml_file: アノテーションファイルのパス
+    :param use_cache: ディスク上のキャッシュを使うか
+    :param pages: 読み込むページのインデックスのイテラブル(Noneの場合は全ページ)
+    :return: アノテーションテーブル
+        page_index, page_width, page_height: ページごとの配列
+        type_offsets: ページ×型ごとの行の開始位置
+        type, id, xmin, ymin, xmax, ymax: 行ごとの配列(typeはTYPE_CODESの型コード，idはバイト列，座標はint16またはint32)
+        doc_order: ページ内での文書順
+        page_position: ページインデックスからページ番号(行番号)への辞書
+    """
+    if pages is not None:
+        return load_annotation_pages(xml_file, pages)
+    path = os.path.abspath(xml_file)
+    stat = os.stat(path)
+    return _load_annotation_table(path, stat.st_mtime_ns, stat.st_size, use_cache)
+
+
+def _type_range(types):
+    """
+    タグのリストを連続した型コードの範囲に変換
+    :param types: タグのリスト
+    :return: (先頭の型コード, 末尾の型コード+1)
+    """
+    codes = sorted(TYPE_CODES[tag] for tag in types)
+    if codes != list(range(codes[0], codes[-1] + 1)):
+        raise ValueError(f"types must be contiguous in {ANNOTATION_TYPES}: {types}")
+    return codes[0], codes[-1] + 1
+
+
+def page_columns(table, page_index, types=ANNOTATION_TYPES):
+    """
+    1ページ分の指定したタグの列をスライス(コピーなし)で取得
+    :param table: アノテーションテーブル
+    :param page_index: ページのインデックス
+    :param types: 取得するタグのリスト(型コードが連続している必要がある)
+    :return: type, id, doc_order, xmin, ymin, xmax, ymaxの配列の辞書(型コード順)
+    """
+    first, last = _type_range(types)
+    offsets = table["type_offsets"][table["page_position"][page_index]]
+    rows = slice(offsets[first], offsets[last])
+    return {column: table[column][rows] for column in ("type", "id", "doc_order") + COORD_COLUMNS}
+
+
+def page_objects(table, page_index, types=ANNOTATION_TYPES):
+    """
+    1ページ分の指定したタグのバウンディングボックス情報を取得
+    :param table: アノテーションテーブル
+    :param page_index: ページのインデックス
+    :param types: 取得するタグのリスト
+    :return: バウンディングボックス情報(BBox)のリスト(文書順)
+    """
+    columns = page_columns(table, page_index, types)
+    order = np.argsort(columns["doc_order"], kind="stable")
+    ids = columns["id"][order].tolist()
+    if columns["id"].dtype.kind == "S":
+        ids = [obj_id.decode() for obj_id in ids]
+    rows = zip(columns["type"][order].tolist(), ids, *(columns[column][order].tolist() for column in COORD_COLUMNS))
+    return [BBox(ANNOTATION_TYPES[code], obj_id, xmin, ymin, xmax, ymax) for code, obj_id, xmin, ymin, xmax, ymax in rows]
+
+
+def table_to_page_objects(table, types=ANNOTATION_TYPES):
+    """
+    アノテーションテーブルをページごとのバウンディングボックス情報に変換
+    各オブジェクトは従来の辞書と同じように参照できるBBoxで返す
+    :param table: アノテーションテーブル
+    :param types: 取得するタグのリスト
+    :return: ページごとのバウンディングボックス情報(文書順)
+    """
+    return {page_index: page_objects(table, page_index, types) for page_index in table["page_index"].tolist()}
@@ -4,8 +4,11 @@ import cv2
 from modules import *
 import math
 import numpy as np
-import itertools
-from scipy.spatial import distance_matrix
+from scipy.spatial import cKDTree
+# 吹き出しの順序推定(全順序・予算内のビームサーチ)はballoon_orderの実装を使う
+from balloon_order import order_balloons_beam, order_page_balloons, order_page_balloons_beam
+from image_prefetch import prefetch_pages
+from image_source import open_image_source
 
 
 def get_distance(x1, y1, x2, y2):
@@ -96,69 +99,62 @@ def order_balloons(panel, bounded_text):
     return ordered_balloons
 
 
-# こちらを採用
-def order_balloons2(panel, bounded_text):
-    """
-    吹き出しの順番を決定する(全順序)
-    :param panel: コマのバウンディングボックス情報
-    :param bounded_text: コマ内の吹き出しのバウンディングボックス情報
-    :return: 吹き出しの順番のリスト
-    :see also: find_nearest_balloon コマ右上の座標と最も近い吹き出しを見つける関数
-    :see also: get_distance 2点間の距離を計算する関数
-    """
-    panel_xmax, panel_ymin = int(panel["xmax"]), int(panel["ymin"])
-    start = find_nearest_balloon(panel, bounded_text)
-    if start is None:
-        return []
+# 吹き出しごとに返す話者の候補数の既定値
+SPEAKER_TOP_K = 3
 
-    start_point = [(int(start["xmin"]) + int(start["xmax"])) / 2, (int(start["ymin"]) + int(start["ymax"])) / 2]
-    end_point = [int(panel["xmin"]), int(panel["ymax"])]
 
-    # 吹き出しの中心座標を取得
-    points = []
-    for balloon in bounded_text:
-        center = [(int(balloon["xmin"]) + int(balloon["xmax"])) / 2, (int(balloon["ymin"]) + int(balloon["ymax"])) / 2]
-        points.append(center)
-        # スタート地点は除外
-        if center == start_point:
-            points.remove(center)
-    # 始点をstart_point,終点ををend_pointとして，pointsを全て通る最短経路を求める
-    points = [start_point] + points + [end_point]
-    # print(f'points: {points}')
-    # 各点間の距離を計算
-    dist_matrix = distance_matrix(points, points)
-
-    # 巡回経路となるインデックスを全列挙
-    N = len(points)
-    indices = np.arange(N)
-    paths = [p for p in itertools.permutations(indices[1:-1])]
-
-    # 各巡回経路の総距離を計算し、最短経路を求める
-    best_dist = np.inf
-    best_path = None
-    for path in paths:
-        path = [0] + list(path) + [N - 1]
-        dist = np.sum([dist_matrix[path[i], path[i + 1]] for i in range(len(path) - 1)])
-        if dist < best_dist:
-            best_dist = dist
-            best_path = path
-
-    # 最短経路上の吹き出しをbounded_textから取得
-    ordered_balloons = []
-    for i in best_path[0:-1]:
-        point = points[i]
-        for balloon in bounded_text:
-            balloon_center = [
-                (int(balloon["xmin"]) + int(balloon["xmax"])) / 2,
-                (int(balloon["ymin"]) + int(balloon["ymax"])) / 2,
-            ]
-            # print(f'point: {point}, balloon_center: {balloon_center}')
-            if balloon_center == point:
-                ordered_balloons.append(balloon)
-            else:
-                print("not found")
+def find_speaker_candidates(panels, page_ordered_balloons, characters, k=SPEAKER_TOP_K, max_distance=None, iou_threshold=0.5):
+    """
+    ページ内の各吹き出しについて，同じコマ内で中心が近いキャラクター(body, face)を話者の候補として求める
+    キャラクターのコマへの割り当てはget_bouded_objと同じ判定で行い，
+    中心座標にコマごとに離した3番目の座標を加えた点のKD木をページで1つ作って，全吹き出しをまとめて検索する
+    :param panels: ページ内のコマのバウンディングボックス情報
+    :param page_ordered_balloons: コマごとの順序付けた吹き出し(order_page_balloonsの結果)
+    :param characters: ページ内のキャラクター(body, face)のバウンディングボックス情報
+    :param k: 吹き出しごとの候補数の上限
+    :param max_distance: 候補とする中心間の距離の上限(この距離ちょうどのキャラクターも含む，Noneの場合は制限しない)
+    :param iou_threshold: コマに内包されているかを判定するIoUの閾値
+    :return: コマごと・吹き出しごとの話者の候補[(キャラクター, 中心間の距離), ...](近い順)
+    :see also: get_bouded_obj コマに内包されるオブジェクトを求める関数
+    """
+    candidates = [[[] for _ in ordered_balloons] for ordered_balloons in page_ordered_balloons]
+    balloons = [balloon for ordered_balloons in page_ordered_balloons for balloon in ordered_balloons]
+    if not balloons or not characters:
+        return candidates
+
+    # キャラクターは内包されるコマごとに1点ずつ置く(複数のコマに内包される場合は複数点)
+    assigned = assign_objs_to_panels(panels, characters, iou_threshold)
+    point_character = np.concatenate(assigned).astype(np.int64)
+    if point_character.size == 0:
+        return candidates
+    point_panel = np.repeat(np.arange(len(assigned)), [len(indices) for indices in assigned])
+
+    character_boxes = bboxes_to_array(characters).astype(np.float64)
+    balloon_boxes = bboxes_to_array(balloons).astype(np.float64)
+    character_centers = (character_boxes[:, :2] + character_boxes[:, 2:]) / 2
+    balloon_centers = (balloon_boxes[:, :2] + balloon_boxes[:, 2:]) / 2
+    balloon_panel = np.repeat(np.arange(len(page_ordered_balloons)), [len(b) for b in page_ordered_balloons])
+
+    # 3番目の座標の間隔はページ内の最大距離より大きくし，別のコマの点が上限距離内に入らないようにする
+    centers = np.concatenate([character_centers, balloon_centers])
+    extent = float(np.ptp(centers, axis=0).max())
+    separation = 2 * extent + 2
+    # KD木の検索は上限距離ちょうどの点を含まないため，max_distanceより大きい上限で検索してから距離で絞り込む
+    upper_bound = separation - 1 if max_distance is None else min(max_distance + 1, separation - 1)
+    tree = cKDTree(np.column_stack([character_centers[point_character], point_panel * separation]))
+    distances, points = tree.query(
+        np.column_stack([balloon_centers, balloon_panel * separation]),
+        k=list(range(1, k + 1)),
+        distance_upper_bound=upper_bound,
+    )
 
-    return ordered_balloons
+    flat = [balloon_candidates for panel_candidates in candidates for balloon_candidates in panel_candidates]
+    for balloon_candidates, row_distances, row_points in zip(flat, distances.tolist(), points.tolist()):
+        for distance, point in zip(row_distances, row_points):
+            if math.isinf(distance) or (max_distance is not None and distance > max_distance):
+                break
+            balloon_candidates.append((characters[point_character[point]], distance))
+    return candidates
 
 
 if __name__ == "__main__":
@@ -184,52 +180,41 @@ if __name__ == "__main__":
     manga109 = True
     # manga109 = False
     ano_file_path = manga109_ano_dir + manga_title + ".xml"
-    img_folder_path = manga109_img_dir + manga_title + "/"
-
-    # 画像ファイル名を取得
-    imgs = os.listdir(img_folder_path)
-    imgs.sort()
+    # 画像の読み込み元(展開済みのフォルダ，なければCBZ/ZIPの書庫)
+    img_source = open_image_source(manga109_img_dir, manga_title)
 
     panels = get_panelbbox_info_from_xml(ano_file_path)
     balloons = get_textbbox_info_from_xml(ano_file_path)
+    characters = table_to_page_objects(load_annotation_table(ano_file_path), ["body", "face"])
 
-    for page_index in balloons.keys():
-        img_path = index_to_img_path(page_index, img_folder_path)
+    # 画像は次のページの処理中に別スレッドで先読みする
+    for page_index, img in prefetch_pages(balloons.keys(), img_source):
+        img_path = img_source.img_path(page_index)
         # 実験用：img_pathにsiteiが含まれない場合はスキップ
         # if sitei not in img_path:
         #     continue
         print("img_path", img_path)
-        for panel in panels[page_index]:
-            # print("panel", panel)
 
-            img = cv2.imread(img_path)
-
-            # 吹き出しの検出
-            speech_balloons = extractSpeechBalloon(img)
-
-            # コマ内の吹き出しを取得
-            if manga109:
-                bounded_text = get_bounded_text(panel, balloons[page_index])
-            else:
-                bounded_text = get_bounded_text(panel, speech_balloons)
-            # print("bounded_text", bounded_text)
-
-            # print("speech_balloons", speech_balloons)
-            # draw_img = draw_bbox(img,speech_balloons, "output.jpg")
-            draw_img = draw_bbox(img, [panel], (0, 255, 0))
-            # draw_img = draw_bbox(draw_img, bounded_text, (0, 0, 255))
-            # cv2.imshow("img", draw_img)
-            # cv2.waitKey(0)
-            # cv2.destroyAllWindows()
-
-            ordered_balloons = order_balloons2(panel, bounded_text)
-            drawimg = draw_bbox(img, [panel], "output.jpg")
-            # drawimg = draw_bbox(drawimg, ordered_balloons, "output.jpg")
+        # 吹き出しの検出はページごとに1回だけ行う
+        if manga109:
+            page_balloons = balloons[page_index]
+        else:
+            page_balloons = detect_page_balloons(img_source, page_index, img)
+
+        # ページ内の全コマの吹き出しの順番を決定
+        page_ordered_balloons = order_page_balloons(panels[page_index], page_balloons)
+        # 吹き出しごとの話者の候補
+        page_speakers = find_speaker_candidates(panels[page_index], page_ordered_balloons, characters.get(page_index, []))
+
+        for panel, ordered_balloons, speakers in zip(panels[page_index], page_ordered_balloons, page_speakers):
+            # print("panel", panel)
+            drawimg = draw_bbox(img.copy(), [panel], "output.jpg")
             cv2.imshow("img", drawimg)
             cv2.waitKey(0)
             cv2.destroyAllWindows()
-            for balloon in ordered_balloons:
-                drawimg = draw_bbox(drawimg, [balloon], "output.jpg")
+            for balloon, candidates in zip(ordered_balloons, speakers):
+                # 吹き出しと最も近い話者の候補を描画
+                drawimg = draw_bbox(drawimg, [balloon] + [character for character, _ in candidates[:1]], "output.jpg")
                 cv2.imshow("img", drawimg)
                 cv2.waitKey(0)
                 cv2.destroyAllWindows()
@@ -1,11 +1,15 @@
 import math
 import os
+import time
 import cv2
 from modules import *
 import math
 import numpy as np
-import itertools
 from scipy.spatial import distance_matrix
+from profiler import count, profiled
+from result_cache import cached_order
+from image_prefetch import prefetch_pages
+from image_source import open_image_source
 
 
 def get_distance(x1, y1, x2, y2):
@@ -96,69 +100,189 @@ def order_balloons(panel, bounded_text):
     return ordered_balloons
 
 
+# order_balloons2の結果が変わる変更をしたら上げる(結果のキャッシュのキーに含める)
+ORDER_BALLOONS2_VERSION = 2
+
+
 # こちらを採用
-def order_balloons2(panel, bounded_text):
+@profiled("order_balloons2")
+def order_balloons2(panel, bounded_text, cache=None):
     """
     吹き出しの順番を決定する(全順序)
     :param panel: コマのバウンディングボックス情報
     :param bounded_text: コマ内の吹き出しのバウンディングボックス情報
+    :param cache: 結果を再利用するOrderCache(Noneの場合は使わない)
     :return: 吹き出しの順番のリスト
     :see also: find_nearest_balloon コマ右上の座標と最も近い吹き出しを見つける関数
     :see also: get_distance 2点間の距離を計算する関数
     """
-    panel_xmax, panel_ymin = int(panel["xmax"]), int(panel["ymin"])
+    if cache is None:
+        order = _order_balloons2_indices(panel, bounded_text)
+    else:
+        order = cached_order(
+            cache,
+            "order_balloons2",
+            ORDER_BALLOONS2_VERSION,
+            bboxes_to_array([panel] + list(bounded_text)),
+            lambda: _order_balloons2_indices(panel, bounded_text),
+            **shortest_path_params(),
+        )
+    return [bounded_text[i] for i in order]
+
+
+def _order_balloons2_indices(panel, bounded_text):
+    """
+    吹き出しの順番を決定する(order_balloons2の本体)
+    :param panel: コマのバウンディングボックス情報
+    :param bounded_text: コマ内の吹き出しのバウンディングボックス情報
+    :return: 吹き出しのインデックスの順番のリスト
+    """
+    problem = _balloon_path_problem(panel, bounded_text)
+    if problem is None:
+        return []
+    head_balloons, via_balloons, dist_matrix = problem
+
+    # 最短経路を求める(経由点が少ない場合は全順列の列挙と同じ結果になる，多い場合は展開数の上限で打ち切ることがある)
+    best_path = shortest_hamiltonian_path(dist_matrix)
+
+    # 最短経路上の吹き出しを経由点のインデックスから取得
+    return head_balloons + [via_balloons[i - 1] for i in best_path[1:-1]]
+
+
+def _balloon_path_problem(panel, bounded_text):
+    """
+    吹き出しの順番を求める最短経路問題を作成
+    始点はコマ右上に最も近い吹き出しの中心，終点はコマの左下
+    :param panel: コマのバウンディングボックス情報
+    :param bounded_text: コマ内の吹き出しのバウンディングボックス情報
+    :return: (先頭にまとめる吹き出しのインデックス, 経由点の吹き出しのインデックス, 距離行列)，吹き出しがない場合はNone
+    """
     start = find_nearest_balloon(panel, bounded_text)
     if start is None:
-        return []
+        return None
 
     start_point = [(int(start["xmin"]) + int(start["xmax"])) / 2, (int(start["ymin"]) + int(start["ymax"])) / 2]
     end_point = [int(panel["xmin"]), int(panel["ymax"])]
 
     # 吹き出しの中心座標を取得
+    # スタート地点と中心が同じ吹き出しは先頭にまとめ，それ以外を経由点とする
+    head_balloons = []
+    via_balloons = []
     points = []
-    for balloon in bounded_text:
+    for i, balloon in enumerate(bounded_text):
         center = [(int(balloon["xmin"]) + int(balloon["xmax"])) / 2, (int(balloon["ymin"]) + int(balloon["ymax"])) / 2]
-        points.append(center)
-        # スタート地点は除外
         if center == start_point:
-            points.remove(center)
+            head_balloons.append(i)
+        else:
+            via_balloons.append(i)
+            points.append(center)
     # 始点をstart_point,終点ををend_pointとして，pointsを全て通る最短経路を求める
     points = [start_point] + points + [end_point]
-    # print(f'points: {points}')
     # 各点間の距離を計算
-    dist_matrix = distance_matrix(points, points)
-
-    # 巡回経路となるインデックスを全列挙
-    N = len(points)
-    indices = np.arange(N)
-    paths = [p for p in itertools.permutations(indices[1:-1])]
-
-    # 各巡回経路の総距離を計算し、最短経路を求める
-    best_dist = np.inf
-    best_path = None
-    for path in paths:
-        path = [0] + list(path) + [N - 1]
-        dist = np.sum([dist_matrix[path[i], path[i + 1]] for i in range(len(path) - 1)])
-        if dist < best_dist:
-            best_dist = dist
-            best_path = path
-
-    # 最短経路上の吹き出しをbounded_textから取得
-    ordered_balloons = []
-    for i in best_path[0:-1]:
-        point = points[i]
-        for balloon in bounded_text:
-            balloon_center = [
-                (int(balloon["xmin"]) + int(balloon["xmax"])) / 2,
-                (int(balloon["ymin"]) + int(balloon["ymax"])) / 2,
-            ]
-            # print(f'point: {point}, balloon_center: {balloon_center}')
-            if balloon_center == point:
-                ordered_balloons.append(balloon)
-            else:
-                print("not found")
+    return head_balloons, via_balloons, distance_matrix(points, points)
 
-    return ordered_balloons
+
+# order_balloons_beamで1コマに使う時間の既定値[秒]
+BEAM_PANEL_BUDGET = 0.01
+# order_page_balloons_beamで1ページに使う時間の既定値[秒]
+BEAM_PAGE_BUDGET = 0.05
+
+
+@profiled("order_balloons_beam")
+def order_balloons_beam(panel, bounded_text, time_budget=BEAM_PANEL_BUDGET, max_expansions=None):
+    """
+    吹き出しの順番を予算内のビームサーチで決定する
+    order_balloons2と同じ始点・終点で，予算が尽きた時点で見つかっている最良の順番を返す
+    :param panel: コマのバウンディングボックス情報
+    :param bounded_text: コマ内の吹き出しのバウンディングボックス情報
+    :param time_budget: 探索時間の上限[秒](Noneの場合は制限しない)
+    :param max_expansions: 展開する部分経路数の上限(Noneの場合は制限しない)
+                           経由点がHELD_KARP_LIMIT個より多いコマではtime_budgetかmax_expansionsの指定が必要
+    :return: (吹き出しの順番のリスト, order_balloons2と同じ最短の順番であることが保証されているか)
+    :see also: beam_search_path 予算内で最短経路を探索する関数
+    """
+    problem = _balloon_path_problem(panel, bounded_text)
+    if problem is None:
+        return [], True
+    head_balloons, via_balloons, dist_matrix = problem
+    best_path, optimal = beam_search_path(dist_matrix, time_budget, max_expansions)
+    order = head_balloons + [via_balloons[i - 1] for i in best_path[1:-1]]
+    return [bounded_text[i] for i in order], optimal
+
+
+def order_page_balloons_beam(panels, text_info, page_budget=BEAM_PAGE_BUDGET, iou_threshold=0.5):
+    """
+    ページ内の全コマについて吹き出しの順番を1ページあたりの時間の上限内で決定する
+    各コマには残り時間を残りのコマ数で等分した時間を割り当てる
+    :param panels: ページ内のコマのバウンディングボックス情報
+    :param text_info: ページ内の吹き出しのバウンディングボックス情報
+    :param page_budget: 1ページに使う時間の上限[秒]
+    :param iou_threshold: コマに内包されているかを判定するIoUの閾値
+    :return: (コマごとの吹き出しの順番のリスト, 全コマで最短の順番であることが保証されているか)
+    :see also: order_balloons_beam 吹き出しの順番を予算内のビームサーチで決定する関数
+    """
+    count("panels", len(panels))
+    count("balloons", len(text_info))
+    deadline = time.perf_counter() + page_budget
+    bounded_texts = get_bounded_objs_page(panels, text_info, iou_threshold)
+    # 吹き出しが2つ以下のコマは探索しないので時間を割り当てない
+    remaining = sum(len(bounded_text) > 2 for bounded_text in bounded_texts)
+    orders = []
+    all_optimal = True
+    for panel, bounded_text in zip(panels, bounded_texts):
+        time_budget = None
+        if len(bounded_text) > 2:
+            time_budget = max(deadline - time.perf_counter(), 0.0) / remaining
+            remaining -= 1
+        ordered_balloons, optimal = order_balloons_beam(panel, bounded_text, time_budget)
+        orders.append(ordered_balloons)
+        all_optimal &= optimal
+    return orders, all_optimal
+
+
+def order_page_balloons(panels, text_info, iou_threshold=0.5, cache=None):
+    """
+    ページ内の全コマについて吹き出しの順番を決定する
+    吹き出しのコマへの割り当てはページ単位で1回だけ行う
+    :param panels: ページ内のコマのバウンディングボックス情報
+    :param text_info: ページ内の吹き出しのバウンディングボックス情報
+    :param iou_threshold: コマに内包されているかを判定するIoUの閾値
+    :param cache: ページ単位の結果を再利用するOrderCache(Noneの場合は使わない)
+    :return: コマごとの吹き出しの順番のリスト
+    :see also: order_balloons2 吹き出しの順番を決定する関数(全順序)
+    """
+    count("panels", len(panels))
+    count("balloons", len(text_info))
+    if cache is None:
+        return _order_page_balloons(panels, text_info, iou_threshold)
+
+    # 結果はtext_infoのインデックスで保存する
+    position = {id(text): i for i, text in enumerate(text_info)}
+    orders = cached_order(
+        cache,
+        "order_page_balloons",
+        ORDER_BALLOONS2_VERSION,
+        [bboxes_to_array(panels), bboxes_to_array(text_info)],
+        lambda: [
+            [position[id(balloon)] for balloon in ordered_balloons]
+            for ordered_balloons in _order_page_balloons(panels, text_info, iou_threshold)
+        ],
+        iou_threshold=iou_threshold,
+        **shortest_path_params(),
+    )
+    return [[text_info[i] for i in order] for order in orders]
+
+
+def _order_page_balloons(panels, text_info, iou_threshold):
+    """
+    ページ内の全コマについて吹き出しの順番を決定する(order_page_balloonsの本体)
+    :param panels: ページ内のコマのバウンディングボックス情報
+    :param text_info: ページ内の吹き出しのバウンディングボックス情報
+    :param iou_threshold: コマに内包されているかを判定するIoUの閾値
+    :return: コマごとの吹き出しの順番のリスト
+    """
+    bounded_texts = get_bounded_objs_page(panels, text_info, iou_threshold)
+    return [order_balloons2(panel, bounded_text) for panel, bounded_text in zip(panels, bounded_texts)]
 
 
 if __name__ == "__main__":
@@ -184,47 +308,32 @@ if __name__ == "__main__":
     manga109 = True
     # manga109 = False
     ano_file_path = manga109_ano_dir + manga_title + ".xml"
-    img_folder_path = manga109_img_dir + manga_title + "/"
-
-    # 画像ファイル名を取得
-    imgs = os.listdir(img_folder_path)
-    imgs.sort()
+    # 画像の読み込み元(展開済みのフォルダ，なければCBZ/ZIPの書庫)
+    img_source = open_image_source(manga109_img_dir, manga_title)
 
     panels = get_panelbbox_info_from_xml(ano_file_path)
     balloons = get_textbbox_info_from_xml(ano_file_path)
 
-    for page_index in balloons.keys():
-        img_path = index_to_img_path(page_index, img_folder_path)
+    # 画像は次のページの処理中に別スレッドで先読みする
+    for page_index, img in prefetch_pages(balloons.keys(), img_source):
+        img_path = img_source.img_path(page_index)
         # 実験用：img_pathにsiteiが含まれない場合はスキップ
         # if sitei not in img_path:
         #     continue
         print("img_path", img_path)
-        for panel in panels[page_index]:
-            # print("panel", panel)
 
-            img = cv2.imread(img_path)
-
-            # 吹き出しの検出
-            speech_balloons = extractSpeechBalloon(img)
-
-            # コマ内の吹き出しを取得
-            if manga109:
-                bounded_text = get_bounded_text(panel, balloons[page_index])
-            else:
-                bounded_text = get_bounded_text(panel, speech_balloons)
-            # print("bounded_text", bounded_text)
-
-            # print("speech_balloons", speech_balloons)
-            # draw_img = draw_bbox(img,speech_balloons, "output.jpg")
-            draw_img = draw_bbox(img, [panel], (0, 255, 0))
-            # draw_img = draw_bbox(draw_img, bounded_text, (0, 0, 255))
-            # cv2.imshow("img", draw_img)
-            # cv2.waitKey(0)
-            # cv2.destroyAllWindows()
-
-            ordered_balloons = order_balloons2(panel, bounded_text)
-            drawimg = draw_bbox(img, [panel], "output.jpg")
-            # drawimg = draw_bbox(drawimg, ordered_balloons, "output.jpg")
+        # 吹き出しの検出はページごとに1回だけ行う
+        if manga109:
+            page_balloons = balloons[page_index]
+        else:
+            page_balloons = detect_page_balloons(img_source, page_index, img)
+
+        # ページ内の全コマの吹き出しの順番を決定
+        page_ordered_balloons = order_page_balloons(panels[page_index], page_balloons)
+
+        for panel, ordered_balloons in zip(panels[page_index], page_ordered_balloons):
+            # print("panel", panel)
+            drawimg = draw_bbox(img.copy(), [panel], "output.jpg")
             cv2.imshow("img", drawimg)
             cv2.waitKey(0)
             cv2.destroyAllWindows()
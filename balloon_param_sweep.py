@@ -0,0 +1,263 @@
+import argparse
+import itertools
+import json
+import sys
+import time
+
+import cv2
+import numpy as np
+from modules import (
+    BALLOON_BINARY_THRESHOLD,
+    BALLOON_KERNEL_SIZE,
+    BALLOON_MAX_AREA_RATIO,
+    BALLOON_MIN_AREA_RATIO,
+    BALLOON_MIN_CIRCULARITY,
+    binarize_for_balloons,
+    bboxes_to_array,
+    box_iou_matrix,
+    contour_feature_table,
+)
+from manga109_pages import MANGA109_ANO_DIR, MANGA109_IMG_DIR, iter_pages
+
+# 探索するパラメータと既定値(extractSpeechBalloonと同じ設定)
+SWEEP_DEFAULTS = {
+    "threshold": [BALLOON_BINARY_THRESHOLD],
+    "kernel_size": [BALLOON_KERNEL_SIZE],
+    "min_area_ratio": [BALLOON_MIN_AREA_RATIO],
+    "max_area_ratio": [BALLOON_MAX_AREA_RATIO],
+    "min_circularity": [BALLOON_MIN_CIRCULARITY],
+    "white_ratio_range": [None],
+}
+# 二値化・収縮膨張の結果(輪郭と特徴量の表)を共有するパラメータ
+VARIANT_PARAMS = ("threshold", "kernel_size")
+
+
+def parameter_grid(**values):
+    """
+    パラメータの全ての組み合わせを作成(指定しないパラメータは既定値)
+    :param values: パラメータ名 -> 値のリスト(SWEEP_DEFAULTSのキー)
+    :return: 設定(パラメータ名 -> 値の辞書)のリスト
+    """
+    unknown = set(values) - set(SWEEP_DEFAULTS)
+    if unknown:
+        raise ValueError(f"unknown parameters: {', '.join(sorted(unknown))}")
+    grid = {**SWEEP_DEFAULTS, **{name: list(value) for name, value in values.items()}}
+    return [dict(zip(grid, combination)) for combination in itertools.product(*grid.values())]
+
+
+def filter_masks(features, page_area, settings):
+    """
+    特徴量の表に全ての設定の吹き出しの条件をまとめて適用(filter_balloon_featuresを設定の数だけ行うのと同じ)
+    :param features: contour_feature_tableの戻り値
+    :param page_area: ページの面積
+    :param settings: 設定のリスト
+    :return: (設定数, 輪郭数)の吹き出しとみなすかのbool配列
+    """
+    min_area = np.array([setting["min_area_ratio"] for setting in settings]) * page_area
+    max_area = np.array([setting["max_area_ratio"] for setting in settings]) * page_area
+    min_circularity = np.array([setting["min_circularity"] for setting in settings], dtype=np.float64)
+    area = features["area"][None, :]
+    keep = (min_area[:, None] <= area) & (area < max_area[:, None])
+    keep &= features["circularity"][None, :] > min_circularity[:, None]
+
+    has_range = np.array([setting["white_ratio_range"] is not None for setting in settings])
+    if has_range.any():
+        ranges = np.array([setting["white_ratio_range"] or (np.nan, np.nan) for setting in settings], dtype=np.float64)
+        white_ratio = features["white_ratio"][None, :]
+        with np.errstate(invalid="ignore"):
+            in_range = (white_ratio > ranges[:, :1]) & (white_ratio < ranges[:, 1:])
+        keep &= ~has_range[:, None] | in_range
+    return keep
+
+
+def match_counts(iou, keep, iou_threshold=0.5):
+    """
+    全ての設定について検出結果と基準をcompare_detectionsと同じ規則(IoUが大きい組から1対1)で対応付ける
+    :param iou: (基準数, 候補数)のIoU行列
+    :param keep: (設定数, 候補数)の各設定で検出とみなす候補のbool配列
+    :param iou_threshold: 対応付けるIoUの閾値
+    :return: (設定ごとの対応付いた組数, 設定ごとの対応付いた組のIoUの合計)
+    """
+    pairs = np.argwhere(iou >= iou_threshold)
+    pairs = pairs[np.argsort(-iou[pairs[:, 0], pairs[:, 1]], kind="stable")]
+    pair_iou = iou[pairs[:, 0], pairs[:, 1]].tolist()
+    pairs = pairs.tolist()
+    pair_kept = keep[:, [j for _, j in pairs]]
+
+    matched = np.zeros(len(keep), dtype=np.int64)
+    iou_sum = np.zeros(len(keep))
+    # 対応付けに関わる候補が同じ設定は結果も同じ
+    memo = {}
+    for s, kept in enumerate(pair_kept):
+        key = kept.tobytes()
+        if key not in memo:
+            used_reference, used_detected, total = set(), set(), 0.0
+            for p in np.flatnonzero(kept).tolist():
+                i, j = pairs[p]
+                if i not in used_reference and j not in used_detected:
+                    used_reference.add(i)
+                    used_detected.add(j)
+                    total += pair_iou[p]
+            memo[key] = (len(used_reference), total)
+        matched[s], iou_sum[s] = memo[key]
+    return matched, iou_sum
+
+
+def sweep_page(img, reference, settings, iou_threshold=0.5):
+    """
+    1ページについて全ての設定の吹き出し検出を評価
+    二値化・収縮膨張と輪郭の特徴量の表は(threshold, kernel_size)ごとに1回だけ計算し，
+    面積・円形度・白黒比の条件は表に対するベクトル演算でまとめて判定する
+    :param img: ページ画像(カラーまたはグレースケール)
+    :param reference: 基準(Manga109のtextなど)のバウンディングボックス情報のリスト
+    :param settings: 設定のリスト(parameter_gridを参照)
+    :param iou_threshold: 検出と基準を対応付けるIoUの閾値
+    :return: matched, detected, iou_sum(設定ごとの配列)の辞書
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    page_area = gray.shape[0] * gray.shape[1]
+    reference_boxes = bboxes_to_array(reference)
+    result = {
+        "matched": np.zeros(len(settings), dtype=np.int64),
+        "detected": np.zeros(len(settings), dtype=np.int64),
+        "iou_sum": np.zeros(len(settings)),
+    }
+
+    variants = {}
+    for s, setting in enumerate(settings):
+        variants.setdefault(tuple(setting[name] for name in VARIANT_PARAMS), []).append(s)
+    for (threshold, kernel_size), indices in variants.items():
+        variant_settings = [settings[s] for s in indices]
+        _, binary = binarize_for_balloons(gray, threshold, kernel_size)
+        contours, _ = cv2.findContours(binary, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+        # 白黒比は白黒比の条件をもつ設定の面積の範囲にある輪郭についてだけ計算
+        ranged = [setting for setting in variant_settings if setting["white_ratio_range"] is not None]
+        ratio_area_range = (0.0, 0.0)
+        if ranged:
+            ratio_area_range = (
+                min(setting["min_area_ratio"] for setting in ranged) * page_area,
+                max(setting["max_area_ratio"] for setting in ranged) * page_area,
+            )
+        features = contour_feature_table(contours, gray, ratio_area_range)
+        keep = filter_masks(features, page_area, variant_settings)
+
+        # いずれかの設定で吹き出しとみなす輪郭だけを対応付けの候補にする
+        candidates = np.flatnonzero(keep.any(axis=0))
+        keep = keep[:, candidates]
+        x, y, w, h = (features[key][candidates] for key in ("x", "y", "w", "h"))
+        iou = box_iou_matrix(reference_boxes, np.stack([x, y, x + w, y + h], axis=1))
+        matched, iou_sum = match_counts(iou, keep, iou_threshold)
+        result["matched"][indices] = matched
+        result["detected"][indices] = keep.sum(axis=1)
+        result["iou_sum"][indices] = iou_sum
+    return result
+
+
+def sweep_balloon_params(pages, settings, iou_threshold=0.5):
+    """
+    複数ページについて全ての設定の吹き出し検出のrecall/precisionを集計
+    :param pages: (ページ画像, 基準のバウンディングボックス情報のリスト)のイテラブル
+    :param settings: 設定のリスト(parameter_gridを参照)
+    :param iou_threshold: 検出と基準を対応付けるIoUの閾値
+    :return: 設定ごとの結果(設定, recall, precision, f1, mean_iou, matched, detected, reference)のリスト
+    """
+    matched = np.zeros(len(settings), dtype=np.int64)
+    detected = np.zeros(len(settings), dtype=np.int64)
+    iou_sum = np.zeros(len(settings))
+    n_reference = 0
+    for img, reference in pages:
+        if img is None:
+            continue
+        page_result = sweep_page(img, reference, settings, iou_threshold)
+        matched += page_result["matched"]
+        detected += page_result["detected"]
+        iou_sum += page_result["iou_sum"]
+        n_reference += len(reference)
+
+    results = []
+    for s, setting in enumerate(settings):
+        recall = matched[s] / n_reference if n_reference else 1.0
+        precision = matched[s] / detected[s] if detected[s] else 1.0
+        results.append(
+            {
+                **setting,
+                "recall": float(recall),
+                "precision": float(precision),
+                "f1": float(2 * recall * precision / (recall + precision)) if recall + precision > 0 else 0.0,
+                "mean_iou": float(iou_sum[s] / matched[s]) if matched[s] else 0.0,
+                "matched": int(matched[s]),
+                "detected": int(detected[s]),
+                "reference": n_reference,
+            }
+        )
+    return results
+
+
+def iter_title_pages(manga_title, max_pages=None, manga109_ano_dir=MANGA109_ANO_DIR, manga109_img_dir=MANGA109_IMG_DIR):
+    """
+    漫画タイトルの(グレースケールのページ画像, textのバウンディングボックス情報)を1ページずつ返すジェネレータ
+    :param manga_title: 漫画のタイトル
+    :param max_pages: 返すページ数の上限(Noneの場合は全ページ)
+    :param manga109_ano_dir: アノテーションファイルのディレクトリ
+    :param manga109_img_dir: 画像ファイルのディレクトリ
+    :return: (画像, 吹き出しのバウンディングボックス情報のリスト)のジェネレータ
+    """
+    pages = iter_pages(manga_title, None, manga109_ano_dir, manga109_img_dir, cv2.IMREAD_GRAYSCALE)
+    for page in itertools.islice(pages, max_pages):
+        with page:
+            yield page.image, page.texts
+
+
+def format_results(results, top=None):
+    """
+    設定ごとの結果をf1の高い順に表にする
+    :param results: sweep_balloon_paramsの戻り値
+    :param top: 表示する設定数の上限(Noneの場合は全て)
+    :return: 表の行のリスト
+    """
+    names = list(SWEEP_DEFAULTS)
+    header = " ".join(f"{name:>17}" for name in names)
+    lines = [f"{header} {'recall':>8} {'precision':>10} {'f1':>7} {'mean_iou':>9} {'detected':>9}"]
+    for result in sorted(results, key=lambda result: -result["f1"])[:top]:
+        values = " ".join(f"{str(result[name]):>17}" for name in names)
+        lines.append(
+            f"{values} {result['recall']:>8.3f} {result['precision']:>10.3f} {result['f1']:>7.3f} "
+            f"{result['mean_iou']:>9.3f} {result['detected']:>9}"
+        )
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="extractSpeechBalloonのパラメータをManga109のtextに対して探索する")
+    parser.add_argument("--annotations", default=MANGA109_ANO_DIR, help="アノテーションファイルのディレクトリ")
+    parser.add_argument("--images", default=MANGA109_IMG_DIR, help="画像ファイルのディレクトリ")
+    parser.add_argument("--titles", nargs="+", required=True, help="漫画のタイトル")
+    parser.add_argument("--max-pages", type=int, default=None, help="タイトルごとに評価するページ数の上限")
+    parser.add_argument("--thresholds", type=int, nargs="+", default=[210, 220, 230, 240], help="二値化の閾値")
+    parser.add_argument("--kernel-sizes", type=int, nargs="+", default=[3], help="収縮・膨張のカーネルサイズ")
+    parser.add_argument("--min-area-ratios", type=float, nargs="+", default=[0.0005, 0.001, 0.002], help="最小面積比")
+    parser.add_argument("--max-area-ratios", type=float, nargs="+", default=[0.03, 0.05, 0.08], help="最大面積比")
+    parser.add_argument("--min-circularities", type=float, nargs="+", default=[0.0, 0.2, 0.4], help="円形度の下限")
+    parser.add_argument("--iou-threshold", type=float, default=0.5, help="検出とアノテーションを対応付けるIoUの閾値")
+    parser.add_argument("--top", type=int, default=20, help="表示する設定数")
+    parser.add_argument("--output", default=None, help="全ての設定の結果を書き出すJSONファイル")
+    args = parser.parse_args()
+
+    settings = parameter_grid(
+        threshold=args.thresholds,
+        kernel_size=args.kernel_sizes,
+        min_area_ratio=args.min_area_ratios,
+        max_area_ratio=args.max_area_ratios,
+        min_circularity=args.min_circularities,
+    )
+    start_time = time.perf_counter()
+    pages = itertools.chain.from_iterable(
+        iter_title_pages(manga_title, args.max_pages, args.annotations, args.images) for manga_title in args.titles
+    )
+    results = sweep_balloon_params(pages, settings, args.iou_threshold)
+    elapsed = time.perf_counter() - start_time
+    print("\n".join(format_results(results, args.top)))
+    print(f"{len(settings)} settings, {results[0]['reference'] if results else 0} text boxes, {elapsed:.1f} s", file=sys.stderr)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
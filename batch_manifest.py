@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from annotation_loader import load_page_offsets
+
+# マニフェストの形式のバージョン
+MANIFEST_VERSION = 1
+
+
+def manifest_path(output_path):
+    """
+    出力ファイルに対応するマニフェストのパスを取得(出力ファイルと同じディレクトリ)
+    :param output_path: 出力するJSONLファイルのパス
+    :return: マニフェスト(.manifest.json)のパス
+    """
+    return output_path + ".manifest.json"
+
+
+def load_manifest(path, algorithm):
+    """
+    マニフェストを読み込む
+    :param path: マニフェストのパス
+    :param algorithm: 今回のアルゴリズムのバージョンとパラメータ
+    :return: タイトルごとの入力の記録，ないか形式・アルゴリズムが異なる場合は空の辞書
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("algorithm") != algorithm:
+        return {}
+    return manifest["titles"]
+
+
+def _write_atomic(path, lines):
+    """
+    一時ファイルに書いてからos.replaceで置き換える
+    :param path: 書き込むファイルのパス
+    :param lines: 書き込む行のイテラブル
+    """
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for line in lines:
+                f.write(line)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+
+
+def save_manifest(path, algorithm, titles):
+    """
+    マニフェストを書き込む
+    :param path: マニフェストのパス
+    :param algorithm: アルゴリズムのバージョンとパラメータ
+    :param titles: タイトルごとの入力の記録
+    """
+    manifest = {"version": MANIFEST_VERSION, "algorithm": algorithm, "titles": titles}
+    _write_atomic(path, [json.dumps(manifest, ensure_ascii=False)])
+
+
+def _file_stat(path):
+    """
+    ファイルのサイズと更新時刻を取得
+    :param path: ファイルのパス
+    :return: [サイズ, 更新時刻]，ファイルがない場合はNone
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def page_annotation_digests(ano_file_path):
+    """
+    各ページの<page>要素のバイト列のSHA-1を計算(ページ位置の索引を用いる)
+    :param ano_file_path: アノテーションファイルのパス
+    :return: ページインデックス(文字列) -> ハッシュ値の辞書
+    """
+    offsets = load_page_offsets(ano_file_path)
+    digests = {}
+    with open(ano_file_path, "rb") as f:
+        for index, start, end in zip(offsets["page_index"].tolist(), offsets["start"].tolist(), offsets["end"].tolist()):
+            f.seek(start)
+            digests[str(index)] = hashlib.sha1(f.read(end - start)).hexdigest()
+    return digests
+
+
+def image_fingerprint(img_path, previous=None):
+    """
+    画像ファイルの[サイズ, 更新時刻, SHA-1]を取得(比較には3番目の要素だけを用いる)
+    サイズと更新時刻が前回と同じ場合はハッシュを計算し直さない
+    :param img_path: 画像ファイルのパス
+    :param previous: 前回の記録
+    :return: [サイズ, 更新時刻, SHA-1]，ファイルがない場合はNone
+    """
+    stat = _file_stat(img_path)
+    if stat is None:
+        return None
+    if previous is not None and previous[:2] == stat:
+        return previous
+    with open(img_path, "rb") as f:
+        return stat + [hashlib.sha1(f.read()).hexdigest()]
+
+
+def title_fingerprint(ano_file_path, img_fingerprint, previous=None):
+    """
+    1タイトル分の入力(各ページのアノテーションと画像)の記録を作成
+    アノテーションファイルのサイズと更新時刻が前回と同じ場合はページごとのハッシュを計算し直さない
+    :param ano_file_path: アノテーションファイルのパス
+    :param img_fingerprint: (ページインデックス, 前回の記録) -> 画像の記録の関数(画像を使わない場合はNone)
+                            image_source.DirectoryImageSource.fingerprintなど
+    :param previous: 前回の記録
+    :return: annotation([サイズ, 更新時刻]), pages(ページインデックス(文字列) -> annotation, image)の辞書
+    """
+    stat = _file_stat(ano_file_path)
+    if previous is not None and previous["annotation"] == stat:
+        annotation_digests = {page: record["annotation"] for page, record in previous["pages"].items()}
+    else:
+        annotation_digests = page_annotation_digests(ano_file_path)
+
+    previous_pages = previous["pages"] if previous is not None else {}
+    pages = {}
+    for page, digest in annotation_digests.items():
+        image = None
+        if img_fingerprint is not None:
+            image = img_fingerprint(int(page), previous_pages.get(page, {}).get("image"))
+        pages[page] = {"annotation": digest, "image": image}
+    return {"annotation": stat, "pages": pages}
+
+
+def _content_key(record):
+    """
+    ページの入力の内容だけを比較するためのキー(更新時刻は含めない)
+    """
+    if record is None:
+        return None
+    return record["annotation"], record["image"][2] if record["image"] else None
+
+
+def pages_to_update(entry, previous=None, done_pages=()):
+    """
+    入力が変わったか，結果が出力にないページを求める
+    :param entry: 今回の記録(title_fingerprintを参照)
+    :param previous: 前回の記録
+    :param done_pages: 出力に正常な結果があるページインデックスの集合
+    :return: 再計算するページインデックスの集合
+    """
+    previous_pages = previous["pages"] if previous is not None else {}
+    return {
+        int(page)
+        for page, record in entry["pages"].items()
+        if int(page) not in done_pages or _content_key(record) != _content_key(previous_pages.get(page))
+    }
+
+
+def read_results(output_path):
+    """
+    出力済みのJSONLを読み込む
+    :param output_path: 出力したJSONLファイルのパス
+    :return: (タイトル, ページインデックス) -> (結果, 行)の辞書
+    """
+    results = {}
+    try:
+        with open(output_path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                results[(result["title"], result["page"])] = (result, line if line.endswith("\n") else line + "\n")
+    except OSError:
+        pass
+    return results
+
+
+def merge_results(output_path, existing, updated, title_pages):
+    """
+    出力済みの結果に再計算した結果を統合し，タイトル・ページ順に書き直す
+    :param output_path: 出力するJSONLファイルのパス
+    :param existing: 出力済みの結果(read_resultsを参照)
+    :param updated: 再計算した結果の行の辞書((タイトル, ページインデックス) -> 行)
+    :param title_pages: 今回処理したタイトル -> アノテーションにあるページインデックスの集合(それ以外のページは削除する)
+    """
+    lines = {key: line for key, (_, line) in existing.items()}
+    lines.update(updated)
+    keys = [key for key in lines if key[0] not in title_pages or key[1] in title_pages[key[0]]]
+    _write_atomic(output_path, (lines[key] for key in sorted(keys)))
@@ -0,0 +1,393 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from modules import *
+from panel_order_estimater import ORDER_PANELS_VERSION, calculate_pseudo_regions, order_panels
+from balloon_order import ORDER_BALLOONS2_VERSION, order_page_balloons
+from batch_manifest import (
+    load_manifest,
+    manifest_path,
+    merge_results,
+    pages_to_update,
+    read_results,
+    save_manifest,
+    title_fingerprint,
+)
+from image_source import open_image_source
+from profiler import disable_profiling, enable_profiling, stage
+from result_cache import OrderCache
+
+# ワーカープロセスごとに開いた結果のキャッシュ(パス -> OrderCache)
+_worker_caches = {}
+
+
+def list_titles(manga109_ano_dir, titles):
+    """
+    処理する漫画タイトルのリストを取得
+    :param manga109_ano_dir: アノテーションファイルのディレクトリ
+    :param titles: タイトルのリスト("all"の場合は全タイトル)
+    :return: タイトルのリスト
+    """
+    if titles == ["all"]:
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(manga109_ano_dir) if f.endswith(".xml"))
+    return titles
+
+
+def _bbox_record(obj):
+    """
+    バウンディングボックス情報を出力用の辞書に変換
+    :param obj: バウンディングボックス情報
+    :return: idと座標の辞書
+    """
+    return {"id": obj.get("id"), "bbox": [int(obj["xmin"]), int(obj["ymin"]), int(obj["xmax"]), int(obj["ymax"])]}
+
+
+def algorithm_signature(detect, iou_threshold):
+    """
+    出力に影響するアルゴリズムのバージョンとパラメータ(変わった場合は全ページを再計算する)
+    :param detect: Trueの場合，吹き出しを画像処理で検出する
+    :param iou_threshold: コマに内包されているかを判定するIoUの閾値
+    :return: バージョンとパラメータの辞書
+    """
+    signature = {
+        "order_panels": ORDER_PANELS_VERSION,
+        "order_balloons2": ORDER_BALLOONS2_VERSION,
+        "shortest_path": shortest_path_params(),
+        "iou_threshold": iou_threshold,
+        "detect": detect,
+    }
+    if detect:
+        signature["extract_balloon"] = [
+            EXTRACT_BALLOON_VERSION,
+            BALLOON_BINARY_THRESHOLD,
+            BALLOON_KERNEL_SIZE,
+            BALLOON_MIN_AREA_RATIO,
+            BALLOON_MAX_AREA_RATIO,
+            BALLOON_MIN_CIRCULARITY,
+        ]
+    return signature
+
+
+def _worker_cache(cache_path):
+    """
+    ワーカープロセス内で結果のキャッシュを開く(プロセスごとに1回だけ開く)
+    :param cache_path: キャッシュファイルのパス
+    :return: OrderCache
+    """
+    if cache_path not in _worker_caches:
+        _worker_caches[cache_path] = OrderCache(cache_path)
+    return _worker_caches[cache_path]
+
+
+def process_page(task):
+    """
+    1ページ分のコマと吹き出しの順序を推定(ワーカープロセスで実行)
+    task["profile"]がNoneでなければ処理段階ごとの計測結果を"profile"に入れて返す
+    :param task: ページの情報(title, page_index, page_width, page_height, panels, texts, img_source, img_path, iou_threshold, profile, cache)
+    :return: ページの推定結果
+    """
+    if task.get("profile") is None:
+        return _process_page(task)
+
+    profiler = enable_profiling(trace_memory=task["profile"] == "memory")
+    try:
+        with profiler.page(title=task["title"], page=task["page_index"]):
+            result = _process_page(task)
+    finally:
+        disable_profiling()
+    result["profile"] = profiler.export()
+    return result
+
+
+def _process_page(task):
+    """
+    1ページ分のコマと吹き出しの順序を推定
+    :param task: ページの情報
+    :return: ページの推定結果
+    """
+    texts = task["texts"]
+    page_width, page_height = task["page_width"], task["page_height"]
+
+    try:
+        # 画像処理で吹き出しを検出する場合
+        if task["img_path"] is not None:
+            with stage("imread"):
+                img = task["img_source"].read(task["page_index"])
+            if img is None:
+                return read_error(task)
+            page_height, page_width = img.shape[:2]
+            texts = extractSpeechBalloon(img)
+        return order_page(task, texts, page_width, page_height)
+    except Exception as e:
+        # 1ページの失敗でバッチ全体を止めない
+        return page_error(task, e)
+
+
+def read_error(task):
+    """
+    画像を読み込めなかったページの結果を作成
+    :param task: ページの情報
+    :return: ページの推定結果(error)
+    """
+    return {"title": task["title"], "page": task["page_index"], "error": f"cannot read {task['img_path']}"}
+
+
+def page_error(task, error):
+    """
+    処理中に例外が発生したページの結果を作成
+    :param task: ページの情報
+    :param error: 発生した例外
+    :return: ページの推定結果(error)
+    """
+    return {"title": task["title"], "page": task["page_index"], "error": f"{type(error).__name__}: {error}"}
+
+
+def order_page(task, texts, page_width, page_height):
+    """
+    吹き出しが決まったページのコマと吹き出しの順序を推定
+    :param task: ページの情報
+    :param texts: 吹き出しのバウンディングボックス情報(アノテーションまたは検出結果)
+    :param page_width: ページの幅
+    :param page_height: ページの高さ
+    :return: ページの推定結果
+    """
+    cache = _worker_cache(task["cache"]) if task.get("cache") else None
+    if cache is not None:
+        hits, misses = cache.hits, cache.misses
+    panels = task["panels"]
+
+    # コマの順序
+    if panels:
+        pseudo_regions = calculate_pseudo_regions(panels)
+        panel_order = order_panels(pseudo_regions, page_width, page_height, cache)
+    else:
+        panel_order = []
+
+    # コマごとの吹き出しの順序
+    page_ordered_balloons = order_page_balloons(panels, texts, task["iou_threshold"], cache)
+    panel_records = []
+    for i in panel_order:
+        balloon_records = [_bbox_record(b) for b in page_ordered_balloons[i]]
+        panel_records.append({**_bbox_record(panels[i]), "balloons": balloon_records})
+
+    result = {
+        "title": task["title"],
+        "page": task["page_index"],
+        "panel_order": [panels[i]["id"] for i in panel_order],
+        "panels": panel_records,
+    }
+    if cache is not None:
+        # プールの終了時に書き込みが失われないようにページごとにコミットする
+        cache.flush()
+        result["cache_stats"] = [cache.hits - hits, cache.misses - misses]
+    return result
+
+
+def iter_title_tasks(manga109_ano_dir, manga109_img_dir, manga_title, detect, iou_threshold, profile=None, cache_path=None):
+    """
+    1タイトル分のページのタスクを生成
+    :param manga109_ano_dir: アノテーションファイルのディレクトリ
+    :param manga109_img_dir: 画像ファイルのディレクトリ
+    :param manga_title: 漫画のタイトル
+    :param detect: Trueの場合，吹き出しを画像処理で検出する
+    :param iou_threshold: コマに内包されているかを判定するIoUの閾値
+    :param profile: 計測の種類(None: 計測しない, "time": 実行時間, "memory": 実行時間とピークメモリ)
+    :param cache_path: 順序推定の結果のキャッシュファイルのパス(Noneの場合は使わない)
+    :return: ページごとのタスクのジェネレータ
+    """
+    ano_file_path = os.path.join(manga109_ano_dir, manga_title + ".xml")
+    img_source = open_image_source(manga109_img_dir, manga_title) if detect else None
+    with stage("load_annotations"):
+        table = load_annotation_table(ano_file_path)
+    panels = table_to_page_objects(table, ["frame"])
+    texts = table_to_page_objects(table, ["text"])
+    for p, page_index in enumerate(table["page_index"].tolist()):
+        yield {
+            "title": manga_title,
+            "page_index": page_index,
+            "page_width": int(table["page_width"][p]),
+            "page_height": int(table["page_height"][p]),
+            "panels": panels[page_index],
+            "texts": [] if detect else texts[page_index],
+            "img_source": img_source,
+            "img_path": img_source.img_path(page_index) if detect else None,
+            "iou_threshold": iou_threshold,
+            "profile": profile,
+            "cache": cache_path,
+        }
+
+
+def run_batch(
+    manga109_ano_dir,
+    manga109_img_dir,
+    titles,
+    output_path,
+    workers=None,
+    detect=False,
+    iou_threshold=0.5,
+    profile_path=None,
+    trace_memory=False,
+    cache_path=None,
+    incremental=False,
+):
+    """
+    複数タイトルのコマと吹き出しの順序をプロセスプールで推定し，JSONLに逐次書き出す
+    incrementalがTrueの場合，出力ファイルの隣のマニフェストと入力を比較し，
+    アノテーション・画像・アルゴリズムが変わったページだけを再計算して出力済みの結果に統合する
+    :param manga109_ano_dir: アノテーションファイルのディレクトリ
+    :param manga109_img_dir: 画像ファイルのディレクトリ
+    :param titles: タイトルのリスト("all"の場合は全タイトル)
+    :param output_path: 出力するJSONLファイルのパス
+    :param workers: ワーカープロセス数(Noneの場合はCPU数)
+    :param detect: Trueの場合，吹き出しを画像処理で検出する
+    :param iou_threshold: コマに内包されているかを判定するIoUの閾値
+    :param profile_path: 処理段階ごとの計測結果を書き出すJSONファイルのパス(Noneの場合は計測しない)
+    :param trace_memory: Trueの場合，ページごとのピークメモリも計測する
+    :param cache_path: 順序推定の結果のキャッシュファイルのパス(Noneの場合は使わない)
+    :param incremental: Trueの場合，変わったページだけを再計算する
+    :return: 処理したページ数
+    """
+    titles = list_titles(manga109_ano_dir, titles)
+    start_time = time.perf_counter()
+    total_done = 0
+    cache_hits = cache_misses = 0
+    profile = None
+    if profile_path is not None:
+        profile = "memory" if trace_memory else "time"
+        # アノテーションの読み込みはメインプロセスで計測し，ページごとの結果はワーカーから集める
+        profiler = enable_profiling()
+
+    if incremental:
+        algorithm = algorithm_signature(detect, iou_threshold)
+        manifest_file = manifest_path(output_path)
+        previous_titles = load_manifest(manifest_file, algorithm)
+        existing = read_results(output_path) if previous_titles else {}
+        # 出力に正常な結果があるページ
+        done_pages = {}
+        for (manga_title, page_index), (result, _) in existing.items():
+            if "error" not in result:
+                done_pages.setdefault(manga_title, set()).add(page_index)
+        manifest_titles = dict(previous_titles)
+        annotated_pages = {}
+        updated = {}
+        # 再計算した結果はいったん別のファイルに書き，最後に統合する
+        write_path = output_path + ".partial"
+    else:
+        write_path = output_path
+
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(write_path, "w", encoding="utf-8") as out:
+        # 全タイトルのページをまとめて投入し，タイトルの切れ目でワーカーを遊ばせない
+        futures = {}
+        title_pages = {}
+        for manga_title in titles:
+            if incremental:
+                entry = title_fingerprint(
+                    os.path.join(manga109_ano_dir, manga_title + ".xml"),
+                    open_image_source(manga109_img_dir, manga_title).fingerprint if detect else None,
+                    previous_titles.get(manga_title),
+                )
+                manifest_titles[manga_title] = entry
+                annotated_pages[manga_title] = {int(page) for page in entry["pages"]}
+                todo = pages_to_update(entry, previous_titles.get(manga_title), done_pages.get(manga_title, set()))
+                if not todo:
+                    continue
+
+            tasks = list(
+                iter_title_tasks(
+                    manga109_ano_dir, manga109_img_dir, manga_title, detect, iou_threshold, profile, cache_path
+                )
+            )
+            if incremental:
+                tasks = [task for task in tasks if task["page_index"] in todo]
+            # [ページ数, 完了数, 最初のページを投入した時刻]
+            title_pages[manga_title] = [len(tasks), 0, time.perf_counter()]
+            for task in tasks:
+                futures[executor.submit(process_page, task)] = task
+
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # ワーカープロセスの異常終了など(ページ内の例外はprocess_pageでエラーの結果になる)
+                result = page_error(futures[future], e)
+            if "profile" in result:
+                profiler.merge(result.pop("profile"))
+            if "cache_stats" in result:
+                hits, misses = result.pop("cache_stats")
+                cache_hits += hits
+                cache_misses += misses
+            line = json.dumps(result, ensure_ascii=False) + "\n"
+            out.write(line)
+            out.flush()
+            if incremental:
+                updated[(result["title"], result["page"])] = line
+            total_done += 1
+
+            # タイトルごとの進捗
+            now = time.perf_counter()
+            manga_title = futures[future]["title"]
+            progress = title_pages[manga_title]
+            progress[1] += 1
+            if progress[1] == progress[0]:
+                title_rate = progress[0] / max(now - progress[2], 1e-9)
+                print(
+                    f"{manga_title}: {progress[0]} pages, {title_rate:.1f} pages/sec "
+                    f"(total {total_done}/{len(futures)} pages, {total_done / max(now - start_time, 1e-9):.1f} pages/sec)",
+                    file=sys.stderr,
+                )
+
+    if incremental:
+        merge_results(output_path, existing, updated, annotated_pages)
+        os.remove(write_path)
+        save_manifest(manifest_file, algorithm, manifest_titles)
+        print(f"incremental: {total_done} pages recomputed", file=sys.stderr)
+    if cache_path is not None:
+        lookups = max(cache_hits + cache_misses, 1)
+        print(f"result cache: {cache_hits} hits, {cache_misses} misses ({cache_hits / lookups:.1%} hit rate)", file=sys.stderr)
+    if profile is not None:
+        disable_profiling()
+        profiler.write_report(profile_path)
+        profiler.print_summary()
+    return total_done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manga109のコマと吹き出しの順序を一括で推定する")
+    parser.add_argument(
+        "--annotations",
+        default="./../Manga109_released_2021_12_30/annotations.v2020.12.18/",
+        help="アノテーションファイルのディレクトリ",
+    )
+    parser.add_argument(
+        "--images",
+        default="./../Manga109_released_2021_12_30/images/",
+        help="画像ファイルのディレクトリ(タイトルごとのフォルダまたは<タイトル>.cbz/.zip)",
+    )
+    parser.add_argument("--titles", nargs="+", default=["all"], help='漫画のタイトル(全タイトルの場合は"all")')
+    parser.add_argument("--output", default="order_results.jsonl", help="出力するJSONLファイル")
+    parser.add_argument("--workers", type=int, default=None, help="ワーカープロセス数(省略時はCPU数)")
+    parser.add_argument("--detect", action="store_true", help="吹き出しをアノテーションではなく画像処理で検出する")
+    parser.add_argument("--iou-threshold", type=float, default=0.5, help="コマに内包されているかを判定するIoUの閾値")
+    parser.add_argument("--profile", default=None, help="処理段階ごとの計測結果を書き出すJSONファイル")
+    parser.add_argument("--cache", default=None, help="順序推定の結果を再利用するキャッシュファイル(SQLite)")
+    parser.add_argument("--incremental", action="store_true", help="入力が変わったページだけを再計算して出力に統合する")
+    parser.add_argument("--trace-memory", action="store_true", help="ページごとのピークメモリも計測する(--profile指定時)")
+    args = parser.parse_args()
+
+    run_batch(
+        args.annotations,
+        args.images,
+        args.titles,
+        args.output,
+        workers=args.workers,
+        detect=args.detect,
+        iou_threshold=args.iou_threshold,
+        profile_path=args.profile,
+        trace_memory=args.trace_memory,
+        cache_path=args.cache,
+        incremental=args.incremental,
+    )
@@ -0,0 +1,840 @@
+import argparse
+import math
+import os
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+from annotation_loader import ANNOTATION_TYPES, _parse_annotation_xml, table_to_page_objects
+from modules import (
+    assign_objs_to_panels,
+    assign_objs_to_panels_indexed,
+    binarize_for_balloons,
+    compare_detections,
+    contour_feature_table,
+    extractSpeechBalloon,
+    extractSpeechBalloon_scaled,
+    filter_balloon_features,
+    get_bouded_obj,
+    get_bounded_objs_page,
+    get_bounded_text,
+)
+from panel_order_estimater import calculate_pseudo_regions, order_panels
+from balloon_order import order_balloons, order_balloons2, order_balloons_beam, order_page_balloons
+from balloon_chara_order import find_speaker_candidates
+from panel_detector import detect_panel_boxes
+from image_prefetch import ImagePrefetcher
+from image_source import DirectoryImageSource
+from batch_order import process_page
+from shm_pipeline import run_pipeline
+from balloon_param_sweep import parameter_grid, sweep_balloon_params
+
+
+def order_panels_naive(pseudo_regions, page_width, page_height):
+    """
+    比較用: 候補を毎回全探索するorder_panelsの旧実装(O(n^3))
+    :param pseudo_regions: 擬似的なコマ領域の配列
+    :param page_width: ページの幅
+    :param page_height: ページの高さ
+    :return: コマのインデックスの順序
+    """
+    ordered = []
+    remaining = list(range(len(pseudo_regions)))
+
+    while remaining:
+        top_candidates = [
+            i for i in remaining if all(pseudo_regions[i][1] <= pseudo_regions[j][3] for j in remaining if i != j)
+        ]
+        if not top_candidates:
+            break
+        closest = min(
+            top_candidates, key=lambda i: ((page_width - pseudo_regions[i][2]) ** 2 + pseudo_regions[i][1] ** 2) ** 0.5
+        )
+        ordered.append(closest)
+        remaining.remove(closest)
+
+        current_region = pseudo_regions[closest]
+        if any(pseudo_regions[i][2] < current_region[0] for i in remaining):
+            next_candidates = [
+                i
+                for i in remaining
+                if pseudo_regions[i][1] >= current_region[3] and pseudo_regions[i][0] >= current_region[2]
+            ]
+            if next_candidates:
+                next_panel = min(
+                    next_candidates,
+                    key=lambda i: (
+                        (pseudo_regions[i][0] - current_region[2]) ** 2
+                        + (pseudo_regions[i][1] - current_region[3]) ** 2
+                    )
+                    ** 0.5,
+                )
+                ordered.append(next_panel)
+                remaining.remove(next_panel)
+
+    return ordered
+
+
+def make_panel_grid(n_panels, columns=4, panel_width=380, panel_height=280, gutter=20, jitter=15, seed=0):
+    """
+    コマが格子状に並んだ合成ページを生成(4コマ・縦読み漫画のような縦長のページも表現できる)
+    :param n_panels: コマ数
+    :param columns: 1段のコマ数
+    :param panel_width: コマの幅
+    :param panel_height: コマの高さ
+    :param gutter: コマ間の余白
+    :param jitter: 座標に加える乱数の幅
+    :param seed: 乱数のシード
+    :return: (コマ領域の配列(xmin, ymin, xmax, ymax), ページの幅, ページの高さ)
+    """
+    rng = np.random.default_rng(seed)
+    rows = -(-n_panels // columns)
+    page_width = columns * (panel_width + gutter) + gutter
+    page_height = rows * (panel_height + gutter) + gutter
+    regions = []
+    for k in range(n_panels):
+        row, col = divmod(k, columns)
+        # 右から左へ並べる
+        xmin = page_width - (col + 1) * (panel_width + gutter)
+        ymin = gutter + row * (panel_height + gutter)
+        regions.append([xmin, ymin, xmin + panel_width, ymin + panel_height])
+    regions = np.array(regions, dtype=np.int64).reshape(-1, 4)
+    regions += rng.integers(-jitter, jitter + 1, size=regions.shape)
+    return regions, page_width, page_height
+
+
+def _best_time(func, *args, repeat=3, number=1):
+    """
+    関数を複数回実行して最短の実行時間を計測
+    :param func: 計測する関数
+    :param args: 関数の引数
+    :param repeat: 計測回数
+    :param number: 1回の計測で続けて実行する回数(短い関数向け)
+    :return: (1回あたりの最短の実行時間[秒], 最後の戻り値)
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            result = func(*args)
+        best = min(best, (time.perf_counter() - start) / number)
+    return best, result
+
+
+def _boxes_to_dicts(boxes, obj_type, prefix):
+    """
+    座標配列をManga109と同じ形式のバウンディングボックス情報に変換
+    :param boxes: 座標配列(xmin, ymin, xmax, ymax)
+    :param obj_type: オブジェクトの種類
+    :param prefix: idの接頭辞
+    :return: バウンディングボックス情報のリスト
+    """
+    return [
+        {"type": obj_type, "id": f"{prefix}{k:04d}", "xmin": x0, "ymin": y0, "xmax": x1, "ymax": y1}
+        for k, (x0, y0, x1, y1) in enumerate(np.asarray(boxes).tolist())
+    ]
+
+
+def make_synthetic_page(n_panels=6, balloons_per_panel=3, columns=2, overlap=0, seed=0):
+    """
+    コマと吹き出しのアノテーションをもつ合成ページを生成
+    :param n_panels: コマ数
+    :param balloons_per_panel: 1コマあたりの吹き出し数
+    :param columns: 1段のコマ数
+    :param overlap: 隣り合うコマの重なり幅(0の場合は重ならない)
+    :param seed: 乱数のシード
+    :return: width, height, panels, textsをもつページの辞書
+    """
+    rng = np.random.default_rng(seed)
+    gutter = 20
+    panel_width, panel_height = 380, 280
+    regions, page_width, page_height = make_panel_grid(n_panels, columns, panel_width, panel_height, gutter, seed=seed)
+    if overlap:
+        # コマを左右に広げて隣のコマと重ねる
+        regions[:, 0] -= (overlap + gutter) // 2
+        regions[:, 2] += (overlap + gutter) - (overlap + gutter) // 2
+
+    texts = []
+    for x0, y0, x1, y1 in regions.tolist():
+        w = rng.integers(30, 90, size=balloons_per_panel)
+        h = rng.integers(40, 120, size=balloons_per_panel)
+        xmin = x0 + rng.integers(0, np.maximum(x1 - x0 - w, 1))
+        ymin = y0 + rng.integers(0, np.maximum(y1 - y0 - h, 1))
+        texts.append(np.stack([xmin, ymin, xmin + w, ymin + h], axis=1))
+    texts = np.concatenate(texts) if texts else np.zeros((0, 4), dtype=np.int64)
+    return {
+        "width": page_width,
+        "height": page_height,
+        "panels": _boxes_to_dicts(regions, "frame", "f"),
+        "texts": _boxes_to_dicts(texts, "text", "t"),
+    }
+
+
+def bench_order_panels(sizes=(10, 20, 40, 100, 200, 400, 800), naive_limit=400):
+    """
+    order_panelsのコマ数に対するスケーリングを計測
+    :param sizes: コマ数のリスト
+    :param naive_limit: 旧実装も計測するコマ数の上限
+    :return: 結果の行のリスト
+    """
+    lines = ["order_panels", f"{'panels':>8} {'naive[ms]':>12} {'new[ms]':>10} {'speedup':>9} {'same':>6}"]
+    for n in sizes:
+        regions, page_width, page_height = make_panel_grid(n, seed=n)
+        new_time, new_order = _best_time(order_panels, regions, page_width, page_height)
+        if n <= naive_limit:
+            naive_time, naive_order = _best_time(order_panels_naive, regions, page_width, page_height)
+            lines.append(
+                f"{n:>8} {naive_time * 1e3:>12.2f} {new_time * 1e3:>10.2f} "
+                f"{naive_time / new_time:>8.1f}x {str(naive_order == new_order):>6}"
+            )
+        else:
+            lines.append(f"{n:>8} {'-':>12} {new_time * 1e3:>10.2f} {'-':>9} {'-':>6}")
+    return lines
+
+
+def make_object_boxes(n_objects, page_width, page_height, min_size=20, max_size=120, seed=0):
+    """
+    ページ内にランダムに配置したオブジェクト(吹き出し・キャラクター)のバウンディングボックスを生成
+    :param n_objects: オブジェクト数
+    :param page_width: ページの幅
+    :param page_height: ページの高さ
+    :param min_size: オブジェクトの最小の一辺
+    :param max_size: オブジェクトの最大の一辺
+    :param seed: 乱数のシード
+    :return: オブジェクトの座標配列(xmin, ymin, xmax, ymax)
+    """
+    rng = np.random.default_rng(seed)
+    size = rng.integers(min_size, max_size, size=(n_objects, 2))
+    xmin = rng.integers(0, max(1, page_width - max_size), size=n_objects)
+    ymin = rng.integers(0, max(1, page_height - max_size), size=n_objects)
+    return np.stack([xmin, ymin, xmin + size[:, 0], ymin + size[:, 1]], axis=1)
+
+
+def bench_panel_assignment(sizes=((8, 30), (8, 200), (20, 1000), (40, 5000), (100, 20000), (400, 50000))):
+    """
+    パネルへのオブジェクトの割り当てを密な計算と空間インデックスで比較
+    :param sizes: (パネル数, オブジェクト数)のリスト
+    :return: 結果の行のリスト
+    """
+    lines = [
+        "panel/object assignment",
+        f"{'panels':>8} {'objects':>8} {'dense[ms]':>10} {'index[ms]':>10} {'speedup':>9} {'same':>6}",
+    ]
+    for n_panels, n_objects in sizes:
+        panels, page_width, page_height = make_panel_grid(n_panels, seed=n_panels)
+        objs = make_object_boxes(n_objects, page_width, page_height, seed=n_objects)
+        dense_time, dense = _best_time(assign_objs_to_panels, panels, objs)
+        index_time, indexed = _best_time(assign_objs_to_panels_indexed, panels, objs)
+        same = all(np.array_equal(a, b) for a, b in zip(dense, indexed))
+        lines.append(
+            f"{n_panels:>8} {n_objects:>8} {dense_time * 1e3:>10.2f} {index_time * 1e3:>10.2f} "
+            f"{dense_time / index_time:>8.1f}x {str(same):>6}"
+        )
+    return lines
+
+
+def bench_order_balloons(sizes=(2, 4, 6, 8, 10, 12, 16, 20, 30), beam_budget=0.005):
+    """
+    コマ内の吹き出しの順序推定(貪欲法のorder_balloons，最短経路のorder_balloons2，
+    予算付きビームサーチのorder_balloons_beam)の吹き出し数に対するスケーリングを計測
+    :param sizes: 1コマあたりの吹き出し数のリスト
+    :param beam_budget: order_balloons_beamの探索時間の上限[秒]
+    :return: 結果の行のリスト
+    """
+    lines = [
+        f"order_balloons / order_balloons2 / order_balloons_beam (budget {beam_budget * 1e3:g}ms)",
+        f"{'balloons':>8} {'greedy[ms]':>11} {'shortest[ms]':>13} {'beam[ms]':>10} {'same':>6} {'proven':>7}",
+    ]
+    for n in sizes:
+        page = make_synthetic_page(n_panels=1, balloons_per_panel=n, seed=n)
+        panel, texts = page["panels"][0], page["texts"]
+        number = 20 if n <= 12 else 1
+        greedy_time, _ = _best_time(order_balloons, panel, texts, number=number)
+        shortest_time, shortest = _best_time(order_balloons2, panel, texts, number=number)
+        beam_time, (beam, proven) = _best_time(order_balloons_beam, panel, texts, beam_budget, number=number)
+        lines.append(
+            f"{n:>8} {greedy_time * 1e3:>11.3f} {shortest_time * 1e3:>13.3f} {beam_time * 1e3:>10.3f}"
+            f" {str(beam == shortest):>6} {str(proven):>7}"
+        )
+    return lines
+
+
+def find_speaker_candidates_naive(panels, page_ordered_balloons, characters, k=3):
+    """
+    比較用: コマごとにget_bouded_objでキャラクターを求め，吹き出しとの距離を全て計算する実装(O(吹き出し×キャラクター))
+    :param panels: ページ内のコマのバウンディングボックス情報
+    :param page_ordered_balloons: コマごとの順序付けた吹き出し
+    :param characters: ページ内のキャラクターのバウンディングボックス情報
+    :param k: 吹き出しごとの候補数の上限
+    :return: コマごと・吹き出しごとの話者の候補[(キャラクター, 中心間の距離), ...]
+    """
+    candidates = []
+    for panel, ordered_balloons in zip(panels, page_ordered_balloons):
+        panel_characters = get_bouded_obj(panel, characters)
+        panel_candidates = []
+        for balloon in ordered_balloons:
+            bx, by = (int(balloon["xmin"]) + int(balloon["xmax"])) / 2, (int(balloon["ymin"]) + int(balloon["ymax"])) / 2
+            distances = []
+            for character in panel_characters:
+                cx = (int(character["xmin"]) + int(character["xmax"])) / 2
+                cy = (int(character["ymin"]) + int(character["ymax"])) / 2
+                distances.append((math.hypot(bx - cx, by - cy), character))
+            distances.sort(key=lambda item: item[0])
+            panel_candidates.append([(character, distance) for distance, character in distances[:k]])
+        candidates.append(panel_candidates)
+    return candidates
+
+
+def bench_speaker_assignment(sizes=((6, 3, 20), (12, 4, 60), (24, 6, 200), (48, 8, 1000))):
+    """
+    吹き出しの話者の候補の検索をコマごとの全探索とページ単位のKD木で比較
+    :param sizes: (コマ数, 1コマあたりの吹き出し数, キャラクター数)のリスト
+    :return: 結果の行のリスト
+    """
+    lines = [
+        "find_speaker_candidates (top-3)",
+        f"{'panels':>8} {'balloons':>9} {'characters':>11} {'naive[ms]':>10} {'kd-tree[ms]':>12} {'speedup':>9} {'same':>6}",
+    ]
+    for n_panels, balloons_per_panel, n_characters in sizes:
+        page = make_synthetic_page(n_panels, balloons_per_panel, overlap=20, seed=n_panels)
+        boxes = make_object_boxes(n_characters, page["width"], page["height"], seed=n_characters)
+        characters = _boxes_to_dicts(boxes, "face", "c")
+        page_ordered_balloons = order_page_balloons(page["panels"], page["texts"])
+        args = (page["panels"], page_ordered_balloons, characters)
+        naive_time, naive = _best_time(find_speaker_candidates_naive, *args, number=3)
+        tree_time, tree = _best_time(find_speaker_candidates, *args, number=3)
+        same = [[[(c["id"], round(d, 6)) for c, d in b] for b in p] for p in naive] == [
+            [[(c["id"], round(d, 6)) for c, d in b] for b in p] for p in tree
+        ]
+        lines.append(
+            f"{n_panels:>8} {n_panels * balloons_per_panel:>9} {n_characters:>11} {naive_time * 1e3:>10.3f}"
+            f" {tree_time * 1e3:>12.3f} {naive_time / tree_time:>8.1f}x {str(same):>6}"
+        )
+    return lines
+
+
+def bench_pseudo_regions(sizes=(4, 8, 16, 32, 64, 128), overlap=40):
+    """
+    擬似的なコマ領域の計算のコマ数に対するスケーリングを計測(隣り合うコマは重なる)
+    :param sizes: コマ数のリスト
+    :param overlap: 隣り合うコマの重なり幅
+    :return: 結果の行のリスト
+    """
+    lines = [f"calculate_pseudo_regions (overlap {overlap}px)", f"{'panels':>8} {'time[ms]':>10}"]
+    for n in sizes:
+        page = make_synthetic_page(n_panels=n, balloons_per_panel=0, overlap=overlap, seed=n)
+        elapsed, _ = _best_time(calculate_pseudo_regions, page["panels"], number=20)
+        lines.append(f"{n:>8} {elapsed * 1e3:>10.3f}")
+    return lines
+
+
+def bench_bounded_text(sizes=((6, 3), (12, 4), (24, 6), (48, 8), (96, 8))):
+    """
+    吹き出しのコマへの割り当てをコマごとのget_bounded_textとページ単位のget_bounded_objs_pageで比較
+    :param sizes: (コマ数, 1コマあたりの吹き出し数)のリスト
+    :return: 結果の行のリスト
+    """
+    lines = [
+        "get_bounded_text",
+        f"{'panels':>8} {'balloons':>9} {'per-panel[ms]':>14} {'page[ms]':>10} {'speedup':>9} {'same':>6}",
+    ]
+    for n_panels, balloons_per_panel in sizes:
+        page = make_synthetic_page(n_panels, balloons_per_panel, overlap=20, seed=n_panels)
+        panels, texts = page["panels"], page["texts"]
+        per_panel_time, per_panel = _best_time(lambda: [get_bounded_text(panel, texts) for panel in panels], number=5)
+        page_time, whole_page = _best_time(get_bounded_objs_page, panels, texts, number=5)
+        lines.append(
+            f"{n_panels:>8} {len(texts):>9} {per_panel_time * 1e3:>14.3f} {page_time * 1e3:>10.3f} "
+            f"{per_panel_time / page_time:>8.1f}x {str(per_panel == whole_page):>6}"
+        )
+    return lines
+
+
+def bench_extract_balloons(sizes=((827, 585, 8), (1654, 1170, 25), (2480, 1754, 50), (3308, 2340, 90))):
+    """
+    吹き出し検出の画像サイズに対するスケーリングを合成ページ画像で計測
+    :param sizes: (幅, 高さ, 吹き出し数)のリスト
+    :return: 結果の行のリスト
+    """
+    lines = [
+        "extractSpeechBalloon",
+        f"{'size':>10} {'balloons':>9} {'time[ms]':>10} {'recall':>8} {'precision':>10}",
+    ]
+    for page_width, page_height, n_balloons in sizes:
+        img, balloons = render_balloon_page(page_width, page_height, n_balloons, seed=n_balloons)
+        elapsed, detected = _best_time(extractSpeechBalloon, img)
+        # 描いた楕円の外接矩形に対する精度(楕円が重なった吹き出しは1つとして検出されうる)
+        accuracy = compare_detections(balloons, detected)
+        lines.append(
+            f"{f'{page_width}x{page_height}':>10} {n_balloons:>9} {elapsed * 1e3:>10.2f} "
+            f"{accuracy['recall']:>8.3f} {accuracy['precision']:>10.3f}"
+        )
+    return lines
+
+
+def load_annotations_legacy(xml_file):
+    """
+    比較用: 文字列の座標をもつ辞書でアノテーションを読み込む旧実装
+    :param xml_file: アノテーションファイルのパス
+    :return: ページごとのオブジェクトのバウンディングボックス情報
+    """
+    root = ET.parse(xml_file).getroot()
+    page_objects = {}
+    for page in root.findall(".//page"):
+        page_objects[int(page.get("index"))] = [
+            {
+                "type": obj.tag,
+                "id": obj.get("id"),
+                "xmin": obj.get("xmin"),
+                "ymin": obj.get("ymin"),
+                "xmax": obj.get("xmax"),
+                "ymax": obj.get("ymax"),
+            }
+            for obj in page
+            if obj.tag in ANNOTATION_TYPES
+        ]
+    return page_objects
+
+
+def write_synthetic_annotation(xml_file, n_pages=194, objects_per_page=24, page_width=1654, page_height=1170, seed=0):
+    """
+    Manga109と同じ形式の合成アノテーションファイルを書き出す
+    :param xml_file: 出力するアノテーションファイルのパス
+    :param n_pages: ページ数
+    :param objects_per_page: 1ページあたりのオブジェクト数
+    :param page_width: ページの幅
+    :param page_height: ページの高さ
+    :param seed: 乱数のシード
+    """
+    rng = np.random.default_rng(seed)
+    n_objects = n_pages * objects_per_page
+    tags = rng.integers(len(ANNOTATION_TYPES), size=n_objects).tolist()
+    xmin = rng.integers(0, page_width - 200, size=n_objects)
+    ymin = rng.integers(0, page_height - 200, size=n_objects)
+    xmax = (xmin + rng.integers(10, 200, size=n_objects)).tolist()
+    ymax = (ymin + rng.integers(10, 200, size=n_objects)).tolist()
+    xmin, ymin = xmin.tolist(), ymin.tolist()
+
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', '<book title="synthetic">', "<pages>"]
+    for page_index in range(n_pages):
+        lines.append(f'<page index="{page_index}" width="{page_width}" height="{page_height}">')
+        for k in range(page_index * objects_per_page, (page_index + 1) * objects_per_page):
+            tag = ANNOTATION_TYPES[tags[k]]
+            attrs = f'id="{k:08x}" xmin="{xmin[k]}" ymin="{ymin[k]}" xmax="{xmax[k]}" ymax="{ymax[k]}"'
+            lines.append(f"<{tag} {attrs}>text</{tag}>" if tag == "text" else f"<{tag} {attrs}/>")
+        lines.append("</page>")
+    lines += ["</pages>", "</book>"]
+    with open(xml_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+
+def _retained_memory(load, xml_files):
+    """
+    全ファイルを読み込んで保持したときのメモリ使用量を計測
+    :param load: 1ファイルを読み込む関数
+    :param xml_files: アノテーションファイルのリスト
+    :return: 保持しているメモリ量[バイト]
+    """
+    tracemalloc.start()
+    loaded = [load(xml_file) for xml_file in xml_files]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del loaded
+    return current
+
+
+def bench_annotation_memory(manga109_ano_dir=None, n_titles=109):
+    """
+    全タイトルのアノテーションを同時に保持したときのメモリ使用量を比較
+    :param manga109_ano_dir: アノテーションファイルのディレクトリ(Noneの場合は合成データ)
+    :param n_titles: 合成データのタイトル数
+    :return: 結果の行のリスト
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if manga109_ano_dir is None:
+            xml_files = [os.path.join(tmp_dir, f"title{i:03d}.xml") for i in range(n_titles)]
+            for i, xml_file in enumerate(xml_files):
+                write_synthetic_annotation(xml_file, seed=i)
+        else:
+            xml_files = sorted(os.path.join(manga109_ano_dir, f) for f in os.listdir(manga109_ano_dir) if f.endswith(".xml"))
+
+        legacy = _retained_memory(load_annotations_legacy, xml_files)
+        table = _retained_memory(_parse_annotation_xml, xml_files)
+        views = _retained_memory(lambda f: table_to_page_objects(_parse_annotation_xml(f)), xml_files)
+
+    lines = [f"annotation memory ({len(xml_files)} titles)", f"{'representation':<24} {'MB':>10} {'ratio':>8}"]
+    for name, size in (("dict of str (legacy)", legacy), ("columnar table", table), ("table + BBox views", views)):
+        lines.append(f"{name:<24} {size / 2**20:>10.1f} {size / legacy:>8.3f}")
+    return lines
+
+
+def render_balloon_page(page_width=1654, page_height=1170, n_balloons=25, seed=0):
+    """
+    枠線付きの楕円の吹き出しとスクリーントーン風のノイズを描いた合成ページ画像を生成
+    :param page_width: ページの幅
+    :param page_height: ページの高さ
+    :param n_balloons: 吹き出しの数
+    :param seed: 乱数のシード
+    :return: (画像, 吹き出しのバウンディングボックスの配列(xmin, ymin, xmax, ymax))
+    """
+    rng = np.random.default_rng(seed)
+    img = np.full((page_height, page_width, 3), 255, np.uint8)
+    # スクリーントーン
+    for _ in range(20):
+        x, y = int(rng.integers(0, page_width - 200)), int(rng.integers(0, page_height - 200))
+        tone = (rng.random((150, 150)) > 0.6).astype(np.uint8) * 255
+        img[y : y + 150, x : x + 150] = np.minimum(img[y : y + 150, x : x + 150], tone[..., None])
+    # コマ枠
+    for x0 in range(20, page_width - 300, 400):
+        for y0 in range(20, page_height - 250, 380):
+            cv2.rectangle(img, (x0, y0), (x0 + 370, y0 + 350), (0, 0, 0), 3)
+    # 文字の入った吹き出し
+    balloons = []
+    for _ in range(n_balloons):
+        cx, cy = int(rng.integers(80, page_width - 80)), int(rng.integers(80, page_height - 80))
+        ax, ay = int(rng.integers(40, 90)), int(rng.integers(50, 110))
+        cv2.ellipse(img, (cx, cy), (ax, ay), 0, 0, 360, (255, 255, 255), -1)
+        cv2.ellipse(img, (cx, cy), (ax, ay), 0, 0, 360, (0, 0, 0), 2)
+        for k in range(4):
+            cv2.putText(img, "ab", (cx - ax // 2, cy - ay // 2 + 20 + k * 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
+        balloons.append([cx - ax, cy - ay, cx + ax, cy + ay])
+    return img, np.array(balloons, dtype=np.int64).reshape(-1, 4)
+
+
+def render_panel_page(page_width=1654, page_height=1170, slanted=True, seed=0):
+    """
+    見開き2ページにコマを描いた合成ページ画像を生成
+    各ページは2〜4段，各段は1〜3コマで，コマの中には線・吹き出し・スクリーントーンを描く
+    :param page_width: 見開きの幅
+    :param page_height: 見開きの高さ
+    :param slanted: Trueの場合，斜めの余白で分けたコマを含める
+    :param seed: 乱数のシード
+    :return: (画像, コマのバウンディングボックスの配列(xmin, ymin, xmax, ymax))
+    """
+    rng = np.random.default_rng(seed)
+    img = np.full((page_height, page_width, 3), 255, np.uint8)
+    margin, gutter = 60, 16
+    polygons = []
+    half = page_width // 2
+    for left in (half, 0):
+        rows = int(rng.integers(2, 5))
+        row_edges = np.linspace(margin, page_height - margin, rows + 1).astype(int)
+        row_edges[1:-1] += rng.integers(-30, 31, size=rows - 1)
+        for r in range(rows):
+            y0, y1 = row_edges[r] + (gutter // 2 if r else 0), row_edges[r + 1] - (gutter // 2 if r < rows - 1 else 0)
+            columns = int(rng.integers(1, 4))
+            col_edges = np.linspace(left + margin, left + half - margin, columns + 1).astype(int)
+            for c in range(columns):
+                x0 = col_edges[c] + (gutter // 2 if c else 0)
+                x1 = col_edges[c + 1] - (gutter // 2 if c < columns - 1 else 0)
+                if slanted and columns == 1 and rng.random() < 0.5:
+                    # 斜めの余白で左右に分ける
+                    shift = int(rng.integers(20, 60))
+                    mid = (x0 + x1) // 2
+                    polygons.append([(mid + shift + gutter // 2, y0), (x1, y0), (x1, y1), (mid - shift + gutter // 2, y1)])
+                    polygons.append([(x0, y0), (mid + shift - gutter // 2, y0), (mid - shift - gutter // 2, y1), (x0, y1)])
+                else:
+                    polygons.append([(x0, y0), (x1, y0), (x1, y1), (x0, y1)])
+
+    frames = []
+    for polygon in polygons:
+        points = np.array(polygon, dtype=np.int32)
+        (x0, y0), (x1, y1) = points.min(axis=0), points.max(axis=0)
+        # コマの中身
+        canvas = np.full_like(img, 255)
+        for _ in range(int(rng.integers(3, 8))):
+            p, q = rng.integers((x0, y0), (x1, y1), size=(2, 2))
+            cv2.line(canvas, tuple(map(int, p)), tuple(map(int, q)), (0, 0, 0), int(rng.integers(1, 4)))
+        tone = (rng.random((y1 - y0, x1 - x0)) > 0.7).astype(np.uint8) * 255
+        tone_rows = slice(y0 + (y1 - y0) // 2, y1)
+        canvas[tone_rows, x0:x1] = np.minimum(canvas[tone_rows, x0:x1], tone[(y1 - y0) // 2 :, :, None])
+        center = tuple(map(int, rng.integers((x0, y0), (x1, y1))))
+        cv2.ellipse(canvas, center, (50, 70), 0, 0, 360, (255, 255, 255), -1)
+        cv2.ellipse(canvas, center, (50, 70), 0, 0, 360, (0, 0, 0), 2)
+        mask = np.zeros(img.shape[:2], np.uint8)
+        cv2.fillPoly(mask, [points], 1)
+        img[mask > 0] = canvas[mask > 0]
+        cv2.polylines(img, [points], True, (0, 0, 0), 3)
+        frames.append([x0 - 1, y0 - 1, x1 + 2, y1 + 2])
+    return img, np.array(frames, dtype=np.int64).reshape(-1, 4)
+
+
+def bench_panel_detector(n_pages=20):
+    """
+    コマ検出の処理時間と，描いたコマに対する精度を合成ページ画像で計測
+    :param n_pages: 合成ページの枚数
+    :return: 結果の行のリスト
+    """
+    pages = [render_panel_page(seed=i) for i in range(n_pages)]
+    grays = [cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) for img, _ in pages]
+    lines = [
+        f"detect_panel_boxes ({n_pages} synthetic spreads)",
+        f"{'method':<18} {'ms/page':>9} {'recall':>8} {'precision':>10} {'mean_iou':>9}",
+    ]
+    for name, use_components in (("xy-cut", False), ("xy-cut + cc", True)):
+        elapsed, detected = _best_time(lambda: [detect_panel_boxes(gray, use_components) for gray in grays])
+        matched = [compare_detections(frames, boxes) for (_, frames), boxes in zip(pages, detected)]
+        n_frames = sum(len(frames) for _, frames in pages)
+        n_detected = sum(len(boxes) for boxes in detected)
+        n_matched = sum(m["matched"] for m in matched)
+        mean_iou = sum(m["mean_iou"] * m["matched"] for m in matched) / max(n_matched, 1)
+        lines.append(
+            f"{name:<18} {elapsed / n_pages * 1e3:>9.2f} {n_matched / max(n_frames, 1):>8.3f} "
+            f"{n_matched / max(n_detected, 1):>10.3f} {mean_iou:>9.3f}"
+        )
+    return lines
+
+
+def bench_detection_scales(img_paths=None, scales=(1.0, 0.5, 0.25, 0.125), n_pages=8):
+    """
+    吹き出し検出の作業解像度ごとの処理時間と，全解像度の検出結果に対する精度を比較
+    :param img_paths: 画像ファイルのリスト(Noneの場合は合成ページ)
+    :param scales: 縮小率のリスト
+    :param n_pages: 合成ページの枚数
+    :return: 結果の行のリスト
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if img_paths is None:
+            img_paths = _write_synthetic_pages(tmp_dir, n_pages)
+
+        # 全解像度(読み込みを含む)の検出結果を基準とする
+        reference = [extractSpeechBalloon(cv2.imread(img_path)) for img_path in img_paths]
+        lines = [
+            f"balloon detection scale ({len(img_paths)} pages, vs full resolution)",
+            f"{'scale':>7} {'ms/page':>9} {'speedup':>9} {'recall':>8} {'precision':>10} {'mean_iou':>9}",
+        ]
+        full_time = None
+        for scale in scales:
+            elapsed, detected = _best_time(
+                lambda: [extractSpeechBalloon_scaled(img_path=img_path, scale=scale) for img_path in img_paths]
+            )
+            full_time = elapsed if full_time is None else full_time
+            matched = [compare_detections(ref, det) for ref, det in zip(reference, detected)]
+            n_reference = sum(len(ref) for ref in reference)
+            n_detected = sum(len(det) for det in detected)
+            n_matched = sum(m["matched"] for m in matched)
+            mean_iou = np.mean([m["mean_iou"] for m in matched if m["matched"]]) if n_matched else 0.0
+            lines.append(
+                f"{scale:>7.3f} {elapsed / len(img_paths) * 1e3:>9.2f} {full_time / elapsed:>8.1f}x "
+                f"{n_matched / max(n_reference, 1):>8.3f} {n_matched / max(n_detected, 1):>10.3f} {mean_iou:>9.3f}"
+            )
+    return lines
+
+
+def _write_synthetic_pages(tmp_dir, n_pages):
+    """
+    合成ページ画像をJPEGで書き出す
+    :param tmp_dir: 出力するディレクトリ
+    :param n_pages: ページ数
+    :return: 画像ファイルのパスのリスト
+    """
+    img_paths = []
+    for i in range(n_pages):
+        img_path = os.path.join(tmp_dir, f"{i:03d}.jpg")
+        cv2.imwrite(img_path, render_balloon_page(seed=i)[0])
+        img_paths.append(img_path)
+    return img_paths
+
+
+def bench_image_prefetch(img_paths=None, n_pages=24, depths=(1, 2, 4, 8)):
+    """
+    画像の読み込み+吹き出し検出のループを，逐次のcv2.imreadとスレッドによる先読みで比較
+    :param img_paths: 画像ファイルのリスト(Noneの場合は合成ページ)
+    :param n_pages: 合成ページの枚数
+    :param depths: 先読みする枚数のリスト
+    :return: 結果の行のリスト
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if img_paths is None:
+            img_paths = _write_synthetic_pages(tmp_dir, n_pages)
+
+        def sequential(flags):
+            return [extractSpeechBalloon(cv2.imread(img_path, flags)) for img_path in img_paths]
+
+        def prefetched(depth, grayscale):
+            with ImagePrefetcher(img_paths, depth=depth, grayscale=grayscale) as prefetcher:
+                detected = [extractSpeechBalloon(img) for _, img in prefetcher]
+            return detected, prefetcher.metrics()
+
+        lines = [
+            f"image prefetch ({len(img_paths)} pages, cv2.imread + extractSpeechBalloon)",
+            f"{'reader':<22} {'ms/page':>9} {'speedup':>9} {'stalls':>7} {'stall[ms]':>10} {'depth':>7} {'same':>6}",
+        ]
+        base_time, reference = _best_time(sequential, cv2.IMREAD_COLOR)
+        lines.append(f"{'sequential color':<22} {base_time / len(img_paths) * 1e3:>9.2f} {1.0:>8.1f}x")
+        gray_time, detected = _best_time(sequential, cv2.IMREAD_GRAYSCALE)
+        lines.append(
+            f"{'sequential gray':<22} {gray_time / len(img_paths) * 1e3:>9.2f} {base_time / gray_time:>8.1f}x"
+            f" {'':>7} {'':>10} {'':>7} {str(detected == reference):>6}"
+        )
+        for grayscale in (False, True):
+            for depth in depths:
+                elapsed, (detected, metrics) = _best_time(prefetched, depth, grayscale)
+                name = f"prefetch {'gray' if grayscale else 'color'} depth={depth}"
+                lines.append(
+                    f"{name:<22} {elapsed / len(img_paths) * 1e3:>9.2f} {base_time / elapsed:>8.1f}x"
+                    f" {metrics['stalls']:>7} {metrics['stall_time'] * 1e3:>10.1f} {metrics['mean_queue_depth']:>7.2f}"
+                    f" {str(detected == reference):>6}"
+                )
+    return lines
+
+
+def bench_shm_pipeline(n_pages=48, workers=None):
+    """
+    画像の読み込み+吹き出し検出+順序推定を，パスを渡すProcessPoolExecutor.mapと共有メモリのパイプラインで比較
+    :param n_pages: 合成ページの枚数
+    :param workers: プロセス数(Noneの場合はCPU数)
+    :return: 結果の行のリスト
+    """
+    workers = workers or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        img_paths = _write_synthetic_pages(tmp_dir, n_pages)
+        img_source = DirectoryImageSource(tmp_dir)
+        # render_balloon_pageのコマ枠
+        panels = [
+            {"type": "frame", "id": f"frame_{k}", "xmin": x0, "ymin": y0, "xmax": x0 + 370, "ymax": y0 + 350}
+            for k, (x0, y0) in enumerate((x0, y0) for x0 in range(20, 1654 - 300, 400) for y0 in range(20, 1170 - 250, 380))
+        ]
+        tasks = [
+            {
+                "title": "synthetic",
+                "page_index": i,
+                "page_width": 1654,
+                "page_height": 1170,
+                "panels": panels,
+                "texts": [],
+                "img_source": img_source,
+                "img_path": img_path,
+                "iou_threshold": 0.5,
+                "profile": None,
+                "cache": None,
+            }
+            for i, img_path in enumerate(img_paths)
+        ]
+
+        def pool_map():
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                return sorted(executor.map(process_page, tasks), key=lambda result: result["page"])
+
+        def pipeline(**options):
+            return sorted(run_pipeline(tasks, **options), key=lambda result: result["page"])
+
+        lines = [
+            f"shared-memory pipeline ({n_pages} pages, {workers} CPUs)",
+            f"{'runner':<36} {'pages/sec':>10} {'speedup':>9} {'same':>6}",
+        ]
+        base_time, reference = _best_time(pool_map, repeat=2)
+        lines.append(f"{f'ProcessPoolExecutor.map ({workers})':<36} {n_pages / base_time:>10.1f} {1.0:>8.1f}x")
+        detectors = max(1, workers - 2)
+        for name, options in (
+            (f"pipeline 1/{detectors}/1 color", {"detectors": detectors}),
+            (f"pipeline 1/{detectors}/1 gray", {"detectors": detectors, "grayscale": True}),
+        ):
+            elapsed, results = _best_time(lambda: pipeline(**options), repeat=2)
+            lines.append(
+                f"{name:<36} {n_pages / elapsed:>10.1f} {base_time / elapsed:>8.1f}x {str(results == reference):>6}"
+            )
+    return lines
+
+
+def _detect_with_setting(gray, setting):
+    """
+    比較用: 1つの設定で吹き出し検出を最初から行う(extractSpeechBalloonのパラメータを変えたもの)
+    :param gray: グレースケール画像
+    :param setting: 設定(balloon_param_sweep.parameter_gridを参照)
+    :return: 検出したバウンディングボックスの配列
+    """
+    _, binary = binarize_for_balloons(gray, setting["threshold"], setting["kernel_size"])
+    contours, _ = cv2.findContours(binary, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+    page_area = gray.shape[0] * gray.shape[1]
+    # 白黒比はその条件を使う設定でだけ計算する(extractSpeechBalloonと同じ)
+    area_range = (0.0, 0.0)
+    if setting["white_ratio_range"] is not None:
+        area_range = (page_area * setting["min_area_ratio"], page_area * setting["max_area_ratio"])
+    features = contour_feature_table(contours, gray, ratio_area_range=area_range)
+    keep = filter_balloon_features(
+        features,
+        page_area,
+        setting["min_area_ratio"],
+        setting["max_area_ratio"],
+        setting["min_circularity"],
+        setting["white_ratio_range"],
+    )
+    x, y, w, h = (features[key][keep] for key in ("x", "y", "w", "h"))
+    return np.stack([x, y, x + w, y + h], axis=1)
+
+
+def bench_param_sweep(n_pages=4):
+    """
+    吹き出し検出のパラメータ探索(108設定)を，設定ごとに検出をやり直す場合と中間結果を再利用する場合で比較
+    :param n_pages: 合成ページの枚数
+    :return: 結果の行のリスト
+    """
+    pages = []
+    for i in range(n_pages):
+        img, balloons = render_balloon_page(seed=i)
+        pages.append((cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), balloons))
+    settings = parameter_grid(
+        threshold=[210, 220, 230, 240],
+        min_area_ratio=[0.0005, 0.001, 0.002],
+        max_area_ratio=[0.03, 0.05, 0.08],
+        min_circularity=[0.0, 0.2, 0.4],
+    )
+
+    def naive():
+        return [
+            sum(compare_detections(balloons, _detect_with_setting(gray, setting))["matched"] for gray, balloons in pages)
+            for setting in settings
+        ]
+
+    single_time, _ = _best_time(lambda: [extractSpeechBalloon(gray) for gray, _ in pages])
+    naive_time, naive_matched = _best_time(naive, repeat=1)
+    sweep_time, results = _best_time(sweep_balloon_params, pages, settings)
+    same = naive_matched == [result["matched"] for result in results]
+    return [
+        f"balloon parameter sweep ({len(settings)} settings, {n_pages} pages)",
+        f"{'method':<28} {'time[s]':>9} {'detection passes':>17} {'same':>6}",
+        f"{'rerun per setting':<28} {naive_time:>9.2f} {naive_time / single_time:>17.1f}",
+        f"{'shared variants + masks':<28} {sweep_time:>9.2f} {sweep_time / single_time:>17.1f} {str(same):>6}",
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="コマ・吹き出しの順序推定のベンチマーク")
+    parser.add_argument("--output", default="bench_output.txt", help="結果を書き出すファイル")
+    parser.add_argument("--annotations", default=None, help="アノテーションファイルのディレクトリ(省略時は合成データ)")
+    parser.add_argument("--images", nargs="+", default=None, help="吹き出し検出に使う画像ファイル(省略時は合成ページ)")
+    parser.add_argument("--suites", nargs="+", default=None, help="実行するベンチマーク(省略時は全て)")
+    args = parser.parse_args()
+
+    # ベンチマーク名 -> 結果の行を返す関数
+    suites = {
+        "order_balloons": bench_order_balloons,
+        "order_panels": bench_order_panels,
+        "pseudo_regions": bench_pseudo_regions,
+        "bounded_text": bench_bounded_text,
+        "speaker_assignment": bench_speaker_assignment,
+        "panel_assignment": bench_panel_assignment,
+        "extract_balloons": bench_extract_balloons,
+        "panel_detector": bench_panel_detector,
+        "detection_scales": lambda: bench_detection_scales(args.images),
+        "image_prefetch": lambda: bench_image_prefetch(args.images),
+        "shm_pipeline": bench_shm_pipeline,
+        "param_sweep": bench_param_sweep,
+        "annotation_memory": lambda: bench_annotation_memory(args.annotations),
+    }
+    unknown = set(args.suites or []) - set(suites)
+    if unknown:
+        parser.error(f"unknown suites: {', '.join(sorted(unknown))} (choose from {', '.join(suites)})")
+
+    lines = []
+    for name in args.suites or suites:
+        section = suites[name]()
+        print("\n".join(section) + "\n", flush=True)
+        lines += ([""] if lines else []) + section
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
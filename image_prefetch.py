@@ -0,0 +1,141 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+from image_source import DirectoryImageSource
+from profiler import stage
+
+# 先読みする画像の枚数の既定値
+PREFETCH_DEPTH = 4
+# デコードに使うスレッド数の既定値
+PREFETCH_WORKERS = 2
+
+
+def _decode(read, item, flags):
+    """
+    画像を読み込んでデコード(先読みのスレッドで実行)
+    :param read: 画像を読み込む関数(item, flags) -> 画像
+    :param item: 画像ファイルのパスまたはページインデックス
+    :param flags: 読み込みのフラグ
+    :return: (画像(読めない場合はNone), デコードにかかった時間[秒])
+    """
+    start = time.perf_counter()
+    img = read(item, flags)
+    return img, time.perf_counter() - start
+
+
+class ImagePrefetcher:
+    """
+    画像をスレッドで先読みし，指定した順に(画像ファイルのパス, 画像)を返すイテレータ
+    cv2.imread/cv2.imdecodeはデコード中にGILを解放するため，検出・順序推定の間に次のページを読み込める
+    先読みは最大depth枚までで，それ以上は取り出されるまで読み込まない(メモリ使用量が増えない)
+    """
+
+    def __init__(self, img_paths, depth=PREFETCH_DEPTH, workers=PREFETCH_WORKERS, grayscale=False, read=cv2.imread):
+        """
+        :param img_paths: 画像ファイルのパス(readを指定した場合はreadに渡す値)のイテラブル
+        :param depth: 先読みする画像の枚数の上限
+        :param workers: デコードに使うスレッド数
+        :param grayscale: Trueの場合はグレースケールでデコードする(吹き出し・コマ検出はグレースケールで十分)
+        :param read: 画像を読み込む関数(img_pathsの要素, flags) -> 画像
+        """
+        self.read = read
+        self.depth = max(1, depth)
+        self.workers = workers
+        self.flags = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+        self._img_paths = iter(img_paths)
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image_prefetch")
+        # 統計
+        self.pages = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.decode_time = 0.0
+        self._ready_total = 0
+        self._ready_max = 0
+        self._fill()
+
+    def _fill(self):
+        """
+        先読み中の画像がdepth枚になるまで読み込みを開始
+        """
+        while len(self._pending) < self.depth:
+            for img_path in self._img_paths:
+                self._pending.append((img_path, self._executor.submit(_decode, self.read, img_path, self.flags)))
+                break
+            else:
+                return
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._pending:
+            raise StopIteration
+        # 取り出す時点でデコードが終わっている画像の枚数(キューの深さ)
+        ready = sum(future.done() for _, future in self._pending)
+        self._ready_total += ready
+        self._ready_max = max(self._ready_max, ready)
+
+        img_path, future = self._pending.popleft()
+        if not future.done():
+            # デコードが間に合わず待たされた
+            self.stalls += 1
+            start = time.perf_counter()
+            with stage("imread_wait"):
+                img, elapsed = future.result()
+            self.stall_time += time.perf_counter() - start
+        else:
+            img, elapsed = future.result()
+        self.decode_time += elapsed
+        self.pages += 1
+        self._fill()
+        return img_path, img
+
+    def metrics(self):
+        """
+        先読みの統計を取得
+        :return: pages, stalls(待たされた回数), stall_time(待った時間の合計[秒]), decode_time(デコード時間の合計[秒]),
+                 mean_queue_depth, max_queue_depth(取り出し時にデコード済みだった画像の枚数)の辞書
+        """
+        return {
+            "pages": self.pages,
+            "stalls": self.stalls,
+            "stall_time": self.stall_time,
+            "decode_time": self.decode_time,
+            "mean_queue_depth": self._ready_total / self.pages if self.pages else 0.0,
+            "max_queue_depth": self._ready_max,
+        }
+
+    def close(self):
+        """
+        未開始の読み込みを取り消してスレッドを終了
+        """
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def prefetch_pages(page_indices, img_source, depth=PREFETCH_DEPTH, workers=PREFETCH_WORKERS, grayscale=False):
+    """
+    ページの画像を先読みしながら(ページインデックス, 画像)を返すジェネレータ
+    :param page_indices: ページのインデックスのイテラブル
+    :param img_source: 画像の読み込み元(image_sourceを参照，文字列の場合は画像フォルダのパス)
+    :param depth: 先読みする画像の枚数の上限
+    :param workers: デコードに使うスレッド数
+    :param grayscale: Trueの場合はグレースケールでデコードする
+    :return: (ページインデックス, 画像(読めない場合はNone))のジェネレータ
+    """
+    if isinstance(img_source, str):
+        img_source = DirectoryImageSource(img_source)
+    with ImagePrefetcher(page_indices, depth, workers, grayscale, img_source.read) as prefetcher:
+        yield from prefetcher
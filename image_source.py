@@ -0,0 +1,200 @@
+import os
+import re
+import threading
+import zipfile
+
+import cv2
+import numpy as np
+from batch_manifest import image_fingerprint
+from modules import index_to_img_path
+
+# 書庫(CBZ/ZIP)の拡張子(ディレクトリがない場合にこの順で探す)
+ARCHIVE_EXTENSIONS = (".cbz", ".zip")
+# ページ画像とみなすファイル名("005.jpg"のように番号がページインデックス)
+PAGE_IMAGE_PATTERN = re.compile(r"(\d+)\.(?:jpe?g|png)$", re.IGNORECASE)
+
+# プロセスごとに開いている書庫(書庫のパス -> (プロセスID, ZipFile, ページインデックス -> ZipInfo))
+_open_archives = {}
+# 複数のスレッドが同じ書庫を同時に開いてZipFileを重複して作らないようにするロック
+_open_archives_lock = threading.Lock()
+
+
+def _reset_archives_lock():
+    # fork時に他のスレッドが持っていたロックを子プロセスで作り直す
+    global _open_archives_lock
+    _open_archives_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_archives_lock)
+
+
+def _archive(archive_path):
+    """
+    書庫を開いてページ画像のメンバーの一覧を作る
+    同じプロセスでは開いたものを使い回し，fork後の子プロセスでは開き直す
+    :param archive_path: 書庫のパス
+    :return: (ZipFile, ページインデックス -> ZipInfoの辞書)
+    """
+    pid = os.getpid()
+    opened = _open_archives.get(archive_path)
+    if opened is None or opened[0] != pid:
+        with _open_archives_lock:
+            # ロックを待つ間に他のスレッドが開いた場合はそれを使う
+            opened = _open_archives.get(archive_path)
+            if opened is None or opened[0] != pid:
+                archive = zipfile.ZipFile(archive_path)
+                members = {}
+                for info in archive.infolist():
+                    match = PAGE_IMAGE_PATTERN.fullmatch(os.path.basename(info.filename))
+                    if match and not info.is_dir():
+                        members.setdefault(int(match.group(1)), info)
+                opened = _open_archives[archive_path] = (pid, archive, members)
+    return opened[1], opened[2]
+
+
+def close_archives():
+    """
+    このプロセスで開いている書庫を全て閉じる
+    """
+    pid = os.getpid()
+    with _open_archives_lock:
+        for opened_pid, archive, _ in _open_archives.values():
+            if opened_pid == pid:
+                archive.close()
+        _open_archives.clear()
+
+
+class DirectoryImageSource:
+    """
+    展開済みのディレクトリ(images/<タイトル>/NNN.jpg)からページ画像を読み込む
+    """
+
+    def __init__(self, img_folder_path):
+        """
+        :param img_folder_path: 画像フォルダのパス
+        """
+        self.img_folder_path = os.path.join(img_folder_path, "")
+
+    def img_path(self, page_index):
+        """
+        ページ画像のパスを取得
+        :param page_index: ページのインデックス
+        :return: 画像ファイルのパス
+        """
+        return index_to_img_path(page_index, self.img_folder_path)
+
+    def page_indices(self):
+        """
+        画像があるページのインデックスを取得
+        :return: ページのインデックスのリスト(昇順)
+        """
+        matches = (PAGE_IMAGE_PATTERN.fullmatch(name) for name in os.listdir(self.img_folder_path))
+        return sorted({int(match.group(1)) for match in matches if match})
+
+    def read(self, page_index, flags=cv2.IMREAD_COLOR):
+        """
+        ページ画像を読み込む
+        :param page_index: ページのインデックス
+        :param flags: cv2.imreadのフラグ
+        :return: 画像(読めない場合はNone)
+        """
+        return cv2.imread(self.img_path(page_index), flags)
+
+    def fingerprint(self, page_index, previous=None):
+        """
+        ページ画像の[サイズ, 更新時刻, SHA-1]を取得(batch_manifest.image_fingerprintを参照)
+        :param page_index: ページのインデックス
+        :param previous: 前回の記録
+        :return: [サイズ, 更新時刻, SHA-1]，画像がない場合はNone
+        """
+        return image_fingerprint(self.img_path(page_index), previous)
+
+    def __repr__(self):
+        return f"DirectoryImageSource({self.img_folder_path!r})"
+
+
+class ZipImageSource:
+    """
+    展開せずにCBZ/ZIPの書庫からページ画像を読み込む
+    メンバーのファイル名("NNN.jpg"，書庫内のフォルダは問わない)の番号をページインデックスとみなす
+    書庫はプロセスごとに1回だけ開き，画像はメモリ上のバイト列からcv2.imdecodeでデコードする
+    """
+
+    def __init__(self, archive_path):
+        """
+        :param archive_path: 書庫のパス
+        """
+        # 書庫のハンドルはオブジェクトに持たせない(ワーカープロセスへはパスだけが渡る)
+        self.archive_path = archive_path
+
+    @property
+    def members(self):
+        """
+        ページインデックス -> 書庫のメンバー(ZipInfo)の辞書
+        """
+        return _archive(self.archive_path)[1]
+
+    def img_path(self, page_index):
+        """
+        ページ画像の書庫内の位置を表す文字列を取得(表示・エラーメッセージ用)
+        :param page_index: ページのインデックス
+        :return: "書庫のパス/メンバー名"
+        """
+        info = self.members.get(page_index)
+        name = info.filename if info is not None else index_to_img_path(page_index, "")
+        return os.path.join(self.archive_path, name)
+
+    def page_indices(self):
+        """
+        画像があるページのインデックスを取得
+        :return: ページのインデックスのリスト(昇順)
+        """
+        return sorted(self.members)
+
+    def read(self, page_index, flags=cv2.IMREAD_COLOR):
+        """
+        ページ画像を書庫から読み込む
+        :param page_index: ページのインデックス
+        :param flags: cv2.imdecodeのフラグ
+        :return: 画像(ページがない・デコードできない場合はNone)
+        """
+        archive, members = _archive(self.archive_path)
+        info = members.get(page_index)
+        if info is None:
+            return None
+        data = archive.read(info)
+        return cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+
+    def fingerprint(self, page_index, previous=None):
+        """
+        ページ画像の[サイズ, 更新時刻, CRC-32]を書庫の目録から取得(画像を読み込まない)
+        :param page_index: ページのインデックス
+        :param previous: 前回の記録(使わない)
+        :return: [サイズ, 更新時刻, CRC-32]，ページがない場合はNone
+        """
+        info = self.members.get(page_index)
+        if info is None:
+            return None
+        return [info.file_size, list(info.date_time), f"{info.CRC:08x}"]
+
+    def __repr__(self):
+        return f"ZipImageSource({self.archive_path!r})"
+
+
+def open_image_source(manga109_img_dir, manga_title):
+    """
+    漫画タイトルのページ画像の読み込み元を取得
+    images/<タイトル>/ のディレクトリがあればそれを，なければ images/<タイトル>.cbz(.zip)の書庫を用いる
+    :param manga109_img_dir: 画像ファイルのディレクトリ
+    :param manga_title: 漫画のタイトル
+    :return: DirectoryImageSourceまたはZipImageSource
+    """
+    img_folder_path = os.path.join(manga109_img_dir, manga_title, "")
+    if os.path.isdir(img_folder_path):
+        return DirectoryImageSource(img_folder_path)
+    for extension in ARCHIVE_EXTENSIONS:
+        archive_path = os.path.join(manga109_img_dir, manga_title + extension)
+        if os.path.isfile(archive_path):
+            return ZipImageSource(archive_path)
+    # どちらもない場合はディレクトリとして扱う(読み込み時にNoneになる)
+    return DirectoryImageSource(img_folder_path)
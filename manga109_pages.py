@@ -0,0 +1,134 @@
+import os
+
+import cv2
+from annotation_loader import ANNOTATION_TYPES, load_annotation_table, page_objects
+from image_source import open_image_source
+
+# Manga109のディレクトリ(各スクリプトの既定値と同じ)
+MANGA109_ANO_DIR = "./../Manga109_released_2021_12_30/annotations.v2020.12.18/"
+MANGA109_IMG_DIR = "./../Manga109_released_2021_12_30/images/"
+
+
+class PageRecord:
+    """
+    1ページ分のアノテーションと画像への参照
+    画像は最初にimageを参照したときに読み込み，release()で解放する
+    """
+
+    __slots__ = ("title", "index", "width", "height", "img_source", "img_flags", "_table", "_image")
+
+    def __init__(self, title, index, width, height, img_source, table, img_flags=cv2.IMREAD_COLOR):
+        self.title = title
+        self.index = index
+        self.width = width
+        self.height = height
+        self.img_source = img_source
+        self.img_flags = img_flags
+        self._table = table
+        self._image = None
+
+    def objects(self, types=ANNOTATION_TYPES):
+        """
+        ページ内の指定したタグのバウンディングボックス情報を取得
+        :param types: 取得するタグのリスト
+        :return: バウンディングボックス情報(BBox)のリスト(文書順)
+        """
+        return page_objects(self._table, self.index, types)
+
+    @property
+    def panels(self):
+        """
+        コマのバウンディングボックス情報
+        """
+        return self.objects(["frame"])
+
+    @property
+    def texts(self):
+        """
+        テキスト(吹き出し)のバウンディングボックス情報
+        """
+        return self.objects(["text"])
+
+    @property
+    def img_path(self):
+        """
+        ページ画像のパス(書庫の場合は書庫内の位置)
+        """
+        return self.img_source.img_path(self.index)
+
+    @property
+    def image(self):
+        """
+        ページ画像(最初の参照時に読み込む，読めない場合はNone)
+        """
+        if self._image is None:
+            self._image = self.img_source.read(self.index, self.img_flags)
+        return self._image
+
+    @property
+    def image_loaded(self):
+        """
+        画像を読み込み済みか
+        """
+        return self._image is not None
+
+    def release(self):
+        """
+        読み込んだ画像を解放
+        """
+        self._image = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+        return False
+
+    def __repr__(self):
+        return f"PageRecord(title={self.title!r}, index={self.index}, img_path={self.img_path!r})"
+
+
+def _normalize_pages(pages):
+    """
+    ページの指定をインデックスの集合に変換
+    :param pages: ページのインデックス，"005"のような画像ファイル名の番号，またはそれらのリスト
+    :return: ページのインデックスの集合
+    """
+    if isinstance(pages, (int, str)):
+        pages = [pages]
+    return {int(page) for page in pages}
+
+
+def iter_pages(
+    manga_title,
+    pages=None,
+    manga109_ano_dir=MANGA109_ANO_DIR,
+    manga109_img_dir=MANGA109_IMG_DIR,
+    img_flags=cv2.IMREAD_COLOR,
+):
+    """
+    漫画タイトルのページを1ページずつ返すジェネレータ
+    pagesを指定した場合はページ位置の索引からそのページのアノテーションだけを読み込む
+    画像はPageRecord.imageを参照するまで読み込まない(画像フォルダがない場合は<タイトル>.cbz/.zipの書庫から読み込む)
+    :param manga_title: 漫画のタイトル
+    :param pages: ページのインデックス，"005"のような画像ファイル名の番号，またはそれらのリスト(Noneの場合は全ページ)
+    :param manga109_ano_dir: アノテーションファイルのディレクトリ
+    :param manga109_img_dir: 画像ファイルのディレクトリ
+    :param img_flags: 画像を読み込むときのcv2.imreadのフラグ
+    :return: PageRecordのジェネレータ(アノテーションの文書順，存在しないページは含まない)
+    """
+    ano_file_path = os.path.join(manga109_ano_dir, manga_title + ".xml")
+    img_source = open_image_source(manga109_img_dir, manga_title)
+    table = load_annotation_table(ano_file_path, pages=None if pages is None else _normalize_pages(pages))
+
+    for p, page_index in enumerate(table["page_index"].tolist()):
+        yield PageRecord(
+            manga_title,
+            page_index,
+            int(table["page_width"][p]),
+            int(table["page_height"][p]),
+            img_source,
+            table,
+            img_flags,
+        )
@@ -1,146 +1,59 @@
 import cv2
-import os
+import heapq
+import time
+import warnings
+from collections import OrderedDict
 import numpy as np
-import xml.etree.ElementTree as ET
+from profiler import count, profiled, stage
+from annotation_loader import load_annotation_table, table_to_page_objects
 
 
 # アノテーションファイルからページごとにオブジェクトのバウンディングボックス情報を取得
-def get_baundingbox_info_from_xml(xml_file):
+def get_baundingbox_info_from_xml(xml_file, pages=None):
     """
     xmlファイルからページごとにオブジェクトのバウンディングボックス情報を取得
     :param xml_file: アノテーションファイルのパス
+    :param pages: 読み込むページのインデックスのリスト(Noneの場合は全ページ)
     :return: ページごとのオブジェクトのバウンディングボックス情報
     """
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-    pages = root.findall(".//page")
-    page_objects = {}
-    for page in pages:
-        page_index = page.get("index")
-        # to int
-        page_index = int(page_index)
-        objects = []
-
-        for obj in page:
-            if obj.tag in ["frame", "text", "body", "face"]:
-                obj_data = {
-                    "type": obj.tag,
-                    "id": obj.get("id"),
-                    "xmin": obj.get("xmin"),
-                    "ymin": obj.get("ymin"),
-                    "xmax": obj.get("xmax"),
-                    "ymax": obj.get("ymax"),
-                }
-                objects.append(obj_data)
-
-        page_objects[page_index] = objects
-
-    return page_objects
+    return table_to_page_objects(load_annotation_table(xml_file, pages=pages), ["frame", "text", "body", "face"])
 
 
 # アノテーションファイルからページごとにパネルのバウンディングボックス情報を取得
-def get_panelbbox_info_from_xml(xml_file):
+def get_panelbbox_info_from_xml(xml_file, pages=None):
     """
     xmlファイルからページごとにパネルのバウンディングボックス情報を取得
     :param xml_file: アノテーションファイルのパス
+    :param pages: 読み込むページのインデックスのリスト(Noneの場合は全ページ)
     :return: ページごとのパネルのバウンディングボックス情報
     """
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-    pages = root.findall(".//page")
-    page_objects = {}
-    for page in pages:
-        page_index = page.get("index")
-        # to int
-        page_index = int(page_index)
-        objects = []
-
-        for obj in page:
-            if obj.tag in ["frame"]:
-                obj_data = {
-                    "type": obj.tag,
-                    "id": obj.get("id"),
-                    "xmin": obj.get("xmin"),
-                    "ymin": obj.get("ymin"),
-                    "xmax": obj.get("xmax"),
-                    "ymax": obj.get("ymax"),
-                }
-                objects.append(obj_data)
-
-        page_objects[page_index] = objects
-
-    return page_objects
+    return table_to_page_objects(load_annotation_table(xml_file, pages=pages), ["frame"])
 
 
 # アノテーションファイルからページごとにテキストのバウンディングボックスのみ情報を取得
-def get_textbbox_info_from_xml(xml_file):
+def get_textbbox_info_from_xml(xml_file, pages=None):
     """
     xmlファイルからページごとにテキストのバウンディングボックスのみ情報を取得
     :param xml_file: アノテーションファイルのパス
+    :param pages: 読み込むページのインデックスのリスト(Noneの場合は全ページ)
     :return: ページごとのテキストのバウンディングボックス情報
     """
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-    pages = root.findall(".//page")
-    page_objects = {}
-    for page in pages:
-        page_index = page.get("index")
-        # to int
-        page_index = int(page_index)
-        objects = []
+    return table_to_page_objects(load_annotation_table(xml_file, pages=pages), ["text"])
 
-        for obj in page:
-            if obj.tag in ["text"]:
-                obj_data = {
-                    "type": obj.tag,
-                    "id": obj.get("id"),
-                    "xmin": obj.get("xmin"),
-                    "ymin": obj.get("ymin"),
-                    "xmax": obj.get("xmax"),
-                    "ymax": obj.get("ymax"),
-                }
-                objects.append(obj_data)
 
-        page_objects[page_index] = objects
-
-    return page_objects
-
-
-def get_text_and_frame_bbox_info_from_xml(xml_file):
+def get_text_and_frame_bbox_info_from_xml(xml_file, pages=None):
     """
     xmlファイルからページごとにテキストとフレームのバウンディングボックス情報を取得
     :param xml_file: アノテーションファイルのパス
+    :param pages: 読み込むページのインデックスのリスト(Noneの場合は全ページ)
     :return: ページごとのテキストとフレームのバウンディングボックス情報
     """
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-    pages = root.findall(".//page")
-    page_objects = {}
-    for page in pages:
-        page_index = page.get("index")
-        # to int
-        page_index = int(page_index)
-        objects = []
-
-        for obj in page:
-            if obj.tag in ["text", "frame"]:
-                obj_data = {
-                    "type": obj.tag,
-                    "id": obj.get("id"),
-                    "xmin": obj.get("xmin"),
-                    "ymin": obj.get("ymin"),
-                    "xmax": obj.get("xmax"),
-                    "ymax": obj.get("ymax"),
-                }
-                objects.append(obj_data)
-
-        page_objects[page_index] = objects
-
-    return page_objects
+    return table_to_page_objects(load_annotation_table(xml_file, pages=pages), ["text", "frame"])
 
 
 # コマに内包されている吹き出しのバウンディングボックスを取得
 # デフォルト閾値は0.5
+@profiled("get_bounded_text")
 def get_bounded_text(panel_info, text_info, iou_threshold=0.5):
     """
     吹き出しのバウンディングボックスのうち、パネルに内包されているものを取得
@@ -232,6 +145,561 @@ def get_bouded_obj(panel, objs, iou_threshold=0.5):
     return bounded_objs
 
 
+def bboxes_to_array(objs):
+    """
+    バウンディングボックス情報のリストを座標配列に変換
+    :param objs: バウンディングボックス情報のリスト，または(N, 4)の座標配列
+    :return: xmin, ymin, xmax, ymaxを列にもつ(N, 4)のint64配列
+    """
+    if isinstance(objs, np.ndarray) or (len(objs) > 0 and not hasattr(objs[0], "keys")):
+        return np.asarray(objs).reshape(-1, 4).astype(np.int64, copy=False)
+    return np.array(
+        [[int(obj["xmin"]), int(obj["ymin"]), int(obj["xmax"]), int(obj["ymax"])] for obj in objs], dtype=np.int64
+    ).reshape(-1, 4)
+
+
+def containment_ratio_matrix(panels, objs):
+    """
+    全パネル×全オブジェクトについて，重なり面積/オブジェクト面積を一括で計算
+    get_bounded_text, get_bouded_objのIoUをページ単位でまとめて求める
+    :param panels: パネルのバウンディングボックス情報のリスト，または(P, 4)の座標配列
+    :param objs: オブジェクトのバウンディングボックス情報のリスト，または(O, 4)の座標配列
+    :return: (P, O)の比率行列(面積0のオブジェクトはnan)
+    """
+    panel_boxes = bboxes_to_array(panels)[:, None, :]
+    obj_boxes = bboxes_to_array(objs)[None, :, :]
+
+    # 重なっている領域の面積を計算
+    overlap_w = np.minimum(panel_boxes[..., 2], obj_boxes[..., 2]) - np.maximum(panel_boxes[..., 0], obj_boxes[..., 0])
+    overlap_h = np.minimum(panel_boxes[..., 3], obj_boxes[..., 3]) - np.maximum(panel_boxes[..., 1], obj_boxes[..., 1])
+    overlap_area = np.maximum(overlap_w, 0) * np.maximum(overlap_h, 0)
+
+    obj_area = (obj_boxes[..., 2] - obj_boxes[..., 0]) * (obj_boxes[..., 3] - obj_boxes[..., 1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = overlap_area / obj_area
+    ratio[:, obj_area[0] == 0] = np.nan
+    return ratio
+
+
+def assign_objs_to_panels(panels, objs, iou_threshold=0.5, best_only=False):
+    """
+    ページ内の全パネルについて，内包されているオブジェクトのインデックスを一括で取得
+    :param panels: パネルのバウンディングボックス情報のリスト，または(P, 4)の座標配列
+    :param objs: オブジェクトのバウンディングボックス情報のリスト，または(O, 4)の座標配列
+    :param iou_threshold: IoUの閾値
+    :param best_only: Trueの場合，各オブジェクトを比率が最大のパネル(同率なら先頭)にのみ割り当てる
+    :return: パネルごとのオブジェクトのインデックス配列のリスト
+    """
+    ratio = containment_ratio_matrix(panels, objs)
+    with np.errstate(invalid="ignore"):
+        assigned = ratio >= iou_threshold
+    if best_only and ratio.shape[0] > 0:
+        best_panel = np.argmax(np.nan_to_num(ratio, nan=-np.inf), axis=0)
+        assigned &= np.arange(ratio.shape[0])[:, None] == best_panel[None, :]
+    return [np.flatnonzero(row) for row in assigned]
+
+
+def build_grid_index(objs, cell_size=None):
+    """
+    オブジェクトのバウンディングボックスから一様グリッドの空間インデックスを作成
+    各セルに重なるオブジェクトのインデックスをセル番号順に並べて持つ(CSR形式)
+    :param objs: オブジェクトのバウンディングボックス情報のリスト，または(O, 4)の座標配列
+    :param cell_size: セルの一辺の長さ(Noneの場合はオブジェクトの大きさの中央値の2倍)
+    :return: 空間インデックス
+    """
+    boxes = bboxes_to_array(objs)
+    # xmax < xminまたはymax < yminのボックス(検出結果や手で修正したアノテーションにある)は
+    # どのパネルとも重なり面積が0になるのでセルに登録しない
+    valid = (boxes[:, 2] >= boxes[:, 0]) & (boxes[:, 3] >= boxes[:, 1])
+    valid_boxes = boxes[valid]
+    if cell_size is None:
+        sides = np.maximum(valid_boxes[:, 2] - valid_boxes[:, 0], valid_boxes[:, 3] - valid_boxes[:, 1])
+        cell_size = max(1, int(2 * np.median(sides))) if len(valid_boxes) else 1
+    origin = valid_boxes[:, :2].min(axis=0) if len(valid_boxes) else np.zeros(2, dtype=np.int64)
+    extent = valid_boxes[:, 2:].max(axis=0) if len(valid_boxes) else np.zeros(2, dtype=np.int64)
+    n_cells = (extent - origin) // cell_size + 1
+
+    # オブジェクトが重なるセルの範囲
+    cell_min = np.clip((boxes[:, :2] - origin) // cell_size, 0, n_cells - 1)
+    cell_max = np.clip((boxes[:, 2:] - origin) // cell_size, 0, n_cells - 1)
+    spans = np.where(valid[:, None], cell_max - cell_min + 1, 0)
+    counts = spans[:, 0] * spans[:, 1]
+
+    # (セル番号, オブジェクト)の組を全て列挙してセル番号順に並べる
+    obj_ids = np.repeat(np.arange(len(boxes)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cell_x = cell_min[obj_ids, 0] + local % spans[obj_ids, 0]
+    cell_y = cell_min[obj_ids, 1] + local // spans[obj_ids, 0]
+    cell_ids = cell_y * n_cells[0] + cell_x
+    order = np.argsort(cell_ids, kind="stable")
+    cell_starts = np.searchsorted(cell_ids[order], np.arange(n_cells[0] * n_cells[1] + 1))
+
+    return {
+        "boxes": boxes,
+        "cell_size": cell_size,
+        "origin": origin,
+        "n_cells": n_cells,
+        "cell_starts": cell_starts,
+        "cell_objs": obj_ids[order],
+    }
+
+
+def query_grid_index(index, rect):
+    """
+    矩形と重なる可能性のあるオブジェクトのインデックスを空間インデックスから取得
+    :param index: build_grid_indexで作成した空間インデックス
+    :param rect: 矩形(xmin, ymin, xmax, ymax)
+    :return: 候補のオブジェクトのインデックス配列(昇順)
+    """
+    origin, cell_size, n_cells = index["origin"], index["cell_size"], index["n_cells"]
+    rect = np.asarray(rect, dtype=np.int64)
+    # 反転した矩形はどのオブジェクトとも重ならない
+    if len(index["boxes"]) == 0 or np.any(rect[2:] < rect[:2]) or np.any(rect[2:] < origin) or np.any((rect[:2] - origin) // cell_size >= n_cells):
+        return np.zeros(0, dtype=np.int64)
+    cell_min = np.clip((rect[:2] - origin) // cell_size, 0, n_cells - 1)
+    cell_max = np.clip((rect[2:] - origin) // cell_size, 0, n_cells - 1)
+
+    # セル番号順に並んでいるので，1行分のセルは連続した区間になる
+    starts, cell_objs = index["cell_starts"], index["cell_objs"]
+    segments = []
+    for cell_y in range(cell_min[1], cell_max[1] + 1):
+        first = cell_y * n_cells[0] + cell_min[0]
+        last = cell_y * n_cells[0] + cell_max[0]
+        segments.append(cell_objs[starts[first] : starts[last + 1]])
+    return np.unique(np.concatenate(segments))
+
+
+def assign_objs_to_panels_indexed(panels, objs, iou_threshold=0.5, best_only=False, index=None):
+    """
+    空間インデックスで候補を絞り込んでから，パネルに内包されているオブジェクトのインデックスを取得
+    結果はassign_objs_to_panelsと一致する(iou_threshold <= 0の場合は全オブジェクトが候補になるため密な計算を行う)
+    :param panels: パネルのバウンディングボックス情報のリスト，または(P, 4)の座標配列
+    :param objs: オブジェクトのバウンディングボックス情報のリスト，または(O, 4)の座標配列
+    :param iou_threshold: IoUの閾値
+    :param best_only: Trueの場合，各オブジェクトを比率が最大のパネル(同率なら先頭)にのみ割り当てる
+    :param index: build_grid_indexで作成した空間インデックス(Noneの場合は作成する)
+    :return: パネルごとのオブジェクトのインデックス配列のリスト
+    """
+    if iou_threshold <= 0:
+        return assign_objs_to_panels(panels, objs, iou_threshold, best_only)
+    if index is None:
+        index = build_grid_index(objs)
+    panel_boxes = bboxes_to_array(panels)
+    boxes = index["boxes"]
+
+    # 候補についてのみ重なり面積/オブジェクト面積を計算
+    candidates = []
+    ratios = []
+    for panel_box in panel_boxes:
+        candidate = query_grid_index(index, panel_box)
+        candidates.append(candidate)
+        ratios.append(containment_ratio_matrix(panel_box[None, :], boxes[candidate])[0])
+
+    if best_only:
+        # パネル順に比率が大きいものだけを更新するので，同率なら先頭のパネルになる
+        best_ratio = np.full(len(boxes), -np.inf)
+        best_panel = np.full(len(boxes), -1)
+        for p, (candidate, ratio) in enumerate(zip(candidates, ratios)):
+            better = ratio > best_ratio[candidate]
+            best_ratio[candidate[better]] = ratio[better]
+            best_panel[candidate[better]] = p
+
+    assigned = []
+    for p, (candidate, ratio) in enumerate(zip(candidates, ratios)):
+        with np.errstate(invalid="ignore"):
+            keep = ratio >= iou_threshold
+        if best_only:
+            keep &= best_panel[candidate] == p
+        assigned.append(candidate[keep])
+    return assigned
+
+
+# 空間インデックスを使うパネル数×オブジェクト数の下限(これより少ない場合は密な計算の方が速い)
+GRID_INDEX_MIN_PAIRS = 1_000_000
+
+
+@profiled("assign_objects")
+def get_bounded_objs_page(panels, objs, iou_threshold=0.5, best_only=False, use_index=None):
+    """
+    ページ内の全パネルについて，内包されているオブジェクトのバウンディングボックス情報を一括で取得
+    best_only=Falseの場合，各パネルの結果はget_bounded_text, get_bouded_objと一致する
+    :param panels: パネルのバウンディングボックス情報のリスト
+    :param objs: オブジェクトのバウンディングボックス情報のリスト
+    :param iou_threshold: IoUの閾値
+    :param best_only: Trueの場合，各オブジェクトを比率が最大のパネルにのみ割り当てる
+    :param use_index: Trueの場合，空間インデックスで候補を絞り込む(オブジェクトの多いページ向け)
+                      Noneの場合はパネル数×オブジェクト数がGRID_INDEX_MIN_PAIRS以上のときだけ使う
+    :return: パネルごとの内包されているオブジェクトのバウンディングボックス情報のリスト
+    """
+    if use_index is None:
+        use_index = len(panels) * len(objs) >= GRID_INDEX_MIN_PAIRS
+    if use_index:
+        assigned = assign_objs_to_panels_indexed(panels, objs, iou_threshold, best_only)
+    else:
+        assigned = assign_objs_to_panels(panels, objs, iou_threshold, best_only)
+    return [[objs[i] for i in indices] for indices in assigned]
+
+
+@profiled("pseudo_regions")
+def compute_pseudo_regions(frames):
+    """
+    コマ同士の重なりから擬似的なコマ領域を計算
+    他のコマと重なっているコマは，重なり領域の平均の中央のx座標をxmaxとする
+    全てのコマの組の重なりをブロードキャストで一括計算する
+    :param frames: コマのバウンディングボックス情報のリスト，または(N, 4)の座標配列
+    :return: 擬似的なコマ領域の配列(xmin, ymin, xmax, ymax)，重なりがなければ整数配列
+    """
+    boxes = bboxes_to_array(frames)
+    n = len(boxes)
+    if n == 0:
+        return np.array([])
+
+    # 重なりを計算
+    overlap_min = np.maximum(boxes[:, None, :2], boxes[None, :, :2])
+    overlap_max = np.minimum(boxes[:, None, 2:], boxes[None, :, 2:])
+    overlapped = (overlap_max > overlap_min).all(axis=2)
+    np.fill_diagonal(overlapped, False)
+    counts = overlapped.sum(axis=1)
+    if not counts.any():
+        return boxes.copy()
+
+    # 重なりがある場合、重なり領域の平均から擬似的なコマ領域を計算
+    has_overlap = counts > 0
+    counts = counts[has_overlap]
+    mean_xmin = (overlap_min[has_overlap, :, 0] * overlapped[has_overlap]).sum(axis=1) / counts
+    mean_xmax = (overlap_max[has_overlap, :, 0] * overlapped[has_overlap]).sum(axis=1) / counts
+    pseudo_regions = boxes.astype(np.float64)
+    pseudo_regions[has_overlap, 2] = (mean_xmin + mean_xmax) / 2
+    return pseudo_regions
+
+
+# 厳密解法(ビットDP)を使う経由点数の上限
+HELD_KARP_LIMIT = 16
+# 分枝限定法で展開する部分経路数の上限
+BRANCH_AND_BOUND_MAX_EXPANSIONS = 50000
+# ビームサーチの最初のビーム幅(予算が残っている間は2倍ずつ広げる)
+BEAM_INITIAL_WIDTH = 4
+# 経過時間を確認する展開数の間隔
+BEAM_CLOCK_INTERVAL = 64
+
+
+def _path_length(dist_matrix, path):
+    """
+    経路の総距離を計算
+    :param dist_matrix: 各点間の距離行列
+    :param path: 点のインデックスのリスト
+    :return: 経路の総距離
+    """
+    return float(sum(dist_matrix[path[i], path[i + 1]] for i in range(len(path) - 1)))
+
+
+def _held_karp_path(dist_matrix):
+    """
+    ビットDPで始点0・終点N-1を固定した最短ハミルトン路を求める
+    最短経路が複数ある場合は経由点の並びが辞書順で最小のもの(全順列を列挙した場合と同じ)を返す
+    :param dist_matrix: 各点間の距離行列(N×N)
+    :return: 最短経路のインデックスのリスト
+    """
+    N = dist_matrix.shape[0]
+    m = N - 2
+    end = N - 1
+    full = (1 << m) - 1
+    D = dist_matrix[1:-1, 1:-1]
+    # h[mask, i]: 経由点iにいて，mask外の経由点を全て通って終点に着くまでの最短距離
+    h = np.full((1 << m, m), np.inf)
+    h[full] = dist_matrix[1:-1, end]
+    # 経由点の個数が多い部分集合から順に，同じ個数の部分集合をまとめて計算する
+    masks = np.arange(1 << m)
+    popcount = np.zeros(1 << m, dtype=np.int64)
+    for j in range(m):
+        popcount += (masks >> j) & 1
+    for size in range(m - 1, -1, -1):
+        layer = masks[popcount == size]
+        for j in range(m):
+            rows = layer[(layer >> j) & 1 == 0]
+            h[rows] = np.minimum(h[rows], D[:, j] + h[rows | (1 << j), j][:, None])
+
+    # 始点から辞書順に最短経路を復元
+    eps = 1e-9 * max(1.0, float(dist_matrix.max()))
+    mask = 0
+    current = 0
+    remaining = min(dist_matrix[0, j + 1] + h[1 << j, j] for j in range(m))
+    path = [0]
+    while mask != full:
+        for j in range(m):
+            if mask & (1 << j):
+                continue
+            step = dist_matrix[current, j + 1]
+            if step + h[mask | (1 << j), j] <= remaining + eps:
+                remaining -= step
+                mask |= 1 << j
+                current = j + 1
+                path.append(current)
+                break
+    path.append(end)
+    return path
+
+
+def _greedy_path(dist_matrix):
+    """
+    最近傍法と2-optで始点0・終点N-1を固定した経路の近似解を求める
+    :param dist_matrix: 各点間の距離行列(N×N)
+    :return: 経路のインデックスのリスト
+    """
+    N = dist_matrix.shape[0]
+    unvisited = list(range(1, N - 1))
+    path = [0]
+    while unvisited:
+        nearest = min(unvisited, key=lambda j: dist_matrix[path[-1], j])
+        path.append(nearest)
+        unvisited.remove(nearest)
+    path.append(N - 1)
+    return _two_opt(dist_matrix, path)
+
+
+def _two_opt(dist_matrix, path):
+    """
+    2-optで改善がなくなるまで経路の区間を反転する(始点と終点は固定)
+    :param dist_matrix: 各点間の距離行列(N×N)
+    :param path: 経路のインデックスのリスト(書き換える)
+    :return: 改善した経路のインデックスのリスト
+    """
+    N = dist_matrix.shape[0]
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, N - 2):
+            for k in range(i + 1, N - 1):
+                a, b = path[i - 1], path[i]
+                c, d = path[k], path[k + 1]
+                delta = dist_matrix[a, c] + dist_matrix[b, d] - dist_matrix[a, b] - dist_matrix[c, d]
+                if delta < -1e-12:
+                    path[i : k + 1] = path[i : k + 1][::-1]
+                    improved = True
+    return path
+
+
+def _path_lower_bound(inf_diag, current, unvisited, end):
+    """
+    部分経路の残りの距離の下界(未訪問点と終点それぞれへの最小流入距離の和)を計算
+    :param inf_diag: 対角成分を無限大にした距離行列
+    :param current: 部分経路の最後の点
+    :param unvisited: 未訪問の経由点のリスト
+    :param end: 終点
+    :return: 残りの距離の下界
+    """
+    sources = unvisited + [current]
+    targets = unvisited + [end]
+    return inf_diag[np.ix_(sources, targets)].min(axis=0).sum()
+
+
+def _branch_and_bound_path(dist_matrix, max_expansions=BRANCH_AND_BOUND_MAX_EXPANSIONS):
+    """
+    分枝限定法で始点0・終点N-1を固定した最短ハミルトン路を求める
+    未訪問点と終点それぞれへの最小流入距離の和を下界として枝刈りする
+    展開数が上限に達した場合はそれまでの最良解(少なくとも最近傍法+2-optの解)と，未探索の部分経路の下界から求めた最短距離の下界を返す
+    :param dist_matrix: 各点間の距離行列(N×N)
+    :param max_expansions: 展開する部分経路数の上限
+    :return: (経路のインデックスのリスト, 最適性が保証されているか, 最短距離の下界)
+    """
+    N = dist_matrix.shape[0]
+    end = N - 1
+    best_path = _greedy_path(dist_matrix)
+    best_dist = _path_length(dist_matrix, best_path)
+    eps = 1e-9 * max(1.0, float(dist_matrix.max()))
+    # 自分自身への距離は下界計算から除外
+    inf_diag = dist_matrix + np.diag(np.full(N, np.inf))
+    expansions = 0
+    exhausted = True
+
+    # (経路, 距離, 未訪問点) のスタックで深さ優先探索
+    stack = [([0], 0.0, list(range(1, N - 1)))]
+    while stack:
+        path, dist, unvisited = stack.pop()
+        if not unvisited:
+            total = dist + dist_matrix[path[-1], end]
+            if total < best_dist - eps:
+                best_dist = total
+                best_path = path + [end]
+            continue
+        if expansions >= max_expansions:
+            exhausted = False
+            stack.append((path, dist, unvisited))
+            break
+        expansions += 1
+        if dist + _path_lower_bound(inf_diag, path[-1], unvisited, end) >= best_dist - eps:
+            continue
+        # 近い点から探索するため，遠い順にスタックへ積む
+        children = sorted(unvisited, key=lambda j: dist_matrix[path[-1], j], reverse=True)
+        for j in children:
+            stack.append((path + [j], dist + dist_matrix[path[-1], j], [u for u in unvisited if u != j]))
+
+    count("solver_states", expansions)
+    lower_bound = best_dist
+    for path, dist, unvisited in stack:
+        lower_bound = min(lower_bound, dist + _path_lower_bound(inf_diag, path[-1], unvisited, end))
+    return best_path, exhausted, lower_bound
+
+
+def shortest_path_params():
+    """
+    shortest_hamiltonian_pathの結果に影響する設定(結果のキャッシュのキーに含める)
+    :return: exact_limit, max_expansionsの辞書
+    """
+    return {"exact_limit": HELD_KARP_LIMIT, "max_expansions": BRANCH_AND_BOUND_MAX_EXPANSIONS}
+
+
+def shortest_hamiltonian_path(dist_matrix, exact_limit=None, max_expansions=None, return_optimal=False):
+    """
+    始点を0，終点をN-1に固定し，全ての点を1度ずつ通る最短経路を求める
+    経由点がexact_limit個以下ならビットDP，それより多い場合は分枝限定法を用いる
+    分枝限定法の展開数が上限に達した場合はそれまでの最良解を返すため，最短とは限らない
+    (この場合はカウンタsolver_truncatedを加算し，最短距離との差の上限を警告する)
+    :param dist_matrix: 各点間の距離行列(N×N)
+    :param exact_limit: ビットDPを用いる経由点数の上限(Noneの場合はHELD_KARP_LIMIT)
+    :param max_expansions: 分枝限定法で展開する部分経路数の上限(Noneの場合はBRANCH_AND_BOUND_MAX_EXPANSIONS)
+    :param return_optimal: Trueの場合，最短であることが保証されているかも返す
+    :return: 経路のインデックスのリスト(先頭は0，末尾はN-1)，return_optimalがTrueの場合は(経路, 最短であることが保証されているか)
+    """
+    if exact_limit is None:
+        exact_limit = HELD_KARP_LIMIT
+    if max_expansions is None:
+        max_expansions = BRANCH_AND_BOUND_MAX_EXPANSIONS
+    dist_matrix = np.asarray(dist_matrix, dtype=float)
+    N = dist_matrix.shape[0]
+    if N <= 3:
+        path, exhausted = list(range(N)), True
+    elif N - 2 <= exact_limit:
+        # ビットDPの状態数(経由点の部分集合×最後の点)
+        count("solver_states", (N - 2) << (N - 2))
+        path, exhausted = _held_karp_path(dist_matrix), True
+    else:
+        path, exhausted, lower_bound = _branch_and_bound_path(dist_matrix, max_expansions)
+        if not exhausted:
+            # 展開数の上限で打ち切ったため最適性が保証されない
+            count("solver_truncated")
+            length = _path_length(dist_matrix, path)
+            gap = (length - lower_bound) / length if length > 0 else 0.0
+            warnings.warn(
+                f"shortest_hamiltonian_path: search over {N - 2} via points stopped after {max_expansions} expansions, "
+                f"path may be up to {gap:.1%} longer than the shortest",
+                stacklevel=2,
+            )
+    return (path, exhausted) if return_optimal else path
+
+
+class _SearchBudget:
+    """
+    探索の時間・展開数の予算
+    """
+
+    __slots__ = ("deadline", "max_expansions", "expansions")
+
+    def __init__(self, time_budget=None, max_expansions=None):
+        self.deadline = None if time_budget is None else time.perf_counter() + time_budget
+        self.max_expansions = max_expansions
+        self.expansions = 0
+
+    def spend(self):
+        """
+        1回分の展開を記録
+        :return: 予算が残っているか
+        """
+        self.expansions += 1
+        if self.max_expansions is not None and self.expansions > self.max_expansions:
+            return False
+        if self.deadline is not None and self.expansions % BEAM_CLOCK_INTERVAL == 0:
+            return time.perf_counter() < self.deadline
+        return True
+
+
+def _beam_pass(dist_matrix, width, budget):
+    """
+    ビーム幅widthで始点0・終点N-1を固定した経路を探索
+    (訪問済みの経由点の集合, 最後の点)が同じ部分経路は距離が最短のもの(同じ場合は辞書順で最小のもの)だけを残し，
+    各深さでは距離が短い順にwidth個の状態を残す
+    :param dist_matrix: 各点間の距離行列(N×N)
+    :param width: ビーム幅
+    :param budget: 探索の予算(_SearchBudget)
+    :return: (経路のインデックスのリスト, 状態を切り捨てたか)，予算が尽きた場合はNone
+    """
+    N = dist_matrix.shape[0]
+    end = N - 1
+    eps = 1e-9 * max(1.0, float(dist_matrix.max()))
+    dist = dist_matrix.tolist()
+    truncated = False
+    # (訪問済みのビット集合, 最後の点) -> (距離, 経路)
+    beam = {(0, 0): (0.0, (0,))}
+    for _ in range(N - 2):
+        expanded = {}
+        for (mask, last), (cost, path) in beam.items():
+            row = dist[last]
+            for j in range(1, N - 1):
+                if mask & (1 << j):
+                    continue
+                if not budget.spend():
+                    return None
+                key = (mask | (1 << j), j)
+                state = (cost + row[j], path + (j,))
+                known = expanded.get(key)
+                if known is None or state[0] < known[0] - eps or (state[0] <= known[0] + eps and state[1] < known[1]):
+                    expanded[key] = state
+        if len(expanded) > width:
+            truncated = True
+            expanded = dict(heapq.nsmallest(width, expanded.items(), key=lambda item: item[1]))
+        beam = expanded
+
+    best_dist, best_path = np.inf, None
+    for (_, last), (cost, path) in beam.items():
+        total = cost + dist[last][end]
+        if total < best_dist - eps or (total <= best_dist + eps and path < best_path):
+            best_dist, best_path = total, path
+    return list(best_path) + [end], truncated
+
+
+def beam_search_path(dist_matrix, time_budget=None, max_expansions=None, initial_width=BEAM_INITIAL_WIDTH):
+    """
+    始点を0，終点をN-1に固定し，全ての点を1度ずつ通る経路を予算内でビームサーチにより求める
+    最近傍法+2-optの解から始め，予算が残っている間はビーム幅を2倍ずつ広げて探索し直す(anytime)
+    状態を1つも切り捨てずに探索が終わった場合はビットDPと同じ結果(最短経路)になる
+    :param dist_matrix: 各点間の距離行列(N×N)
+    :param time_budget: 探索時間の上限[秒](Noneの場合は制限しない)
+    :param max_expansions: 展開する部分経路数の上限(Noneの場合は制限しない)
+    :param initial_width: 最初のビーム幅
+    :return: (予算内で見つかった最良の経路のインデックスのリスト, 最短であることが保証されているか)
+    :raises ValueError: 経由点がHELD_KARP_LIMIT個より多いのに予算が両方ともNoneの場合(探索時間に上限がなくなるため)
+    """
+    dist_matrix = np.asarray(dist_matrix, dtype=float)
+    N = dist_matrix.shape[0]
+    if N <= 3:
+        return list(range(N)), True
+    if time_budget is None and max_expansions is None and N - 2 > HELD_KARP_LIMIT:
+        raise ValueError(f"beam_search_path needs time_budget or max_expansions for {N - 2} via points")
+    budget = _SearchBudget(time_budget, max_expansions)
+    best_path = _greedy_path(dist_matrix)
+    best_dist = _path_length(dist_matrix, best_path)
+    eps = 1e-9 * max(1.0, float(dist_matrix.max()))
+    inf_diag = dist_matrix + np.diag(np.full(N, np.inf))
+    optimal = best_dist <= _path_lower_bound(inf_diag, 0, list(range(1, N - 1)), N - 1) + eps
+
+    width = initial_width
+    while not optimal:
+        result = _beam_pass(dist_matrix, width, budget)
+        if result is None:
+            break
+        path, truncated = result
+        if not truncated:
+            best_path, optimal = path, True
+        else:
+            path = _two_opt(dist_matrix, path)
+            if _path_length(dist_matrix, path) < best_dist - eps:
+                best_path, best_dist = path, _path_length(dist_matrix, path)
+        width *= 2
+
+    count("solver_states", budget.expansions)
+    return best_path, optimal
+
+
 # 画像ファイル名をインデックスから取得
 def index_to_img_path(index, img_folder_path):
     """
@@ -277,16 +745,24 @@ def draw_bbox(img, page_objects, output_path):
     cv2.destroyAllWindows()
 
 
-def extractSpeechBalloon(img):
+# 吹き出し検出の結果が変わる変更をしたら上げる
+EXTRACT_BALLOON_VERSION = 1
+# 吹き出し検出のパラメータ
+BALLOON_BINARY_THRESHOLD = 230
+BALLOON_KERNEL_SIZE = 3
+BALLOON_MIN_AREA_RATIO = 0.001
+BALLOON_MAX_AREA_RATIO = 0.05
+BALLOON_MIN_CIRCULARITY = 0.0
+
+
+def binarize_for_balloons(img, threshold=BALLOON_BINARY_THRESHOLD, kernel_size=BALLOON_KERNEL_SIZE):
     """
-    画像から輪郭検出して吹き出しを抽出
-    :param img: 画像
-    :return: 吹き出しのバウンディングボックス情報
+    吹き出し検出用に画像を二値化し，収縮・膨張でノイズを除去
+    :param img: 画像(カラーまたはグレースケール)
+    :param threshold: 二値化の閾値
+    :param kernel_size: 収縮・膨張のカーネルサイズ
+    :return: (グレースケール画像, 二値画像)
     """
-    speech_balloons = []
-    if img is None:
-        return None
-
     # 画像がカラーの場合はグレースケールに変換
     if len(img.shape) == 3:
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -294,46 +770,237 @@ def extractSpeechBalloon(img):
         gray = img
 
     # 画像の二値化
-    binary = cv2.threshold(gray, 230, 255, cv2.THRESH_BINARY)[1]
-    gaussian_img = cv2.GaussianBlur(gray, (3, 3), 0)
-    kernel = np.ones((3, 3), np.uint8)
+    binary = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY)[1]
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
     binary = cv2.erode(binary, kernel, (-1, -1), iterations=1)
     binary = cv2.dilate(binary, kernel, (-1, -1), iterations=1)
+    return gray, binary
+
+
+def contour_feature_table(contours, gray, ratio_area_range=(0.0, np.inf)):
+    """
+    輪郭ごとの特徴量を表にまとめる
+    白黒比は面積がratio_area_rangeの範囲にある輪郭についてのみ，その輪郭のバウンディングボックス内で計算する
+    :param contours: 輪郭のリスト
+    :param gray: グレースケール画像
+    :param ratio_area_range: 白黒比を計算する輪郭の面積の範囲(lower <= 面積 < upper)
+    :return: 特徴量の配列の辞書
+        x, y, w, h: バウンディングボックス
+        area: 面積, perimeter: 周囲長, circularity: 円形度(4πS/L^2)
+        white_ratio: 輪郭内の白画素/(白画素+黒画素)(未計算の輪郭はnan)
+    """
+    n = len(contours)
+    rects = np.array([cv2.boundingRect(contour) for contour in contours], dtype=np.int64).reshape(n, 4)
+    area = np.array([cv2.contourArea(contour) for contour in contours], dtype=np.float64)
+    perimeter = np.array([cv2.arcLength(contour, True) for contour in contours], dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        circularity = np.where(perimeter > 0, 4.0 * np.pi * area / (perimeter * perimeter), 0.0)
+
+    # 白黒比は輪郭のバウンディングボックス内だけで計算
+    white_ratio = np.full(n, np.nan)
+    for i in np.flatnonzero((ratio_area_range[0] <= area) & (area < ratio_area_range[1])):
+        x, y, w, h = rects[i]
+        mask = np.zeros((h, w), np.uint8)
+        cv2.drawContours(mask, [contours[i]], -1, 255, thickness=-1, offset=(-int(x), -int(y)))
+        inside = gray[y : y + h, x : x + w][mask > 0]
+        white_pixel = np.count_nonzero(inside == 255)
+        black_pixel = np.count_nonzero(inside == 0)
+        white_ratio[i] = white_pixel / (white_pixel + black_pixel) if white_pixel + black_pixel > 0 else 0.0
+
+    return {
+        "x": rects[:, 0],
+        "y": rects[:, 1],
+        "w": rects[:, 2],
+        "h": rects[:, 3],
+        "area": area,
+        "perimeter": perimeter,
+        "circularity": circularity,
+        "white_ratio": white_ratio,
+    }
+
+
+def filter_balloon_features(
+    features,
+    page_area,
+    min_area_ratio=BALLOON_MIN_AREA_RATIO,
+    max_area_ratio=BALLOON_MAX_AREA_RATIO,
+    min_circularity=BALLOON_MIN_CIRCULARITY,
+    white_ratio_range=None,
+):
+    """
+    特徴量の表に吹き出しの条件をまとめて適用
+    :param features: contour_feature_tableの戻り値
+    :param page_area: ページの面積
+    :param min_area_ratio: ページ面積に対する最小面積比
+    :param max_area_ratio: ページ面積に対する最大面積比
+    :param min_circularity: 円形度の下限(この値より大きいものを残す)
+    :param white_ratio_range: 白黒比の範囲(lower, upper)，Noneの場合は判定しない
+    :return: 吹き出しとみなす輪郭のbool配列
+    """
+    area = features["area"]
+    keep = (page_area * min_area_ratio <= area) & (area < page_area * max_area_ratio)
+    keep &= features["circularity"] > min_circularity
+    if white_ratio_range is not None:
+        with np.errstate(invalid="ignore"):
+            keep &= (features["white_ratio"] > white_ratio_range[0]) & (features["white_ratio"] < white_ratio_range[1])
+    return keep
+
+
+@profiled("extract_balloons")
+def extractSpeechBalloon(img):
+    """
+    画像から輪郭検出して吹き出しを抽出
+    :param img: 画像
+    :return: 吹き出しのバウンディングボックス情報
+    """
+    if img is None:
+        return None
+
+    gray, binary = binarize_for_balloons(img)
     contours, _ = cv2.findContours(binary, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
-    mask = np.zeros_like(binary)
-    for contour in contours:
-        # バウンディングボックスの座標を取得
-        x, y, w, h = cv2.boundingRect(contour)
-        area = cv2.contourArea(contour)
-        length = cv2.arcLength(contour, True)
-        en = 0.0
-        if (
-            gaussian_img.shape[0] * gaussian_img.shape[1] * 0.001 <= area
-            and area < gaussian_img.shape[0] * gaussian_img.shape[1] * 0.05
-        ):
-            en = 4.0 * np.pi * area / (length * length)
-
-        # 一定のサイズ以上の輪郭のみを吹き出しとみなす
-        if en > 0.0:
-            cv2.drawContours(mask, [contour], -1, 255, -1)
-            masked_img = cv2.bitwise_and(img, img, mask=mask)
-            # cv2.imshow("masked_img", masked_img)
-            # cv2.waitKey(0)
-            # cv2.destroyAllWindows()
-            # 白黒比
-            white_pixel = np.sum(masked_img == 255)
-            black_pixel = np.sum(masked_img == 0)
-            # 白黒比を計算
-            if black_pixel + white_pixel > 0:
-                white_black_ratio = white_pixel / (black_pixel + white_pixel)
-            else:
-                white_black_ratio = 0
-            # cv2.imshow("masked_img", masked_img)
-            # cv2.waitKey(0)
-            # cv2.destroyAllWindows()
-            # if white_black_ratio > 0.01 and white_black_ratio < 0.15:
-            #     print(f"white_black_ratio: {white_black_ratio}")
-            speech_bubble = {"type": "text", "xmin": str(x), "ymin": str(y), "xmax": str(x + w), "ymax": str(y + h)}
-            speech_balloons.append(speech_bubble)
+    page_area = gray.shape[0] * gray.shape[1]
+    count("contours", len(contours))
+
+    # 一定のサイズ以上の輪郭のみを吹き出しとみなす
+    # 白黒比の条件は使わないので計算しない(面積の範囲を空にする)
+    features = contour_feature_table(contours, gray, ratio_area_range=(0.0, 0.0))
+    keep = filter_balloon_features(features, page_area)
+
+    speech_balloons = []
+    for i in np.flatnonzero(keep):
+        x, y, w, h = (int(features[key][i]) for key in ("x", "y", "w", "h"))
+        speech_bubble = {"type": "text", "xmin": str(x), "ymin": str(y), "xmax": str(x + w), "ymax": str(y + h)}
+        speech_balloons.append(speech_bubble)
+
+    count("balloons_detected", len(speech_balloons))
+    return speech_balloons
+
+
+# 縮小読み込みに使うフラグ(縮小率の逆数 -> フラグ)
+REDUCED_GRAYSCALE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def extractSpeechBalloon_scaled(img=None, img_path=None, scale=0.5):
+    """
+    縮小した画像で吹き出しを検出し，バウンディングボックスを元の解像度の座標に戻す
+    img_pathを指定し，1/scaleが2, 4, 8のいずれかの場合はデコード時に縮小する(IMREAD_REDUCED_GRAYSCALE_*)
+    面積の条件はページ面積に対する比なので縮小しても変わらないが，収縮・膨張のカーネルは相対的に大きくなる
+    :param img: 画像(img_pathを指定する場合は不要)
+    :param img_path: 画像ファイルのパス
+    :param scale: 縮小率(0 < scale <= 1)
+    :return: 吹き出しのバウンディングボックス情報(元の解像度の座標)，画像が読めない場合はNone
+    """
+    factor = 1.0 / scale
+    reduced_flag = REDUCED_GRAYSCALE_FLAGS.get(int(round(factor))) if abs(factor - round(factor)) < 1e-9 else None
+    if img is None and reduced_flag is not None:
+        small = cv2.imread(img_path, reduced_flag)
+    else:
+        if img is None:
+            img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            return None
+        if scale == 1.0:
+            small = img
+        else:
+            small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    speech_balloons = extractSpeechBalloon(small)
+    if speech_balloons is None:
+        return None
 
+    # 元の解像度の座標に戻す
+    for balloon in speech_balloons:
+        for key in ("xmin", "ymin"):
+            balloon[key] = str(int(np.floor(int(balloon[key]) * factor)))
+        for key in ("xmax", "ymax"):
+            balloon[key] = str(int(np.ceil(int(balloon[key]) * factor)))
     return speech_balloons
+
+
+def box_iou_matrix(boxes_a, boxes_b):
+    """
+    2つのバウンディングボックスの集合の全組み合わせのIoUを計算
+    :param boxes_a: バウンディングボックス情報のリスト，または(A, 4)の座標配列
+    :param boxes_b: バウンディングボックス情報のリスト，または(B, 4)の座標配列
+    :return: (A, B)のIoU行列
+    """
+    a = bboxes_to_array(boxes_a)[:, None, :]
+    b = bboxes_to_array(boxes_b)[None, :, :]
+    overlap_w = np.maximum(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0)
+    overlap_h = np.maximum(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0)
+    overlap_area = overlap_w * overlap_h
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    union = area_a + area_b - overlap_area
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(union > 0, overlap_area / union, 0.0)
+
+
+def compare_detections(reference, detected, iou_threshold=0.5):
+    """
+    検出結果を基準(全解像度の検出結果やアノテーション)と比較
+    IoUが大きい組から順に1対1で対応付ける
+    :param reference: 基準のバウンディングボックス情報のリスト
+    :param detected: 検出したバウンディングボックス情報のリスト
+    :param iou_threshold: 対応付けるIoUの閾値
+    :return: recall, precision, 対応付いた組のIoUの平均(mean_iou), 対応付いた組数(matched)の辞書
+    """
+    iou = box_iou_matrix(reference, detected)
+    pairs = np.argwhere(iou >= iou_threshold)
+    pairs = pairs[np.argsort(-iou[pairs[:, 0], pairs[:, 1]], kind="stable")]
+    used_reference, used_detected, matched_iou = set(), set(), []
+    for i, j in pairs.tolist():
+        if i not in used_reference and j not in used_detected:
+            used_reference.add(i)
+            used_detected.add(j)
+            matched_iou.append(iou[i, j])
+    n_reference, n_detected = iou.shape
+    return {
+        "recall": len(matched_iou) / n_reference if n_reference else 1.0,
+        "precision": len(matched_iou) / n_detected if n_detected else 1.0,
+        "mean_iou": float(np.mean(matched_iou)) if matched_iou else 0.0,
+        "matched": len(matched_iou),
+    }
+
+
+# ページ単位の吹き出し検出結果を保持するページ数
+PAGE_CACHE_SIZE = 8
+# (読み込み元, ページインデックス) -> (画像の記録, 吹き出しのバウンディングボックス情報)
+_page_balloon_cache = OrderedDict()
+
+
+def detect_page_balloons(img_source, page_index, img=None):
+    """
+    ページ画像から吹き出しを検出(直近PAGE_CACHE_SIZEページ分の結果を再利用する)
+    画像の記録(img_source.fingerprint)が前回と同じであれば輪郭の抽出を省略する．デコードを省略できるのはimgを渡さない場合だけ
+    :param img_source: 画像の読み込み元(image_source.DirectoryImageSourceまたはZipImageSource)
+    :param page_index: ページのインデックス
+    :param img: 読み込み済みの画像(Noneの場合はキャッシュにないときだけimg_sourceから読み込む)
+    :return: 吹き出しのバウンディングボックス情報，画像が読めない場合はNone
+    """
+    key = (repr(img_source), page_index)
+    cached = _page_balloon_cache.get(key)
+    # ディレクトリの場合，サイズと更新時刻が前回と同じならハッシュを計算し直さない
+    fingerprint = img_source.fingerprint(page_index, cached[0] if cached is not None else None)
+    if fingerprint is None:
+        return None
+    if cached is not None and cached[0] == fingerprint:
+        _page_balloon_cache.move_to_end(key)
+    else:
+        if img is None:
+            with stage("imread"):
+                img = img_source.read(page_index)
+        if img is None:
+            return None
+        speech_balloons = extractSpeechBalloon(img)
+        if speech_balloons is None:
+            return None
+        _page_balloon_cache[key] = (fingerprint, speech_balloons)
+        _page_balloon_cache.move_to_end(key)
+        if len(_page_balloon_cache) > PAGE_CACHE_SIZE:
+            _page_balloon_cache.popitem(last=False)
+    return [dict(balloon) for balloon in _page_balloon_cache[key][1]]
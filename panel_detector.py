@@ -1,2 +1,240 @@
+import argparse
+import os
+import time
+
 import cv2
-import numpy as np
\ No newline at end of file
+import numpy as np
+from modules import compare_detections
+from annotation_loader import load_annotation_table, table_to_page_objects
+from image_prefetch import prefetch_pages
+from image_source import open_image_source
+
+# コマ検出のパラメータ
+# この値より暗い画素を描画(枠線・絵)とみなす
+PANEL_INK_THRESHOLD = 200
+# 描画の画素数が辺の長さのこの割合以下の行・列を余白とみなす
+PANEL_GUTTER_INK_RATIO = 0.002
+# 余白とみなす行・列の連続数の下限(ページの辺の長さに対する比)
+PANEL_MIN_GUTTER_RATIO = 0.004
+# コマとみなす領域の面積の下限(ページ面積に対する比)
+PANEL_MIN_AREA_RATIO = 0.01
+# コマとみなす領域の辺の長さの下限(ページの辺の長さに対する比)
+PANEL_MIN_SIDE_RATIO = 0.05
+# X-Y分割の再帰の深さの上限
+PANEL_MAX_DEPTH = 8
+# 連結成分による分割を行う画像の縮小率の逆数(描画は縮小後も残るように最大値で縮小する)
+PANEL_COMPONENT_SCALE = 2
+
+
+def _ink_runs(profile, max_ink, min_gap):
+    """
+    投影の中で描画がある区間を求める(min_gap未満の余白は区間の一部とみなす)
+    :param profile: 行または列ごとの描画の画素数
+    :param max_ink: 余白とみなす描画の画素数の上限
+    :param min_gap: 区間を分ける余白の長さの下限
+    :return: 描画がある区間(開始, 終了)のリスト
+    """
+    ink = np.flatnonzero(profile > max_ink)
+    if len(ink) == 0:
+        return []
+    # 隣の描画がある行・列との間隔がmin_gap以上のところで区切る
+    breaks = np.flatnonzero(np.diff(ink) > min_gap)
+    starts = np.concatenate(([ink[0]], ink[breaks + 1]))
+    ends = np.concatenate((ink[breaks], [ink[-1]])) + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def _xy_cut(integral, region, min_gap, min_size, depth, leaves):
+    """
+    投影の余白で領域を再帰的に分割する(X-Y分割)
+    行方向(横の余白)で分割できなければ列方向(縦の余白)で分割し，どちらでも分割できない領域を葉とする
+    :param integral: 描画の積分画像
+    :param region: 領域(xmin, ymin, xmax, ymax)
+    :param min_gap: (縦, 横)の余白の長さの下限
+    :param min_size: (幅, 高さ)の下限
+    :param depth: 残りの再帰の深さ
+    :param leaves: 葉の領域を追加するリスト
+    """
+    x0, y0, x1, y1 = region
+    # 積分画像から行ごと・列ごとの描画の画素数を計算
+    rows = integral[y0 + 1 : y1 + 1, x1] - integral[y0 + 1 : y1 + 1, x0] - integral[y0:y1, x1] + integral[y0:y1, x0]
+    cols = integral[y1, x0 + 1 : x1 + 1] - integral[y0, x0 + 1 : x1 + 1] - integral[y1, x0:x1] + integral[y0, x0:x1]
+    row_runs = _ink_runs(rows, max(1, PANEL_GUTTER_INK_RATIO * (x1 - x0)), min_gap[0])
+    col_runs = _ink_runs(cols, max(1, PANEL_GUTTER_INK_RATIO * (y1 - y0)), min_gap[1])
+    if not row_runs or not col_runs:
+        return
+
+    # 描画のある範囲に切り詰める
+    x0, x1 = x0 + col_runs[0][0], x0 + col_runs[-1][1]
+    y0, y1 = y0 + row_runs[0][0], y0 + row_runs[-1][1]
+    offset_x, offset_y = col_runs[0][0], row_runs[0][0]
+    if x1 - x0 < min_size[0] or y1 - y0 < min_size[1]:
+        return
+
+    if depth > 0 and len(row_runs) > 1:
+        for start, end in row_runs:
+            _xy_cut(integral, (x0, y0 + start - offset_y, x1, y0 + end - offset_y), min_gap, min_size, depth - 1, leaves)
+    elif depth > 0 and len(col_runs) > 1:
+        for start, end in col_runs:
+            _xy_cut(integral, (x0 + start - offset_x, y0, x0 + end - offset_x, y1), min_gap, min_size, depth - 1, leaves)
+    else:
+        leaves.append((x0, y0, x1, y1))
+
+
+def _split_by_components(ink_small, region, min_area, min_size):
+    """
+    X-Y分割で分けられない領域(斜めの余白など)を連結成分で分割
+    領域の外周につながる余白を背景とし，それ以外の連結成分をコマとする
+    :param ink_small: PANEL_COMPONENT_SCALE分の1に縮小した描画の二値画像
+    :param region: 領域(xmin, ymin, xmax, ymax)
+    :param min_area: コマとみなす面積の下限
+    :param min_size: (幅, 高さ)の下限
+    :return: 分割した領域のリスト(2つ以上に分けられない場合は元の領域のみ)
+    """
+    scale = PANEL_COMPONENT_SCALE
+    x0, y0, x1, y1 = region
+    sx0, sy0, sx1, sy1 = x0 // scale, y0 // scale, -(-x1 // scale), -(-y1 // scale)
+    # 外周を余白で囲み，外周から塗りつぶした余白を背景とする
+    foreground = np.pad(ink_small[sy0:sy1, sx0:sx1], 1)
+    cv2.floodFill(foreground, None, (0, 0), 2)
+    foreground = (foreground != 2).astype(np.uint8)
+    n, _, stats, _ = cv2.connectedComponentsWithStats(foreground, connectivity=8)
+    boxes = []
+    for x, y, w, h, _ in stats[1:n].tolist():
+        box = (
+            max(x0, (sx0 + x - 1) * scale),
+            max(y0, (sy0 + y - 1) * scale),
+            min(x1, (sx0 + x - 1 + w) * scale),
+            min(y1, (sy0 + y - 1 + h) * scale),
+        )
+        if (box[2] - box[0]) * (box[3] - box[1]) >= min_area and box[2] - box[0] >= min_size[0] and box[3] - box[1] >= min_size[1]:
+            boxes.append(box)
+    return boxes if len(boxes) > 1 else [region]
+
+
+def detect_panel_boxes(img, use_components=True):
+    """
+    画像からコマを検出(投影の余白によるX-Y分割と，分割できない領域の連結成分による分割)
+    :param img: 画像(カラーまたはグレースケール)
+    :param use_components: 連結成分による分割も行うか
+    :return: コマの座標配列(xmin, ymin, xmax, ymax)，上の段から順，同じ段では右から順
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    height, width = gray.shape
+    ink = (gray < PANEL_INK_THRESHOLD).astype(np.uint8)
+    integral = cv2.integral(ink)
+
+    min_gap = (max(2, round(PANEL_MIN_GUTTER_RATIO * height)), max(2, round(PANEL_MIN_GUTTER_RATIO * width)))
+    min_size = (PANEL_MIN_SIDE_RATIO * width, PANEL_MIN_SIDE_RATIO * height)
+    min_area = PANEL_MIN_AREA_RATIO * width * height
+    leaves = []
+    _xy_cut(integral, (0, 0, width, height), min_gap, min_size, PANEL_MAX_DEPTH, leaves)
+
+    if use_components:
+        # scale×scaleの範囲の最大値で縮小(細い余白の両側の描画はつながらず，細い枠線は消えない)
+        scale = PANEL_COMPONENT_SCALE
+        ink_small = cv2.dilate(ink, np.ones((scale, scale), np.uint8), anchor=(0, 0))
+        ink_small = cv2.resize(ink_small, (-(-width // scale), -(-height // scale)), interpolation=cv2.INTER_NEAREST)
+
+    boxes = []
+    for leaf in leaves:
+        area = (leaf[2] - leaf[0]) * (leaf[3] - leaf[1])
+        if area < min_area:
+            continue
+        # 2つのコマに分けられる大きさの領域だけ連結成分で分割を試みる
+        if use_components and area >= 2 * min_area:
+            boxes.extend(_split_by_components(ink_small, leaf, min_area, min_size))
+        else:
+            boxes.append(leaf)
+
+    boxes = np.array(boxes, dtype=np.int64).reshape(-1, 4)
+    order = np.lexsort((-boxes[:, 2], boxes[:, 1]))
+    return boxes[order]
+
+
+def detect_panels(img, use_components=True):
+    """
+    画像からコマを検出
+    :param img: 画像(カラーまたはグレースケール)
+    :param use_components: 連結成分による分割も行うか
+    :return: コマのバウンディングボックス情報(calculate_pseudo_regionsに渡せる形式)
+    """
+    return [
+        {"type": "frame", "id": f"detected_{k}", "xmin": x0, "ymin": y0, "xmax": x1, "ymax": y1}
+        for k, (x0, y0, x1, y1) in enumerate(detect_panel_boxes(img, use_components).tolist())
+    ]
+
+
+def evaluate_panel_detector(manga109_ano_dir, manga109_img_dir, titles, max_pages=None, iou_threshold=0.5):
+    """
+    Manga109のコマのアノテーションに対するコマ検出の精度と処理時間を計測
+    :param manga109_ano_dir: アノテーションファイルのディレクトリ
+    :param manga109_img_dir: 画像ファイルのディレクトリ
+    :param titles: 漫画のタイトルのリスト
+    :param max_pages: タイトルごとに評価するページ数の上限(Noneの場合は全ページ)
+    :param iou_threshold: 検出とアノテーションを対応付けるIoUの閾値
+    :return: 結果の行のリスト
+    """
+    lines = [
+        f"panel detector vs Manga109 frames (IoU >= {iou_threshold})",
+        f"{'title':<28} {'pages':>6} {'frames':>7} {'recall':>8} {'precision':>10} {'mean_iou':>9} {'ms/page':>9}",
+    ]
+    totals = {"pages": 0, "frames": 0, "detected": 0, "matched": 0, "iou": 0.0, "time": 0.0}
+    for manga_title in titles:
+        table = load_annotation_table(os.path.join(manga109_ano_dir, manga_title + ".xml"))
+        frames = table_to_page_objects(table, ["frame"])
+        img_source = open_image_source(manga109_img_dir, manga_title)
+        stats = {"pages": 0, "frames": 0, "detected": 0, "matched": 0, "iou": 0.0, "time": 0.0}
+        for page_index, img in prefetch_pages(list(frames)[:max_pages], img_source, grayscale=True):
+            if img is None:
+                continue
+            start = time.perf_counter()
+            detected = detect_panel_boxes(img)
+            stats["time"] += time.perf_counter() - start
+            accuracy = compare_detections(frames[page_index], detected, iou_threshold)
+            stats["pages"] += 1
+            stats["frames"] += len(frames[page_index])
+            stats["detected"] += len(detected)
+            stats["matched"] += accuracy["matched"]
+            stats["iou"] += accuracy["mean_iou"] * accuracy["matched"]
+        for key in totals:
+            totals[key] += stats[key]
+        lines.append(_evaluation_line(manga_title, stats))
+    lines.append(_evaluation_line("total", totals))
+    return lines
+
+
+def _evaluation_line(name, stats):
+    """
+    評価結果の1行を作成
+    :param name: 行の名前
+    :param stats: pages, frames, detected, matched, iou(対応付いた組のIoUの合計), time(検出時間の合計)の辞書
+    :return: 結果の行
+    """
+    recall = stats["matched"] / max(stats["frames"], 1)
+    precision = stats["matched"] / max(stats["detected"], 1)
+    mean_iou = stats["iou"] / max(stats["matched"], 1)
+    ms_per_page = stats["time"] / max(stats["pages"], 1) * 1e3
+    return (
+        f"{name:<28} {stats['pages']:>6} {stats['frames']:>7} {recall:>8.3f} {precision:>10.3f} "
+        f"{mean_iou:>9.3f} {ms_per_page:>9.2f}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="コマ検出のManga109のアノテーションに対する精度を評価する")
+    parser.add_argument(
+        "--annotations",
+        default="./../Manga109_released_2021_12_30/annotations.v2020.12.18/",
+        help="アノテーションファイルのディレクトリ",
+    )
+    parser.add_argument("--images", default="./../Manga109_released_2021_12_30/images/", help="画像ファイルのディレクトリ")
+    parser.add_argument("--titles", nargs="+", default=["all"], help='漫画のタイトル(全タイトルの場合は"all")')
+    parser.add_argument("--max-pages", type=int, default=None, help="タイトルごとに評価するページ数の上限")
+    parser.add_argument("--iou-threshold", type=float, default=0.5, help="検出とアノテーションを対応付けるIoUの閾値")
+    args = parser.parse_args()
+
+    titles = args.titles
+    if titles == ["all"]:
+        titles = sorted(os.path.splitext(f)[0] for f in os.listdir(args.annotations) if f.endswith(".xml"))
+    print("\n".join(evaluate_panel_detector(args.annotations, args.images, titles, args.max_pages, args.iou_threshold)))
@@ -1,80 +1,126 @@
 from modules import *
-import cv2
-import os
+import heapq
 import numpy as np
+from profiler import profiled
+from manga109_pages import iter_pages
+from panel_detector import detect_panels
+from result_cache import cached_order
+
+# order_panelsの結果が変わる変更をしたら上げる(結果のキャッシュのキーに含める)
+ORDER_PANELS_VERSION = 2
 
 
 def calculate_pseudo_regions(panels):
-    # バウンディングボックスを数値に変換
-    boxes = np.array([[int(p["xmin"]), int(p["ymin"]), int(p["xmax"]), int(p["ymax"])] for p in panels])
-
-    pseudo_regions = []
-    for i, box in enumerate(boxes):
-        overlaps = []
-        for j, other_box in enumerate(boxes):
-            if i != j:
-                # 重なりを計算
-                overlap_xmin = max(box[0], other_box[0])
-                overlap_ymin = max(box[1], other_box[1])
-                overlap_xmax = min(box[2], other_box[2])
-                overlap_ymax = min(box[3], other_box[3])
-
-                if overlap_xmax > overlap_xmin and overlap_ymax > overlap_ymin:
-                    overlaps.append([overlap_xmin, overlap_ymin, overlap_xmax, overlap_ymax])
-
-        if overlaps:
-            # 重なりがある場合、擬似的なコマ領域を計算
-            overlap = np.array(overlaps).mean(axis=0)
-            mid_x = (overlap[0] + overlap[2]) / 2
-            pseudo_regions.append([box[0], box[1], mid_x, box[3]])
-        else:
-            pseudo_regions.append(box)
-
-    return np.array(pseudo_regions)
-
-
-def order_panels(pseudo_regions, page_width, page_height):
-    ordered = []
-    remaining = list(range(len(pseudo_regions)))
+    """
+    コマ同士の重なりから擬似的なコマ領域を計算
+    :param panels: コマのバウンディングボックス情報のリスト，または(N, 4)の座標配列
+    :return: 擬似的なコマ領域の配列(xmin, ymin, xmax, ymax)
+    :see also: compute_pseudo_regions 擬似的なコマ領域を一括で計算する関数
+    """
+    return compute_pseudo_regions(panels)
+
+
+@profiled("order_panels")
+def order_panels(pseudo_regions, page_width, page_height, cache=None):
+    """
+    コマの順序を推定
+    上側に未定義のコマがないコマのうち，右上座標がページ右上に最も近いものを選び，
+    左端でなければその左下にあるコマを続けて選ぶ
+    「上側に未定義のコマがない」判定はymaxの最小値・2番目の最小値と，
+    ymin順に並べたコマへのポインタで管理し，候補は距離をキーにしたヒープで取り出す
+    :param pseudo_regions: 擬似的なコマ領域の配列(xmin, ymin, xmax, ymax)
+    :param page_width: ページの幅
+    :param page_height: ページの高さ
+    :param cache: 結果を再利用するOrderCache(Noneの場合は使わない)
+    :return: コマのインデックスの順序
+    """
+    return cached_order(
+        cache,
+        "order_panels",
+        ORDER_PANELS_VERSION,
+        np.asarray(pseudo_regions).reshape(-1, 4),
+        lambda: _order_panels(pseudo_regions, page_width, page_height),
+        page_width=page_width,
+        page_height=page_height,
+    )
 
-    while remaining:
-        # 上側に未定義のコマがないものを探す
-        top_candidates = [
-            i for i in remaining if all(pseudo_regions[i][1] <= pseudo_regions[j][3] for j in remaining if i != j)
-        ]
 
-        if not top_candidates:
+def _order_panels(pseudo_regions, page_width, page_height):
+    """
+    コマの順序を推定(order_panelsの本体)
+    :param pseudo_regions: 擬似的なコマ領域の配列(xmin, ymin, xmax, ymax)
+    :param page_width: ページの幅
+    :param page_height: ページの高さ
+    :return: コマのインデックスの順序
+    """
+    regions = np.asarray(pseudo_regions).reshape(-1, 4).tolist()
+    n = len(regions)
+    xmin = np.array([r[0] for r in regions])
+    ymin = np.array([r[1] for r in regions])
+
+    def top_key(i):
+        # 右上座標とページ右上の距離
+        return ((page_width - regions[i][2]) ** 2 + regions[i][1] ** 2) ** 0.5
+
+    alive = np.ones(n, dtype=bool)
+    ymin_order = sorted(range(n), key=lambda i: (regions[i][1], i))
+    ymin_pointer = 0
+    ymax_heap = [(regions[i][3], i) for i in range(n)]
+    xmax_heap = [(regions[i][2], i) for i in range(n)]
+    heapq.heapify(ymax_heap)
+    heapq.heapify(xmax_heap)
+    candidate_heap = []
+
+    def discard_removed(heap):
+        while heap and not alive[heap[0][1]]:
+            heapq.heappop(heap)
+
+    ordered = []
+    remaining = n
+    while remaining:
+        # 残りのコマのymaxの最小値m1(とその持ち主)と，持ち主を除いた最小値m2
+        discard_removed(ymax_heap)
+        first = heapq.heappop(ymax_heap)
+        discard_removed(ymax_heap)
+        m1, holder = first
+        m2 = ymax_heap[0][0] if ymax_heap else float("inf")
+        heapq.heappush(ymax_heap, first)
+
+        # 上側に未定義のコマがないもの: 持ち主以外はymin <= m1，持ち主はymin <= m2
+        while ymin_pointer < n and regions[ymin_order[ymin_pointer]][1] <= m1:
+            i = ymin_order[ymin_pointer]
+            ymin_pointer += 1
+            if alive[i]:
+                heapq.heappush(candidate_heap, (top_key(i), i))
+        discard_removed(candidate_heap)
+        best = candidate_heap[0] if candidate_heap else None
+        if m1 < regions[holder][1] <= m2:
+            holder_candidate = (top_key(holder), holder)
+            if best is None or holder_candidate < best:
+                best = holder_candidate
+
+        if best is None:
             break  # エラー処理が必要かもしれません
 
         # 右上座標がページ右上に最も近いコマを選択
-        closest = min(
-            top_candidates, key=lambda i: ((page_width - pseudo_regions[i][2]) ** 2 + pseudo_regions[i][1] ** 2) ** 0.5
-        )
-
+        closest = best[1]
         ordered.append(closest)
-        remaining.remove(closest)
+        alive[closest] = False
+        remaining -= 1
 
-        current_region = pseudo_regions[closest]
+        current_region = regions[closest]
 
         # 左端かどうかをチェック
-        if any(pseudo_regions[i][2] < current_region[0] for i in remaining):
+        discard_removed(xmax_heap)
+        if xmax_heap and xmax_heap[0][0] < current_region[0]:
             # 左端でない場合、次のコマを探す
-            next_candidates = [
-                i
-                for i in remaining
-                if pseudo_regions[i][1] >= current_region[3] and pseudo_regions[i][0] >= current_region[2]
-            ]
-            if next_candidates:
-                next_panel = min(
-                    next_candidates,
-                    key=lambda i: (
-                        (pseudo_regions[i][0] - current_region[2]) ** 2
-                        + (pseudo_regions[i][1] - current_region[3]) ** 2
-                    )
-                    ** 0.5,
-                )
+            next_candidates = np.flatnonzero(alive & (ymin >= current_region[3]) & (xmin >= current_region[2]))
+            if len(next_candidates):
+                dist = ((xmin[next_candidates] - current_region[2]) ** 2 + (ymin[next_candidates] - current_region[3]) ** 2) ** 0.5
+                next_panel = int(next_candidates[np.argmin(dist)])
                 ordered.append(next_panel)
-                remaining.remove(next_panel)
+                alive[next_panel] = False
+                remaining -= 1
 
     return ordered
 
@@ -85,33 +131,21 @@ if __name__ == "__main__":
         "./../Manga109_released_2021_12_30/annotations.v2020.12.18/"  # アノテーションファイルのディレクトリ
     )
     manga109_img_dir = "./../Manga109_released_2021_12_30/images/"  # 画像ファイルのディレクトリ
-    files = os.listdir(manga109_ano_dir)  # アノテーションファイルのリスト
-    img_folders = os.listdir(manga109_img_dir)  # 画像フォルダのリスト
 
     # マンガのタイトルを指定
     manga_title = "PrismHeart"
-    # 実験時，画像を指定する場合
+    # 実験時，画像を指定する場合(全ページの場合はNone)
     sitei = "005"
-    # 実験時，manga109を指定する場合True, 画像処理による抽出を指定する場合False
+    # 実験時，manga109のコマを使う場合True, 画像処理によるコマ検出を使う場合False
     manga109 = True
     # manga109 = False
-    ano_file_path = manga109_ano_dir + manga_title + ".xml"
-    img_folder_path = manga109_img_dir + manga_title + "/"
-
-    # 画像ファイル名を取得
-    imgs = os.listdir(img_folder_path)
-    imgs.sort()
-
-    panels = get_panelbbox_info_from_xml(ano_file_path)
-    for page_index in panels.keys():
-        img_path = index_to_img_path(page_index, img_folder_path)
-        # print("img_path", img_path)
-        # print("panels", panels[page_index])
-        if sitei not in img_path:
-            continue
-        img = cv2.imread(img_path)
-        page_height, page_width = img.shape[:2]
-        print("panels", panels[page_index])
-        pseudo_regions = calculate_pseudo_regions(panels)
-        ordered_indices = order_panels(pseudo_regions, page_width, page_height)
-        print("コマの順序:", [panels[i]["id"] for i in ordered_indices])
+
+    # 指定したページのアノテーションだけを読み込み，画像は参照したときに読み込む
+    for page in iter_pages(manga_title, sitei, manga109_ano_dir, manga109_img_dir):
+        with page:
+            panels = page.panels if manga109 else detect_panels(page.image)
+            page_height, page_width = page.image.shape[:2]
+            print("panels", panels)
+            pseudo_regions = calculate_pseudo_regions(panels)
+            ordered_indices = order_panels(pseudo_regions, page_width, page_height)
+            print("コマの順序:", [panels[i]["id"] for i in ordered_indices])
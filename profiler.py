@@ -0,0 +1,299 @@
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import nullcontext
+from functools import wraps
+
+import numpy as np
+
+# 計測中のプロファイラ(Noneの場合は計測しない)
+_active_profiler = None
+# 計測しないときに返す何もしないコンテキストマネージャ
+_NULL_STAGE = nullcontext()
+# サマリに出すパーセンタイル
+PERCENTILES = (50, 95, 99)
+
+
+class _Stage:
+    """
+    1回分の処理段階の実行時間を計測するコンテキストマネージャ
+    """
+
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add_sample(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _Page:
+    """
+    1ページ分の計測範囲を表すコンテキストマネージャ
+    ページ内の処理段階の合計時間，カウンタ，(有効な場合は)ピークメモリを記録する
+    """
+
+    def __init__(self, profiler, key):
+        self.profiler = profiler
+        self.record = {"key": key, "stages": {}, "counters": {}}
+
+    def __enter__(self):
+        self.profiler._current_page = self.record
+        if self.profiler.trace_memory:
+            # 呼び出し元が既に計測している場合は開始・停止もピークのリセットもしない
+            self.owns_trace = not tracemalloc.is_tracing()
+            if self.owns_trace:
+                tracemalloc.start()
+            self.base_memory, self.base_peak = tracemalloc.get_traced_memory()
+        self.start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, *exc_info):
+        self.record["total"] = time.perf_counter() - self.start
+        if self.profiler.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # ページ開始時からの増加量のピーク
+            # 呼び出し元の計測中にページ開始前のピークを超えなかった場合はページ内のピークが分からないため終了時の増加量を記録する
+            if self.owns_trace or peak > self.base_peak:
+                self.record["peak_memory"] = peak - self.base_memory
+            else:
+                self.record["peak_memory"] = max(current - self.base_memory, 0)
+            if self.owns_trace:
+                tracemalloc.stop()
+        self.profiler._current_page = None
+        self.profiler.pages.append(self.record)
+        return False
+
+
+class PipelineProfiler:
+    """
+    順序推定の各処理段階(XML読み込み，画像読み込み，吹き出し検出，コマへの割り当て，コマ・吹き出しの順序推定)の
+    実行時間とページごとのカウンタを集計する
+    """
+
+    def __init__(self, trace_memory=False):
+        """
+        :param trace_memory: Trueの場合，ページごとのピークメモリをtracemallocで計測する(処理は遅くなる)
+        """
+        self.trace_memory = trace_memory
+        # 処理段階ごとの1回ごとの実行時間[秒]
+        self.samples = {}
+        # ページごとの記録
+        self.pages = []
+        self._current_page = None
+
+    def stage(self, name):
+        """
+        処理段階の実行時間を計測するコンテキストマネージャを返す
+        :param name: 処理段階の名前
+        """
+        return _Stage(self, name)
+
+    def page(self, **key):
+        """
+        1ページ分の計測範囲を表すコンテキストマネージャを返す
+        :param key: ページを識別する値(title, pageなど)
+        """
+        return _Page(self, key)
+
+    def add_sample(self, name, elapsed):
+        """
+        処理段階の実行時間を記録
+        :param name: 処理段階の名前
+        :param elapsed: 実行時間[秒]
+        """
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = []
+        samples.append(elapsed)
+        page = self._current_page
+        if page is not None:
+            stages = page["stages"]
+            stages[name] = stages.get(name, 0.0) + elapsed
+
+    def count(self, name, n=1):
+        """
+        計測中のページのカウンタ(コマ数，吹き出し数，輪郭数など)を加算
+        :param name: カウンタの名前
+        :param n: 加算する値
+        """
+        if self._current_page is not None:
+            counters = self._current_page["counters"]
+            counters[name] = counters.get(name, 0) + n
+
+    def export(self):
+        """
+        他のプロセスへ渡すために計測結果をJSONに変換できる形で取り出す
+        :return: 計測結果の辞書
+        """
+        return {"samples": self.samples, "pages": self.pages}
+
+    def merge(self, exported):
+        """
+        export()で取り出した計測結果(ワーカープロセスの結果など)を統合
+        :param exported: 計測結果の辞書
+        """
+        for name, values in exported["samples"].items():
+            self.samples.setdefault(name, []).extend(values)
+        self.pages.extend(exported["pages"])
+
+    def report(self):
+        """
+        処理段階ごとの実行時間の統計とページごとのカウンタの統計をまとめる
+        :return: レポートの辞書
+        """
+        stages = {}
+        for name, values in self.samples.items():
+            values = np.asarray(values)
+            stages[name] = {
+                "calls": len(values),
+                "total": float(values.sum()),
+                "mean": float(values.mean()),
+                **{f"p{q}": float(v) for q, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))},
+            }
+
+        counters = {}
+        counter_names = sorted({name for page in self.pages for name in page["counters"]})
+        for name in counter_names:
+            values = np.array([page["counters"].get(name, 0) for page in self.pages])
+            counters[name] = {
+                "total": int(values.sum()),
+                **{f"p{q}": float(v) for q, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))},
+            }
+
+        report = {"n_pages": len(self.pages), "stages": stages, "counters": counters, "pages": self.pages}
+        peaks = [page["peak_memory"] for page in self.pages if "peak_memory" in page]
+        if peaks:
+            report["peak_memory"] = {
+                "max": int(max(peaks)),
+                **{f"p{q}": float(v) for q, v in zip(PERCENTILES, np.percentile(peaks, PERCENTILES))},
+            }
+        return report
+
+    def write_report(self, path):
+        """
+        レポートをJSONファイルに書き出す
+        :param path: 出力するファイルのパス
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=1)
+
+    def summary_lines(self):
+        """
+        処理段階ごとのp50/p95/p99の表を作成
+        :return: 表の行のリスト
+        """
+        report = self.report()
+        header = "".join(f"{f'p{q}[ms]':>10}" for q in PERCENTILES)
+        lines = [f"{'stage':<24} {'calls':>8} {'total[s]':>10}{header}"]
+        for name, stat in sorted(report["stages"].items(), key=lambda item: -item[1]["total"]):
+            values = "".join(f"{stat[f'p{q}'] * 1e3:>10.3f}" for q in PERCENTILES)
+            lines.append(f"{name:<24} {stat['calls']:>8} {stat['total']:>10.3f}{values}")
+        if report["counters"]:
+            header = "".join(f"{f'p{q}':>10}" for q in PERCENTILES)
+            lines += ["", f"{'counter (per page)':<24} {'total':>8} {'':>10}{header}"]
+            for name, stat in report["counters"].items():
+                values = "".join(f"{stat[f'p{q}']:>10.1f}" for q in PERCENTILES)
+                lines.append(f"{name:<24} {stat['total']:>8} {'':>10}{values}")
+        if "peak_memory" in report:
+            stat = report["peak_memory"]
+            values = "".join(f"{stat[f'p{q}'] / 2**20:>10.2f}" for q in PERCENTILES)
+            lines += ["", f"{'peak memory [MB]':<24} {'':>8} {stat['max'] / 2**20:>10.2f}{values}"]
+        return lines
+
+    def print_summary(self, file=sys.stderr):
+        """
+        処理段階ごとのp50/p95/p99の表を出力
+        :param file: 出力先
+        """
+        print("\n".join(self.summary_lines()), file=file)
+
+
+def enable_profiling(trace_memory=False):
+    """
+    計測を開始する(以降，各処理段階のフックが計測を行う)
+    :param trace_memory: Trueの場合，ページごとのピークメモリも計測する
+    :return: 計測に用いるプロファイラ
+    """
+    global _active_profiler
+    _active_profiler = PipelineProfiler(trace_memory)
+    return _active_profiler
+
+
+def disable_profiling():
+    """
+    計測を終了する
+    :return: 計測に用いていたプロファイラ(計測していなかった場合はNone)
+    """
+    global _active_profiler
+    profiler, _active_profiler = _active_profiler, None
+    return profiler
+
+
+def get_profiler():
+    """
+    計測中のプロファイラを取得
+    :return: プロファイラ(計測していない場合はNone)
+    """
+    return _active_profiler
+
+
+def stage(name):
+    """
+    処理段階の実行時間を計測するコンテキストマネージャ(計測していない場合は何もしない)
+    :param name: 処理段階の名前
+    """
+    if _active_profiler is None:
+        return _NULL_STAGE
+    return _Stage(_active_profiler, name)
+
+
+def page(**key):
+    """
+    1ページ分の計測範囲を表すコンテキストマネージャ(計測していない場合は何もしない)
+    :param key: ページを識別する値(title, pageなど)
+    """
+    if _active_profiler is None:
+        return _NULL_STAGE
+    return _Page(_active_profiler, key)
+
+
+def count(name, n=1):
+    """
+    計測中のページのカウンタを加算(計測していない場合は何もしない)
+    :param name: カウンタの名前
+    :param n: 加算する値
+    """
+    if _active_profiler is not None:
+        _active_profiler.count(name, n)
+
+
+def profiled(name):
+    """
+    関数全体を1つの処理段階として計測するデコレータ
+    :param name: 処理段階の名前
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _active_profiler
+            if profiler is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.add_sample(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+# キャッシュの既定の上限件数
+RESULT_CACHE_MAX_ENTRIES = 1_000_000
+# この件数の書き込みごとにコミットする
+RESULT_CACHE_COMMIT_INTERVAL = 200
+
+
+class OrderCache:
+    """
+    順序推定の結果をSQLiteファイルに保存するキャッシュ
+    キーはバウンディングボックスの座標配列，アルゴリズムの名前・バージョン，パラメータのハッシュ
+    件数が上限を超えると最後に参照した時刻が古いものから削除する(LRU)
+    """
+
+    def __init__(self, path, max_entries=RESULT_CACHE_MAX_ENTRIES, commit_interval=RESULT_CACHE_COMMIT_INTERVAL):
+        """
+        :param path: キャッシュファイルのパス
+        :param max_entries: 保存する結果の上限件数
+        :param commit_interval: この件数の書き込みごとにコミットする
+        """
+        cache_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.commit_interval = commit_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pending = 0
+        # ヒットしたキー -> 参照した時刻(書き込みロックを取らないようにflush()でまとめて書き込む)
+        self._touched = {}
+        # 複数プロセスから同時に使えるようにWALモードで開く
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS orders (key BLOB PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS orders_last_used ON orders (last_used)")
+        self._conn.commit()
+        self._n_entries = self._count()
+
+    def _count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+    @staticmethod
+    def key(algorithm, version, boxes, **params):
+        """
+        キャッシュのキーを計算
+        :param algorithm: アルゴリズムの名前
+        :param version: アルゴリズムのバージョン(結果が変わる変更をしたら上げる)
+        :param boxes: 座標配列(またはそのリスト)，整数の座標はint64，それ以外はfloat64に正規化してハッシュする
+        :param params: 結果に影響するパラメータ
+        :return: キー(バイト列)
+        """
+        # numpyのスカラーはPythonの数値にそろえる
+        params = sorted((name, value.item() if isinstance(value, np.generic) else value) for name, value in params.items())
+        digest = hashlib.sha1()
+        digest.update(json.dumps([algorithm, version, params]).encode())
+        for array in boxes if isinstance(boxes, (list, tuple)) else [boxes]:
+            array = np.asarray(array)
+            array = array.astype(np.int64 if array.dtype.kind in "iub" else np.float64)
+            digest.update(str(array.shape).encode())
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.digest()
+
+    def get(self, key):
+        """
+        キャッシュから結果を取得
+        :param key: キャッシュのキー
+        :return: 保存されている結果，ない場合はNone
+        """
+        row = self._conn.execute("SELECT value FROM orders WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touched[key] = time.time()
+        if len(self._touched) >= self.commit_interval:
+            self.flush()
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """
+        結果をキャッシュに保存
+        :param key: キャッシュのキー
+        :param value: JSONに変換できる結果(インデックスのリストなど)
+        """
+        value, now = json.dumps(value), time.time()
+        cursor = self._conn.execute(
+            "INSERT OR IGNORE INTO orders (key, value, last_used) VALUES (?, ?, ?)", (key, value, now)
+        )
+        if cursor.rowcount:
+            self._n_entries += 1
+        else:
+            # 他のプロセスが同じキーを書き込み済みの場合は上書きする(件数は増えない)
+            self._conn.execute("UPDATE orders SET value = ?, last_used = ? WHERE key = ?", (value, now, key))
+        self._touched.pop(key, None)
+        if self._n_entries > self.max_entries:
+            self._evict()
+        self._wrote()
+
+    def _evict(self):
+        """
+        最後に参照した時刻が古いものから削除し，件数を上限の9割にする
+        """
+        # 参照した時刻を反映し，他のプロセスの書き込みも含めて数え直す
+        self._write_touched()
+        self._n_entries = self._count()
+        excess = self._n_entries - self.max_entries * 9 // 10
+        if self._n_entries <= self.max_entries or excess <= 0:
+            return
+        self._conn.execute(
+            "DELETE FROM orders WHERE key IN (SELECT key FROM orders ORDER BY last_used LIMIT ?)", (excess,)
+        )
+        self.evictions += excess
+        self._n_entries -= excess
+
+    def _wrote(self):
+        self._pending += 1
+        if self._pending >= self.commit_interval:
+            self.flush()
+
+    def _write_touched(self):
+        """
+        ヒットしたキーの参照時刻をまとめて書き込む
+        """
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE orders SET last_used = ? WHERE key = ?", [(t, key) for key, t in self._touched.items()]
+            )
+            self._touched.clear()
+
+    def flush(self):
+        """
+        参照時刻と未コミットの書き込みをコミット
+        """
+        self._write_touched()
+        self._conn.commit()
+        self._pending = 0
+
+    def stats(self):
+        """
+        ヒット・ミスの統計を取得
+        :return: hits, misses, hit_rate, evictions, entriesの辞書
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": self._n_entries,
+        }
+
+    def close(self):
+        """
+        コミットしてファイルを閉じる
+        """
+        self.flush()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def cached_order(cache, algorithm, version, boxes, compute, **params):
+    """
+    キャッシュにあれば保存された結果を返し，なければ計算して保存する
+    :param cache: OrderCache(Noneの場合は常に計算する)
+    :param algorithm: アルゴリズムの名前
+    :param version: アルゴリズムのバージョン
+    :param boxes: キーに含める座標配列
+    :param compute: 結果を計算する引数なしの関数
+    :param params: キーに含めるパラメータ
+    :return: 結果
+    """
+    if cache is None:
+        return compute()
+    key = cache.key(algorithm, version, boxes, **params)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.put(key, value)
+    return value
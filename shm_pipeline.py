@@ -0,0 +1,292 @@
+import argparse
+import json
+import math
+import multiprocessing as mp
+import os
+import queue
+import sys
+import time
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+from modules import extractSpeechBalloon
+from batch_order import iter_title_tasks, list_titles, order_page, page_error, read_error
+
+# 共有メモリのスロット数の既定値(デコード済みで検出待ちのページ数の上限)
+PIPELINE_SLOTS = 8
+# 1スロットに入る画像の大きさの既定値(Manga109の見開きページ)
+PIPELINE_SLOT_SHAPE = (1170, 1654, 3)
+# 結果を待つ間にワーカープロセスの異常終了を確認する間隔[秒]
+PIPELINE_POLL_INTERVAL = 1.0
+
+
+class PageRing:
+    """
+    共有メモリ上に固定長のスロットを並べたページ画像のバッファ
+    各プロセスはスロット番号からコピーなしでNumPyの配列として参照する
+    """
+
+    def __init__(self, n_slots=PIPELINE_SLOTS, slot_shape=PIPELINE_SLOT_SHAPE, name=None):
+        """
+        :param n_slots: スロット数
+        :param slot_shape: 1スロットに入る画像の大きさ(この画素数以下の画像を格納できる)
+        :param name: 既存の共有メモリの名前(Noneの場合は新しく作成する)
+        """
+        self.n_slots = n_slots
+        self.slot_shape = tuple(slot_shape)
+        self.slot_bytes = math.prod(self.slot_shape)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=n_slots * self.slot_bytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+    @property
+    def spec(self):
+        """
+        他のプロセスで同じバッファを開くための情報
+        """
+        return self.n_slots, self.slot_shape, self.shm.name
+
+    @classmethod
+    def attach(cls, spec):
+        """
+        他のプロセスが作成したバッファを開く
+        :param spec: PageRing.spec
+        :return: PageRing
+        """
+        n_slots, slot_shape, name = spec
+        return cls(n_slots, slot_shape, name)
+
+    def fits(self, shape):
+        """
+        画像がスロットに入るか
+        :param shape: 画像の大きさ
+        """
+        return math.prod(shape) <= self.slot_bytes
+
+    def view(self, slot, shape):
+        """
+        スロットを画像の配列として参照(コピーしない)
+        :param slot: スロット番号
+        :param shape: 画像の大きさ
+        :return: uint8の配列
+        """
+        return np.ndarray(shape, np.uint8, buffer=self.shm.buf, offset=slot * self.slot_bytes)
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        """
+        共有メモリを解放(作成したプロセスで全てのプロセスがcloseした後に呼ぶ)
+        """
+        self.shm.unlink()
+
+
+def _decode_worker(ring_spec, tasks, free_slots, decoded, grayscale):
+    """
+    画像をデコードして空いているスロットに書き込む(デコードのプロセスで実行)
+    空いているスロットがない場合は検出が終わってスロットが返されるまで待つ
+    :param ring_spec: PageRing.spec
+    :param tasks: (通し番号, タスク)のキュー(Noneで終了)
+    :param free_slots: 空いているスロット番号のキュー
+    :param decoded: 検出へ渡す(通し番号, タスク, スロット番号, 画像の大きさまたはエラー)のキュー
+    :param grayscale: Trueの場合はグレースケールでデコードする
+    """
+    ring = PageRing.attach(ring_spec)
+    flags = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    try:
+        for seq, task in iter(tasks.get, None):
+            if task["img_path"] is None:
+                decoded.put((seq, task, None, None))
+                continue
+            try:
+                img = task["img_source"].read(task["page_index"], flags)
+            except Exception as e:
+                decoded.put((seq, task, None, f"{type(e).__name__}: {e}"))
+                continue
+            if img is None:
+                decoded.put((seq, task, None, read_error(task)["error"]))
+                continue
+            if not ring.fits(img.shape):
+                decoded.put((seq, task, None, f"page {img.shape} does not fit in ring slot {ring.slot_shape}"))
+                continue
+            slot = free_slots.get()
+            ring.view(slot, img.shape)[...] = img
+            decoded.put((seq, task, slot, img.shape))
+    finally:
+        ring.close()
+
+
+def _detect_worker(ring_spec, decoded, free_slots, detected):
+    """
+    スロットの画像から吹き出しを検出し，スロットを返す(検出のプロセスで実行)
+    順序推定へは検出したバウンディングボックスだけを渡す
+    :param ring_spec: PageRing.spec
+    :param decoded: (通し番号, タスク, スロット番号, 画像の大きさまたはエラー)のキュー(Noneで終了)
+    :param free_slots: 空いているスロット番号のキュー
+    :param detected: 順序推定へ渡す(通し番号, タスク, 吹き出し, ページの(高さ, 幅)またはエラー)のキュー
+    """
+    ring = PageRing.attach(ring_spec)
+    try:
+        for seq, task, slot, shape in iter(decoded.get, None):
+            if slot is None:
+                detected.put((seq, task, None, shape))
+                continue
+            try:
+                texts = extractSpeechBalloon(ring.view(slot, shape))
+            except Exception as e:
+                detected.put((seq, task, None, f"{type(e).__name__}: {e}"))
+                continue
+            finally:
+                free_slots.put(slot)
+            detected.put((seq, task, texts, shape[:2]))
+    finally:
+        ring.close()
+
+
+def _order_worker(detected, results):
+    """
+    コマと吹き出しの順序を推定(順序推定のプロセスで実行)
+    :param detected: (通し番号, タスク, 吹き出し, ページの(高さ, 幅)またはエラー)のキュー(Noneで終了)
+    :param results: (通し番号, 推定結果)のキュー
+    """
+    for seq, task, texts, info in iter(detected.get, None):
+        try:
+            if task["img_path"] is None:
+                result = order_page(task, task["texts"], task["page_width"], task["page_height"])
+            elif texts is None:
+                result = {"title": task["title"], "page": task["page_index"], "error": info}
+            else:
+                page_height, page_width = info
+                result = order_page(task, texts, page_width, page_height)
+        except Exception as e:
+            result = page_error(task, e)
+        results.put((seq, result))
+
+
+def _check_workers(processes):
+    """
+    異常終了したワーカープロセスがないか確認
+    (検出のプロセスが終了するとスロットが返されずデコードも止まるため，結果を待ち続けないようにする)
+    :param processes: ワーカープロセスのリスト
+    :raises RuntimeError: 終了コードが0以外のプロセスがある場合
+    """
+    for process in processes:
+        if process.exitcode not in (None, 0):
+            raise RuntimeError(f"pipeline worker {process.name} exited with code {process.exitcode}")
+
+
+def run_pipeline(
+    tasks,
+    decoders=1,
+    detectors=None,
+    orderers=1,
+    n_slots=PIPELINE_SLOTS,
+    slot_shape=PIPELINE_SLOT_SHAPE,
+    grayscale=False,
+):
+    """
+    デコード・吹き出し検出・順序推定を別々のプロセスで行い，ページの推定結果を完了した順に返すジェネレータ
+    デコードした画像は共有メモリのスロットに置き，検出のプロセスはスロット番号で参照する(画像はpickleしない)
+    スロットは検出が終わると再利用され，全て使用中の場合はデコードが待つ
+    :param tasks: ページのタスク(batch_order.iter_title_tasksを参照)のリスト
+    :param decoders: デコードのプロセス数
+    :param detectors: 吹き出し検出のプロセス数(Noneの場合はCPU数からデコード・順序推定のプロセス数を引いた数)
+    :param orderers: 順序推定のプロセス数
+    :param n_slots: 共有メモリのスロット数
+    :param slot_shape: 1スロットに入る画像の大きさ(これより画素数が多いページはエラーになる)
+    :param grayscale: Trueの場合はグレースケールでデコードする(実際のページ画像で検出結果がカラーと同じになることは確認していない)
+    :return: ページの推定結果のジェネレータ
+    :raises RuntimeError: ワーカープロセスが異常終了した場合(OOMなどによる強制終了を含む)
+    """
+    tasks = list(tasks)
+    if detectors is None:
+        detectors = max(1, (os.cpu_count() or 1) - decoders - orderers)
+    ring = PageRing(n_slots, slot_shape)
+    task_queue, free_slots, decoded, detected, results = (mp.Queue() for _ in range(5))
+    for slot in range(n_slots):
+        free_slots.put(slot)
+
+    stages = [
+        (decoders, _decode_worker, (ring.spec, task_queue, free_slots, decoded, grayscale)),
+        (detectors, _detect_worker, (ring.spec, decoded, free_slots, detected)),
+        (orderers, _order_worker, (detected, results)),
+    ]
+    processes = [
+        [mp.Process(target=target, args=args, name=f"{target.__name__.strip('_')}-{i}", daemon=True) for i in range(n)]
+        for n, target, args in stages
+    ]
+    for process in sum(processes, []):
+        process.start()
+
+    finished = False
+    try:
+        for seq, task in enumerate(tasks):
+            task_queue.put((seq, task))
+        for _ in range(decoders):
+            task_queue.put(None)
+        for _ in range(len(tasks)):
+            while True:
+                try:
+                    _, result = results.get(timeout=PIPELINE_POLL_INTERVAL)
+                    break
+                except queue.Empty:
+                    _check_workers(sum(processes, []))
+            yield result
+        finished = True
+    finally:
+        if finished:
+            # 全ページの結果を受け取ったので検出・順序推定のプロセスを終了させる(デコードは終了済み)
+            for _ in range(detectors):
+                decoded.put(None)
+            for _ in range(orderers):
+                detected.put(None)
+            for process in sum(processes, []):
+                process.join()
+        else:
+            for process in sum(processes, []):
+                process.terminate()
+                process.join()
+        ring.close()
+        ring.unlink()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="共有メモリのパイプラインでManga109の吹き出しを検出し，順序を推定する")
+    parser.add_argument(
+        "--annotations",
+        default="./../Manga109_released_2021_12_30/annotations.v2020.12.18/",
+        help="アノテーションファイルのディレクトリ",
+    )
+    parser.add_argument(
+        "--images",
+        default="./../Manga109_released_2021_12_30/images/",
+        help="画像ファイルのディレクトリ(タイトルごとのフォルダまたは<タイトル>.cbz/.zip)",
+    )
+    parser.add_argument("--titles", nargs="+", default=["all"], help='漫画のタイトル(全タイトルの場合は"all")')
+    parser.add_argument("--output", default="order_results.jsonl", help="出力するJSONLファイル")
+    parser.add_argument("--decoders", type=int, default=1, help="デコードのプロセス数")
+    parser.add_argument("--detectors", type=int, default=None, help="吹き出し検出のプロセス数(省略時はCPU数に合わせる)")
+    parser.add_argument("--orderers", type=int, default=1, help="順序推定のプロセス数")
+    parser.add_argument("--slots", type=int, default=PIPELINE_SLOTS, help="共有メモリのスロット数")
+    parser.add_argument("--grayscale", action="store_true", help="グレースケールでデコードする(既定はカラー)")
+    parser.add_argument("--iou-threshold", type=float, default=0.5, help="コマに内包されているかを判定するIoUの閾値")
+    parser.add_argument("--cache", default=None, help="順序推定の結果を再利用するキャッシュファイル(SQLite)")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    tasks = []
+    for manga_title in list_titles(args.annotations, args.titles):
+        tasks += iter_title_tasks(
+            args.annotations, args.images, manga_title, True, args.iou_threshold, cache_path=args.cache
+        )
+    with open(args.output, "w", encoding="utf-8") as out:
+        results = run_pipeline(
+            tasks, args.decoders, args.detectors, args.orderers, args.slots, grayscale=args.grayscale
+        )
+        for result in results:
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+    elapsed = time.perf_counter() - start_time
+    print(f"{len(tasks)} pages, {len(tasks) / max(elapsed, 1e-9):.1f} pages/sec", file=sys.stderr)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from modules import assign_objs_to_panels, assign_objs_to_panels_indexed, build_grid_index, get_bounded_objs_page
+
+
+def _random_boxes(rng, n, page_size, max_side, degenerate=0.0):
+    """
+    ランダムなバウンディングボックス(degenerateの割合で反転・面積0のボックスを混ぜる)
+    """
+    xy = rng.integers(0, page_size, (n, 2))
+    side = rng.integers(0, max_side, (n, 2))
+    boxes = np.concatenate([xy, xy + side], axis=1)
+    flip = rng.random(n) < degenerate
+    boxes[flip] = boxes[flip][:, [2, 3, 0, 1]] - rng.integers(0, 2, (flip.sum(), 4))
+    return boxes
+
+
+@pytest.mark.parametrize("best_only", [False, True])
+@pytest.mark.parametrize("degenerate", [0.0, 0.2])
+def test_grid_matches_dense(best_only, degenerate):
+    rng = np.random.default_rng(int(best_only) * 10 + int(degenerate * 10))
+    for _ in range(200):
+        panels = _random_boxes(rng, int(rng.integers(0, 10)), 800, 400, degenerate)
+        objs = _random_boxes(rng, int(rng.integers(0, 60)), 800, 120, degenerate)
+        iou_threshold = float(rng.choice([0.0, 0.3, 0.5, 1.0]))
+        dense = assign_objs_to_panels(panels, objs, iou_threshold, best_only)
+        indexed = assign_objs_to_panels_indexed(panels, objs, iou_threshold, best_only)
+        assert len(dense) == len(indexed)
+        for expected, actual in zip(dense, indexed):
+            np.testing.assert_array_equal(actual, expected)
+
+
+def test_grid_index_with_only_inverted_boxes():
+    objs = np.array([[10, 10, 5, 20], [30, 40, 35, 30]])
+    index = build_grid_index(objs)
+    assert len(index["cell_objs"]) == 0
+    assigned = assign_objs_to_panels_indexed([[0, 0, 100, 100]], objs, index=index)
+    np.testing.assert_array_equal(assigned[0], np.zeros(0, dtype=np.int64))
+
+
+def test_get_bounded_objs_page_dispatch_gives_same_result():
+    rng = np.random.default_rng(0)
+    panels = [dict(zip(("xmin", "ymin", "xmax", "ymax"), box)) for box in _random_boxes(rng, 6, 800, 400).tolist()]
+    objs = [dict(zip(("xmin", "ymin", "xmax", "ymax"), box)) for box in _random_boxes(rng, 50, 800, 120, 0.1).tolist()]
+    expected = get_bounded_objs_page(panels, objs, use_index=False)
+    assert get_bounded_objs_page(panels, objs, use_index=True) == expected
+    assert get_bounded_objs_page(panels, objs) == expected
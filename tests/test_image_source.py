@@ -0,0 +1,41 @@
+import threading
+import time
+import zipfile
+import image_source
+
+
+def test_archive_opened_once_by_concurrent_threads(tmp_path, monkeypatch):
+    archive_path = str(tmp_path / "title.cbz")
+    with zipfile.ZipFile(archive_path, "w") as archive:
+        for page_index in range(3):
+            archive.writestr(f"{page_index:03d}.jpg", b"")
+
+    opened = []
+
+    class SlowZipFile(zipfile.ZipFile):
+        def __init__(self, *args, **kwargs):
+            # 開くのに時間がかかる書庫で，スレッドが同時に開こうとする状況を作る
+            time.sleep(0.05)
+            super().__init__(*args, **kwargs)
+            opened.append(self)
+
+    monkeypatch.setattr(image_source.zipfile, "ZipFile", SlowZipFile)
+    image_source.close_archives()
+    barrier = threading.Barrier(8)
+    results = []
+
+    def worker():
+        barrier.wait()
+        results.append(image_source._archive(archive_path))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(opened) == 1
+    assert all(archive is opened[0] for archive, _ in results)
+    assert sorted(results[0][1]) == [0, 1, 2]
+    image_source.close_archives()
+    assert opened[0].fp is None
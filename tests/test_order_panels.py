@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from panel_order_estimater import _order_panels, calculate_pseudo_regions
+
+
+def _order_panels_reference(pseudo_regions, page_width, page_height):
+    """
+    変更前のorder_panels(候補を毎回全コマから探す実装)
+    """
+    ordered = []
+    remaining = list(range(len(pseudo_regions)))
+
+    while remaining:
+        # 上側に未定義のコマがないものを探す
+        top_candidates = [
+            i for i in remaining if all(pseudo_regions[i][1] <= pseudo_regions[j][3] for j in remaining if i != j)
+        ]
+
+        if not top_candidates:
+            break
+
+        # 右上座標がページ右上に最も近いコマを選択
+        closest = min(
+            top_candidates, key=lambda i: ((page_width - pseudo_regions[i][2]) ** 2 + pseudo_regions[i][1] ** 2) ** 0.5
+        )
+
+        ordered.append(closest)
+        remaining.remove(closest)
+
+        current_region = pseudo_regions[closest]
+
+        # 左端かどうかをチェック
+        if any(pseudo_regions[i][2] < current_region[0] for i in remaining):
+            # 左端でない場合、次のコマを探す
+            next_candidates = [
+                i
+                for i in remaining
+                if pseudo_regions[i][1] >= current_region[3] and pseudo_regions[i][0] >= current_region[2]
+            ]
+            if next_candidates:
+                next_panel = min(
+                    next_candidates,
+                    key=lambda i: (
+                        (pseudo_regions[i][0] - current_region[2]) ** 2
+                        + (pseudo_regions[i][1] - current_region[3]) ** 2
+                    )
+                    ** 0.5,
+                )
+                ordered.append(next_panel)
+                remaining.remove(next_panel)
+
+    return ordered
+
+
+def _random_regions(rng, n, grid):
+    """
+    ランダムなコマ領域(gridが小さいほど座標・距離が同じコマが増える)
+    """
+    corners = rng.integers(0, grid, (n, 2, 2)) * (1000 // grid)
+    return np.concatenate([corners.min(axis=1), corners.max(axis=1) + 1], axis=1).astype(np.float64)
+
+
+@pytest.mark.parametrize("grid", [4, 10, 1000])
+def test_order_panels_matches_reference(grid):
+    rng = np.random.default_rng(grid)
+    for _ in range(500):
+        regions = _random_regions(rng, int(rng.integers(0, 12)), grid)
+        expected = _order_panels_reference(regions.tolist(), 1000, 1000)
+        assert _order_panels(regions, 1000, 1000) == expected
+
+
+def test_order_panels_matches_reference_on_pseudo_regions():
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        regions = _random_regions(rng, int(rng.integers(1, 12)), 20)
+        panels = [
+            {"xmin": int(x0), "ymin": int(y0), "xmax": int(x1), "ymax": int(y1)} for x0, y0, x1, y1 in regions
+        ]
+        pseudo_regions = calculate_pseudo_regions(panels)
+        expected = _order_panels_reference(np.asarray(pseudo_regions).tolist(), 1000, 1000)
+        assert _order_panels(pseudo_regions, 1000, 1000) == expected
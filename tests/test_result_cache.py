@@ -0,0 +1,83 @@
+import numpy as np
+from balloon_order import order_balloons2, order_page_balloons
+from result_cache import OrderCache, cached_order
+
+
+def _box(xmin, ymin, xmax, ymax):
+    return {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax}
+
+
+def test_put_get_round_trip(tmp_path):
+    boxes = np.array([[0, 0, 10, 10], [5, 5, 20, 20]])
+    with OrderCache(str(tmp_path / "cache.sqlite")) as cache:
+        key = cache.key("order", 1, boxes, iou_threshold=0.5)
+        assert cache.get(key) is None
+        cache.put(key, [1, 0])
+        assert cache.get(key) == [1, 0]
+        # 同じキーへの書き込みは上書きで，件数は増えない
+        cache.put(key, [0, 1])
+        assert cache.get(key) == [0, 1]
+        # 座標・バージョン・パラメータが違えば別のキー
+        assert cache.key("order", 2, boxes, iou_threshold=0.5) != key
+        assert cache.key("order", 1, boxes + 1, iou_threshold=0.5) != key
+        assert cache.key("order", 1, boxes, iou_threshold=0.3) != key
+        assert cache.stats() == {"hits": 2, "misses": 1, "hit_rate": 2 / 3, "evictions": 0, "entries": 1}
+
+    # 閉じた後に開き直しても結果が残っている
+    with OrderCache(str(tmp_path / "cache.sqlite")) as cache:
+        assert cache.get(key) == [0, 1]
+        assert cache.stats()["entries"] == 1
+
+
+def test_cached_order_computes_once(tmp_path):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return [2, 0, 1]
+
+    boxes = np.array([[0, 0, 1, 1]])
+    with OrderCache(str(tmp_path / "cache.sqlite")) as cache:
+        assert cached_order(cache, "order", 1, boxes, compute) == [2, 0, 1]
+        assert cached_order(cache, "order", 1, boxes, compute) == [2, 0, 1]
+        assert len(calls) == 1
+        assert (cache.hits, cache.misses) == (1, 1)
+    assert cached_order(None, "order", 1, boxes, compute) == [2, 0, 1]
+    assert len(calls) == 2
+
+
+def test_eviction_keeps_recently_used(tmp_path):
+    with OrderCache(str(tmp_path / "cache.sqlite"), max_entries=10, commit_interval=1) as cache:
+        keys = [cache.key("order", 1, np.array([[i, 0, i + 1, 1]])) for i in range(11)]
+        for i, key in enumerate(keys[:10]):
+            cache.put(key, [i])
+        cache.get(keys[0])
+        cache.put(keys[10], [10])
+        assert cache.stats()["entries"] == 9
+        assert cache.get(keys[0]) == [0]
+        assert cache.get(keys[10]) == [10]
+        assert cache.get(keys[1]) is None
+
+
+def test_order_page_balloons_cache_hit_matches_miss(tmp_path):
+    panels = [_box(0, 0, 400, 300), _box(0, 300, 400, 600)]
+    text_info = [
+        _box(20, 20, 80, 120),
+        _box(300, 30, 380, 140),
+        _box(150, 150, 220, 250),
+        _box(310, 320, 390, 420),
+        _box(30, 450, 90, 560),
+    ]
+    expected = order_page_balloons(panels, text_info)
+    with OrderCache(str(tmp_path / "cache.sqlite")) as cache:
+        miss = order_page_balloons(panels, text_info, cache=cache)
+        hit = order_page_balloons(panels, text_info, cache=cache)
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert miss == expected
+        assert hit == expected
+        # ヒットした場合も呼び出し側の吹き出しの辞書を返す
+        assert {id(balloon) for order in hit for balloon in order} <= {id(text) for text in text_info}
+
+        panel_order = order_balloons2(panels[0], text_info[:3], cache=cache)
+        assert order_balloons2(panels[0], text_info[:3], cache=cache) == panel_order
+        assert (cache.hits, cache.misses) == (2, 2)
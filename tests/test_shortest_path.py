@@ -0,0 +1,68 @@
+import itertools
+import warnings
+
+import numpy as np
+import pytest
+from modules import _branch_and_bound_path, _path_length, shortest_hamiltonian_path
+
+
+def _random_dist_matrix(rng, n_points, grid=None):
+    """
+    ランダムな点の距離行列(gridを指定した場合は格子点にして同じ距離の経路を作る)
+    """
+    points = rng.integers(0, grid, (n_points, 2)).astype(float) if grid else rng.random((n_points, 2)) * 500
+    return np.linalg.norm(points[:, None] - points[None], axis=-1)
+
+
+def _permutation_path(dist_matrix):
+    """
+    全順列を列挙して最短経路を求める(変更前のorder_balloons2と同じ，同じ距離の場合は先に見つかったもの)
+    """
+    N = dist_matrix.shape[0]
+    best_dist, best_path = np.inf, None
+    for via in itertools.permutations(range(1, N - 1)):
+        path = [0, *via, N - 1]
+        dist = np.sum([dist_matrix[path[i], path[i + 1]] for i in range(N - 1)])
+        if dist < best_dist:
+            best_dist, best_path = dist, path
+    return best_path
+
+
+@pytest.mark.parametrize("n_via", range(1, 9))
+def test_held_karp_matches_permutations(n_via):
+    rng = np.random.default_rng(n_via)
+    # 全順列の列挙が遅いため経由点が多い場合は試行回数を減らす
+    for _ in range(20 if n_via <= 6 else 3):
+        dist_matrix = _random_dist_matrix(rng, n_via + 2)
+        assert shortest_hamiltonian_path(dist_matrix) == _permutation_path(dist_matrix)
+
+
+def test_held_karp_tie_break_matches_permutations():
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        dist_matrix = _random_dist_matrix(rng, int(rng.integers(4, 9)), grid=5)
+        expected = _permutation_path(dist_matrix)
+        path = shortest_hamiltonian_path(dist_matrix)
+        assert _path_length(dist_matrix, path) == pytest.approx(_path_length(dist_matrix, expected))
+
+
+def test_branch_and_bound_is_exact_when_not_truncated():
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        dist_matrix = _random_dist_matrix(rng, 9)
+        path, optimal = shortest_hamiltonian_path(dist_matrix, exact_limit=0, return_optimal=True)
+        assert optimal
+        assert _path_length(dist_matrix, path) == pytest.approx(_path_length(dist_matrix, _permutation_path(dist_matrix)))
+
+
+def test_truncated_search_is_reported():
+    dist_matrix = _random_dist_matrix(np.random.default_rng(2), 24)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        path, optimal = shortest_hamiltonian_path(dist_matrix, max_expansions=100, return_optimal=True)
+    assert not optimal
+    assert any("longer than the shortest" in str(w.message) for w in caught)
+    assert sorted(path) == list(range(24)) and path[0] == 0 and path[-1] == 23
+    # 下界は見つかった経路より長くならない
+    _, _, lower_bound = _branch_and_bound_path(dist_matrix, 100)
+    assert lower_bound <= _path_length(dist_matrix, path) + 1e-9